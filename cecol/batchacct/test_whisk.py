@@ -15,7 +15,6 @@ class TestWhisk(unittest.TestCase):
     def test_parse(self):
         # Create simple-minded event handler
         evthdl = EventHandler()
-        evthdl.buf = ''
         evthdl.offset = 0
 
         # Create temporary accounting file
@@ -30,6 +29,7 @@ class TestWhisk(unittest.TestCase):
         w.flush()
         os.fsync(fd)
         self.assertEqual(list(common.parse(r, evthdl)), [])
+        self.assertEqual(evthdl.offset, 0)
 
         # Write the remainder to it
         l = L[40:]
@@ -38,7 +38,52 @@ class TestWhisk(unittest.TestCase):
         w.flush()
         os.fsync(fd)
         self.assertEqual(len(list(common.parse(r, evthdl))), 1)
+        self.assertEqual(evthdl.offset, len(L) + 1)
+
+        # Nothing new to read
+        self.assertEqual(list(common.parse(r, evthdl)), [])
 
         # Cleanup
         r.close()
         w.close()
+
+    def test_resume(self):
+        # Create accounting file with two records
+        fd, path = tempfile.mkstemp()
+        w = os.fdopen(fd, 'w')
+        w.write(L + '\n')
+        w.write(L.replace('lrmsID=42', 'lrmsID=43') + '\n')
+        w.close()
+
+        # Resume right after the first record
+        evthdl = EventHandler()
+        evthdl.offset = len(L) + 1
+        r = open(path, 'r')
+        recs = list(common.parse(r, evthdl))
+        self.assertEqual(len(recs), 1)
+        self.assertEqual(recs[0]['lrmsID'], 43)
+        self.assertEqual(evthdl.offset, os.path.getsize(path))
+
+        # Cleanup
+        r.close()
+        os.remove(path)
+
+    def test_checkpoint(self):
+        # Checkpoint some file
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        ckpt = common.Checkpoint(path + '.ckpt')
+        self.assertEqual(ckpt.load(), False)
+        ckpt.save('blahp.log-19701010', os.stat(path), 42, 24494520.)
+
+        # Read it back
+        ckpt = common.Checkpoint(path + '.ckpt')
+        self.assertEqual(ckpt.load(), True)
+        self.assertEqual(ckpt.name, 'blahp.log-19701010')
+        self.assertEqual(ckpt.offset, 42)
+        self.assertEqual(ckpt.eventtime, 24494520.)
+        self.assert_(ckpt.matches(os.stat(path)))
+
+        # Cleanup
+        os.remove(path)
+        os.remove(path + '.ckpt')
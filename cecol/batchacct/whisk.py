@@ -13,12 +13,20 @@ import optparse
 import pyinotify
 import datetime
 import time
-from pyinotify import IN_CREATE, IN_MODIFY
+import threading
+import Queue
+from pyinotify import IN_CREATE, IN_MODIFY, IN_MOVED_TO
 import common
 
 PIDFILE = '/var/run/batchacct/batchacct-cecold.pid'
+CKPTFILE = '/var/lib/batchacct/batchacct-cecold.ckpt'
+STATEFILE = '/var/lib/batchacct/batchacct-cecold.state'
 LOGFILE = '/var/log/batchacct/batchacct-cecold.log'
 REFILENAME = re.compile('^blahp.log-\d{8}$')
+HARVESTERS = 8 # CEs harvested at a time in central mode
+HOSTTIMEOUT = 600 # Seconds a CE may take to be harvested in central mode
+FETCHSIZE = 1000 # Jobs fetched at a time from CE DBs
+PENDINGAGE = 86400 # Seconds jobs may wait for their LRMS id to be harvested
 
 def latest(acctdir):
     '''
@@ -26,18 +34,13 @@ def latest(acctdir):
     BLAH file name.
     '''
     # List BLAH files
-    entries = [(e, os.stat('%s/%s' % (acctdir, e)))
-               for e in os.listdir(acctdir)
-               if REFILENAME.match(e)]
+    entries = [e for e in os.listdir(acctdir) if REFILENAME.match(e)]
 
     if len(entries) == 0:
         raise common.AcctError("Couldn't list BLAH accounting files")
 
-    # Sort them by modification time
-    entries.sort(key=lambda s: s[1].st_mtime)
-
-    # Return latest BLAH file's name
-    return entries[-1][0]
+    # The date is in the name: no need to stat them to know which is latest
+    return max(entries)
 
 class EventHandler(pyinotify.ProcessEvent):
     # Not quite the same as the local collector one (e.g. I can't just sit 
@@ -45,26 +48,186 @@ class EventHandler(pyinotify.ProcessEvent):
     # rotation). I can't really just refactor things around.
 
     def __init__(self, logger, acctdir, connection,
-                 heartbeatdelta=common.HBDELTA):
+                 heartbeatdelta=common.HBDELTA, batchsize=None,
+                 checkpoint=None, pipeline=None):
         self.logger = logger
         self.acctdir = acctdir
         self.acctfile = None
+        self.newest = None # Latest BLAH file name, as far as we know
+        self.fileobj = None
         self.connection = connection
         self.heartbeatdelta = heartbeatdelta
+        self.batchsize = batchsize
 
         self.heartbeat = datetime.datetime.today()
         self.insertc = 0
         self.errorc = 0
-        self.offset = 0
+        self.offset = 0 # Byte position after the last whole line read
+        self.eventtime = None
+        self.checkpoint = checkpoint
+        self.pipeline = pipeline # Records are written right away if None
+        self.pending = 0 # Modification events not dealt with yet
+
+    def follow(self, acctfile, offset=0):
+        '''
+        Open a BLAH file and make it the currently-read one, closing the
+        previous one if any. Reading will start at the byte offset passed
+        as optional argument.
+        '''
+        if self.fileobj is not None:
+            self.fileobj.close()
+        self.acctfile = acctfile
+        self.fileobj = open(self.acctdir + '/' + acctfile)
+        self.offset = offset
 
-        self.buf = '' # To handle improperly flushed lines
+    def resume(self):
+        '''
+        Pick up where the last checkpoint says we stopped, if there's any
+        checkpoint and if its file is still there, and read whatever has
+        been written since.
+        '''
+        if self.checkpoint is not None and self.checkpoint.load():
+            path = self.acctdir + '/' + self.checkpoint.name
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+
+            if st is not None and self.checkpoint.matches(st) and \
+               st.st_size >= self.checkpoint.offset:
+                self.follow(self.checkpoint.name, self.checkpoint.offset)
+                fmt = "Resuming %s from byte %d"
+                self.logger.info(fmt % (self.acctfile, self.offset))
+            else:
+                fmt = "Checkpointed file %s is gone or has been replaced"
+                self.logger.warning(fmt % self.checkpoint.name)
+
+        self.catchup()
+
+    def snapshot(self):
+        '''
+        Return a function saving the checkpoint as it stands now, to be
+        called once the records read so far have been committed, or None if
+        there's no checkpoint.
+        '''
+        if self.checkpoint is None:
+            return None
+
+        acctfile, offset, eventtime = \
+            self.acctfile, self.offset, self.eventtime
+        st = os.fstat(self.fileobj.fileno())
+        def save():
+            try:
+                self.checkpoint.save(acctfile, st, offset, eventtime)
+            except (IOError, OSError), e:
+                self.logger.error("Couldn't save checkpoint: %s" % e)
+        return save
+
+    def save(self):
+        '''
+        Save checkpoint, once the records read so far have been committed.
+        '''
+        save = self.snapshot()
+        if save is not None:
+            save()
+
+    def replaced(self):
+        '''
+        Check whether the currently-read file has been replaced by another
+        file with the same name (i.e. a different inode) or truncated, in
+        which case it's opened again.
+        '''
+        try:
+            st = os.stat(self.acctdir + '/' + self.acctfile)
+        except OSError:
+            # It's gone: keep reading what's left from the open handle
+            return
+
+        fst = os.fstat(self.fileobj.fileno())
+        if (st.st_ino, st.st_dev) != (fst.st_ino, fst.st_dev):
+            # Same data rewritten (e.g. vi) or new file altogether: the
+            # size tells which.
+            if st.st_size < self.offset:
+                self.logger.info("%s replaced, reading it from the start" %
+                                 self.acctfile)
+                self.follow(self.acctfile)
+            else:
+                self.follow(self.acctfile, self.offset)
+        elif st.st_size < self.offset:
+            self.logger.info("%s truncated, reading it from the start" %
+                             self.acctfile)
+            self.offset = 0
+
+    def collect(self):
+        '''
+        Send whichever whole lines have been appended to the currently-read
+        file since the last time to the DB.
+        '''
+        recs = common.parse(self.fileobj, self)
+
+        if self.pipeline is not None:
+            self.pipeline.put(recs, self.snapshot)
+            return
+
+        insertc, errorc, heartbeat = \
+            common.insert(self.logger, common.CETAB, recs,
+                          self.connection, self.insertc, self.errorc,
+                          self.heartbeat, self.heartbeatdelta,
+                          batchsize=self.batchsize, commitfn=self.save)
+
+        self.insertc = insertc
+        self.errorc = errorc
+        self.heartbeat = heartbeat
 
     def process_IN_MODIFY(self, event):
         '''
         Handles a file modification event in currently-read files as well as
         in newly-created ones, typically when one or more event records have
-        been appended to the accounting file. The new records are sent to the
-        database here.
+        been appended to the accounting file. The event is merely counted
+        here and the new records are sent to the database when pending events
+        are drained.
+        '''
+        self.pending += 1
+
+    def process_IN_CREATE(self, event):
+        '''
+        Handles a file creation event, typically when a new day's BLAH file
+        shows up, in which case it's remembered as the latest one. No
+        listing or stat()ing of the accounting directory is needed then.
+        '''
+        if REFILENAME.match(event.name) and \
+           (self.newest is None or event.name > self.newest):
+            self.newest = event.name
+            self.pending += 1
+
+    # A BLAH file moved in is as good as a created one
+    process_IN_MOVED_TO = process_IN_CREATE
+
+    def process_IN_Q_OVERFLOW(self, event):
+        '''
+        Handles an inotify event queue overflow, after which there's no
+        telling which events have been missed out: the accounting directory
+        is listed again and everything is read again from the last
+        checkpoint, once whatever is being written has been.
+        '''
+        self.logger.warning("Event queue overflow, rescanning from checkpoint")
+        if self.pipeline is not None:
+            self.pipeline.join()
+        self.pending = 0
+        self.newest = None
+        self.resume()
+
+    def drain(self):
+        '''
+        Deal with all pending file modification events at once.
+        '''
+        self.pending = 0
+        self.catchup()
+
+    def catchup(self):
+        '''
+        Send whichever records have been appended to the currently-read
+        file to the DB and move on to the latest file if there's a newer one.
         '''
 
         # Issue: not sure how to deal with the currently-read file if it gets
@@ -74,165 +237,337 @@ class EventHandler(pyinotify.ProcessEvent):
         # 2. The file pointer shouldn't be reset because it's the same data
         #    which has been overwritten in the process of being added new lines
         #    (e.g. vi).
-        # Let's go for the second option, which the following does without even
-        # needing any CREATE event.
+        # Let's go for the second option unless the new file is shorter than
+        # what we've already read, which can only mean the former.
 
         try:
-            l = latest(self.acctdir)
+            if self.newest is None:
+                self.newest = latest(self.acctdir)
+            l = self.newest
             if l == self.acctfile:
                 # There's no new accounting file
-
-                f = open(self.acctdir + '/' + l)
-                recs = common.parse(f, self)
-
-                insertc, errorc, heartbeat = \
-                    common.insert(self.logger, common.CETAB, recs,
-                                  self.connection, self.insertc, self.errorc,
-                                  self.heartbeat, self.heartbeatdelta)
-                f.close()
-
-                self.insertc = insertc
-                self.errorc = errorc
-                self.heartbeat = heartbeat
+                self.replaced()
+                self.collect()
             else:
                 # There's a new accounting file (or we weren't reading any)
 
                 # Finish reading the current one if we were reading one
                 if self.acctfile != None:
-                    f = open(self.acctdir + '/' + self.acctfile)
-                    recs = common.parse(f, self)
-
-                    insertc, errorc, heartbeat = \
-                        common.insert(self.logger, common.CETAB, recs,
-                                      self.connection, self.insertc,
-                                      self.errorc, self.heartbeat,
-                                      self.heartbeatdelta)
-                    f.close()
-
-                    self.insertc = insertc
-                    self.errorc = errorc
-                    self.heartbeat = heartbeat
+                    self.collect()
 
                 # Read the new one
-                self.acctfile = l
-                self.offset = 0
+                self.follow(l)
                 self.logger.info("Will now be watching %s" % self.acctfile)
-
-                f = open(self.acctdir + '/' + self.acctfile)
-                recs = common.parse(f, self)
-
-                insertc, errorc, heartbeat = \
-                    common.insert(self.logger, common.CETAB, recs,
-                                  self.connection, self.insertc, self.errorc,
-                                  self.heartbeat, self.heartbeatdelta)
-                f.close()
-
-                self.insertc = insertc
-                self.errorc = errorc
-                self.heartbeat = heartbeat
+                self.collect()
+        except common.AcctDBError: # Writing has stopped
+            raise
         except common.AcctError: # As raised by latest
             # No need to fuss if a file we're not interested in gets changed
             pass
 
-def getjobs(ora, my, cetable):
+class Watermarks:
+    '''
+    On-disk id and timestamp of the last job harvested from each CE, which
+    is where the next harvest starts from. Safe to share between threads.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.marks = {} # (id, timestamp) tuples by CE host name
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''
+        Read state file. Returns True if there was a state file to read,
+        False otherwise.
+        '''
+        try:
+            f = open(self.path)
+            lines = f.readlines()
+            f.close()
+        except IOError:
+            return False
+
+        try:
+            for l in lines:
+                host, jobid, timestamp = l.split()
+                self.marks[host] = int(jobid), int(timestamp)
+        except ValueError:
+            raise common.AcctError("Corrupted state file: %s" % self.path)
+        return True
+
+    def get(self, host):
+        '''
+        Return the (id, timestamp) tuple of the last job harvested from the
+        CE passed as argument, or None.
+        '''
+        return self.marks.get(host)
+
+    def save(self, host, jobid, timestamp):
+        '''
+        Set the last job harvested from a CE and atomically write state file.
+        '''
+        self.lock.acquire()
+        try:
+            self.marks[host] = jobid, timestamp
+
+            tmp = self.path + '.tmp'
+            f = open(tmp, 'w')
+            for h, (i, t) in self.marks.items():
+                f.write('%s %d %d\n' % (h, i, t))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp, self.path)
+        finally:
+            self.lock.release()
+
+def cycled(my, cetable, mark):
     '''
-    Get (all) jobs from CE
+    Tell whether job ids have cycled on a CE, i.e. whether the last job
+    harvested is no longer there as it was.
 
     Expects:
-    - a cx_Oracle.Connection instance to the accounting DB
     - a MySQLdb.connections.Connection instance to the CE DB
     - the job table name on the CE DB
+    - the (id, timestamp) tuple of the last job harvested
+    '''
+    jobid, timestamp = mark
+    my.query('SELECT timestamp FROM %s WHERE id = %d' % (cetable, jobid))
+    rows = my.store_result().fetch_row()
+    return len(rows) == 0 or int(rows[0][0]) != timestamp
 
-    Returns a MySQLdb.result to be repeatedly read with fetch_row()
+def pending(my, cetable, mark=None):
+    '''
+    Return the smallest id of the jobs which don't have their LRMS id yet,
+    or None. The watermark is kept below it for them to be harvested once
+    they do. Jobs older than PENDINGAGE are given up on, for them not to
+    hold the watermark back forever.
 
-    This function would normally no longer be used since one is supposed to
-    directly read from the BLAH file, not from the CE DB.
+    Expects:
+    - a MySQLdb.connections.Connection instance to the CE DB
+    - the job table name on the CE DB
+    - optionally the (id, timestamp) tuple of the last job harvested
+    '''
+    where = "WHERE lrmsAbsLayerJobId = 'N/A' AND timestamp > %d" % \
+        (time.time() - PENDINGAGE)
+    if mark is not None:
+        where += " AND id > %d" % mark[0]
+    my.query('SELECT MIN(id) FROM %s %s' % (cetable, where))
+    rows = my.store_result().fetch_row()
+    if len(rows) == 0 or rows[0][0] is None:
+        return None
+    return int(rows[0][0])
+
+def getjobs(my, cetable, mark=None):
     '''
+    Get jobs from CE
 
-    # What's this CE's CREAM URL?
-    my.query('SELECT creamURL FROM %s GROUP BY creamURL' % cetable)
+    Expects:
+    - a MySQLdb.connections.Connection instance to the CE DB
+    - the job table name on the CE DB
+    - optionally the (id, timestamp) tuple of the last job harvested, to
+      only get newer ones
 
-    # We're assuming the CREAM URL is CE-unique
-    r = my.use_result()
-    creamurl = None
-    while True:
-        row = r.fetch_row() 
-        if len(row) > 0:
-            if creamurl is None:
-                ((creamurl,),) = row
-            else:
-                # Our assumption is wrong. Need to rethink the algorithm.
-                msg = 'More than one distinct CREAM URL in this CE'
-                raise common.AcctDBError(msg)
-        else:
-            # This row is an empty tuple -- We're done.
-            break
+    Returns a MySQLdb.result to be repeatedly read with fetch_row(), rows
+    being streamed from the server in id order
 
-    # What's the last job, i.e. the job with the maximum id for this ceId?
-    stmt = 'SELECT MAX(id) FROM %s WHERE creamURL = :creamurl'
-    oracursor = ora.cursor()
-    oracursor.execute(stmt % common.CETAB, [creamurl])
-    maxid, = oracursor.fetchone()
+    This function would normally no longer be used since one is supposed to
+    directly read from the BLAH file, not from the CE DB.
+    '''
 
     # Get resulting (row by row) jobs
     cols = filter(lambda c: c.dftval is None, common.CETAB)
-    select = 'SELECT %s' % ', '.join([c.col for c in cols])
+    select = 'SELECT id, %s' % ', '.join([c.col for c in cols])
     where = "WHERE lrmsAbsLayerJobId != 'N/A'"
     idcond = ''
-    #if maxid is not None:
-    #    idcond = "AND id > '%s'" % maxid
-    my.query("%s FROM %s %s %s" % (select, cetable, where, idcond))
+    if mark is not None:
+        idcond = "AND id > %d" % mark[0]
+    my.query("%s FROM %s %s %s ORDER BY id" % (select, cetable, where, idcond))
     r = my.use_result()
 
     return r
 
-def putjobs(ora, jobs):
+def fetchjobs(jobs, deadline=None):
+    '''
+    Yield jobs as dictionaries from a MySQLdb.result as returned by
+    getjobs(), raising CEDBError if it's past the deadline (in seconds since
+    the epoch), if any.
+    '''
+    while True:
+        rows = jobs.fetch_row(FETCHSIZE, 1)
+        if len(rows) == 0:
+            # This is an empty tuple -- We're done.
+            break
+        for r in rows:
+            yield r
+        if deadline is not None and time.time() > deadline:
+            raise common.CEDBError("Timed out")
+
+def putjobs(pipeline, jobs, deadline=None, watermarks=None, host=None,
+            hold=None):
     '''
     Add jobs to accounting DB
 
     Expects:
-    - a cx_Oracle.Connection instance to the accounting DB
+    - a common.Pipeline instance writing to the accounting DB
     - a MySQLdb.result as returned by getjobs()
+    - optionally a deadline in seconds since the epoch
+    - optionally a Watermarks instance to save the last job committed to
+    - optionally the CE host name to save the last job committed for
+    - optionally the id of a job the watermark mustn't get to, as returned
+      by pending()
 
-    Doesn't return anything
+    Returns the number of jobs read
     '''
-    import cx_Oracle
+    count = [0] # Can't rebind from a nested function
+    last = [None]
+
+    def counted():
+        for r in fetchjobs(jobs, deadline):
+            count[0] += 1
+            if hold is None or int(r['id']) < hold:
+                last[0] = r
+            yield r
+
+    def snapshot():
+        r = last[0]
+        if watermarks is None or r is None:
+            return None
+        jobid, timestamp = int(r['id']), int(r['timestamp'])
+        def save():
+            try:
+                watermarks.save(host, jobid, timestamp)
+            except (IOError, OSError), e:
+                pipeline.logger.error("Couldn't save watermark: %s" % e)
+        return save
 
-    # Get cursor
-    cursor = ora.cursor()
+    pipeline.put(counted(), snapshot)
+    return count[0]
 
-    # Evaluate record for each field
-    while True:
-        r = jobs.fetch_row(how=1)
-        if len(r) > 0:
-            r, = r
-            # Evaluate against actual value to see what we're up against
-            for c in common.CETAB:
-                c.eval(r)
-
-            # Lay out statement
-            fmt = 'INSERT INTO %s VALUES (%s)'
-            tab = common.CETAB
-            stmt = fmt % (tab, ', '.join([c.param for c in common.CETAB]))
-
-            # Execute statement
-            l = filter(lambda v: v is not None, [c.val for c in common.CETAB])
+class Harvester(threading.Thread):
+    '''
+    Thread harvesting CEs one after the other, sharing a queue of CE host
+    names with other harvesters and a pipeline to the accounting DB.
+    '''
+
+    def __init__(self, logger, pipeline, hosts, cefile, cetable,
+                 timeout=HOSTTIMEOUT, watermarks=None, resync=False):
+        '''
+        Expects a logger, a common.Pipeline instance, a Queue.Queue of host
+        names, the CE DB connection file path, the job table name on CE DBs,
+        optionally how many seconds a CE may take to be harvested,
+        optionally a Watermarks instance and optionally whether to harvest
+        all the jobs, whatever the watermarks.
+        '''
+        threading.Thread.__init__(self)
+        self.setDaemon(True) # Don't wait for CEs which hang past timeout
+        self.logger = logger
+        self.pipeline = pipeline
+        self.watermarks = watermarks
+        self.resync = resync
+        self.hosts = hosts
+        self.cefile = cefile
+        self.cetable = cetable
+        self.timeout = timeout
+        self.summary = [] # (host, seconds, jobs, status) tuples
+
+    def run(self):
+        import MySQLdb
+
+        while True:
             try:
-                cursor.execute(stmt, l)
-                # FIXME: distinguish interesting errors from uniqueness error
-            except cx_Oracle.DatabaseError, e:
-                pass
-                #logging.error(str(e)[:-1])
-                #for c in common.CETAB:
-                #    print "%s %s '%s'" % (c.col, c.type, str(c.val)[:60])
-                #print
-            else:
-                pass
-                #i += 1
+                h = self.hosts.get_nowait()
+            except Queue.Empty:
+                break
+
+            start = time.time()
+            count = 0
+            ce = None
+            try:
+                try:
+                    self.logger.info("Connecting to %s..." % h)
+                    ce = common.myconnect(self.logger, self.cefile, h,
+                                          self.timeout)
+                    mark = None
+                    if self.watermarks is not None and not self.resync:
+                        mark = self.watermarks.get(h)
+                    if mark is not None and cycled(ce, self.cetable, mark):
+                        msg = "%s: job ids have cycled, harvesting all jobs"
+                        self.logger.warning(msg % h)
+                        mark = None
+                    hold = None
+                    if self.watermarks is not None:
+                        hold = pending(ce, self.cetable, mark)
+                    self.logger.info("Getting jobs from %s..." % h)
+                    jobs = getjobs(ce, self.cetable, mark)
+                    count = putjobs(self.pipeline, jobs,
+                                    start + self.timeout, self.watermarks, h,
+                                    hold)
+                    status = 'ok'
+                except (common.CEDBError, common.AcctDBError,
+                        MySQLdb.Error), e:
+                    msg = "%s: %s, but let's forget about it for now"
+                    self.logger.warning(msg % (h, e))
+                    status = str(e)
+            finally:
+                if ce is not None:
+                    try:
+                        ce.close()
+                    except MySQLdb.Error:
+                        pass
+            self.summary.append((h, time.time() - start, count, status))
+
+def harvest(logger, pipeline, hosts, cefile, cetable, harvesters=HARVESTERS,
+            timeout=HOSTTIMEOUT, watermarks=None, resync=False):
+    '''
+    Harvest CEs with several threads at a time and log how long each took
+    and how many jobs they had.
+
+    Expects a logger, a common.Pipeline instance, an iterable of CE host
+    names, the CE DB connection file path, the job table name on CE DBs,
+    optionally the number of harvester threads, optionally how many seconds
+    a CE may take to be harvested, optionally a Watermarks instance to only
+    harvest new jobs and optionally whether to harvest all the jobs
+    nonetheless.
+
+    Returns the number of CEs which couldn't be harvested.
+    '''
+    queue = Queue.Queue()
+    hosts = list(hosts)
+    for h in hosts:
+        queue.put(h)
+
+    start = time.time()
+    threads = [Harvester(logger, pipeline, queue, cefile, cetable, timeout,
+                         watermarks, resync)
+               for _ in range(min(harvesters, len(hosts)))]
+    for t in threads:
+        t.start()
+
+    # Don't wait forever for threads stuck with CEs which don't respond
+    deadline = start + timeout * (len(hosts) / max(len(threads), 1) + 1)
+    for t in threads:
+        t.join(max(deadline - time.time(), 0))
+    pipeline.join()
+
+    # Summarise
+    summary = {}
+    for t in threads:
+        for h, elapsed, count, status in t.summary:
+            summary[h] = elapsed, count, status
+    failc = 0
+    for h in hosts:
+        if h in summary:
+            elapsed, count, status = summary[h]
         else:
-            # This row is an empty tuple -- We're done.
-            break
-    ora.commit()
+            elapsed, count, status = timeout, 0, 'Timed out'
+        if status != 'ok':
+            failc += 1
+        logger.info("%s: %d jobs in %.1f s (%s)" % (h, count, elapsed, status))
+    fmt = "Harvested %d CEs (%d failed) in %.1f s"
+    logger.info(fmt % (len(hosts), failc, time.time() - start))
+    return failc
 
 def main():
     # Read arguments
@@ -260,6 +595,43 @@ each CE's DB)"""
            common.HBDELTA
     p.add_option("-b", "--heartbeatdelta", type='int',
                  help=help, default=common.HBDELTA)
+    help = "insert records in array-bound blocks of BATCHSIZE rows"
+    p.add_option("--batchsize", type='int', help=help)
+    help = "checkpoint file absolute path (defaults to %s)" % CKPTFILE
+    p.add_option("-k", "--checkpoint", help=help, default=CKPTFILE)
+    help = "number of DB writer threads, each with its own connection "
+    help += "(defaults to 0, i.e. records are written as they are read)"
+    p.add_option("--writers", type='int', help=help, default=0)
+    help = "how many blocks of records may wait to be written when there are "
+    help += "writer threads (defaults to %d)" % common.QUEUESIZE
+    p.add_option("--queuesize", type='int', help=help,
+                 default=common.QUEUESIZE)
+    help = "how many milliseconds modification events may wait to be "
+    help += "dealt with together (defaults to %d)" % common.LATENCY
+    p.add_option("--latency", type='int', help=help, default=common.LATENCY)
+    help = "how many modification events may be dealt with together "
+    help += "(defaults to %d)" % common.MAXEVENTS
+    p.add_option("--maxevents", type='int', help=help,
+                 default=common.MAXEVENTS)
+    help = "spool file absolute path where to keep the records which can't "
+    help += "be written while the DB is unreachable, in which case "
+    help += "connections are also established again (defaults to none)"
+    p.add_option("--spool", help=help)
+    help = "how many megabytes may be spooled at most (defaults to %d)" % \
+           common.SPOOLSIZE
+    p.add_option("--spoolsize", type='int', help=help,
+                 default=common.SPOOLSIZE)
+    help = "how many CEs to harvest at a time when running centrally "
+    help += "(defaults to %d)" % HARVESTERS
+    p.add_option("--harvesters", type='int', help=help, default=HARVESTERS)
+    help = "how many seconds a CE may take to be harvested when running "
+    help += "centrally (defaults to %d)" % HOSTTIMEOUT
+    p.add_option("--hosttimeout", type='int', help=help, default=HOSTTIMEOUT)
+    help = "file absolute path where to keep the last job harvested from "
+    help += "each CE when running centrally (defaults to %s)" % STATEFILE
+    p.add_option("--statefile", help=help, default=STATEFILE)
+    help = "harvest all the jobs of each CE, not only the new ones"
+    p.add_option("--resync", action='store_true', help=help)
     options, args = p.parse_args()
 
     # Set up logging
@@ -270,9 +642,9 @@ each CE's DB)"""
     logger.addHandler(h)
     logger.setLevel(logging.INFO)
 
-    # Get new jobs
+    # Make sure the accounting DB can be reached
     logger.info("Connecting to accounting DB...")
-    acct = common.connect(logger, options.connfile)
+    common.connect(logger, options.connfile).close()
 
     if options.acctdir is None:
         logger.info("Connecting to configuration manager DB...")
@@ -285,18 +657,25 @@ each CE's DB)"""
         if options.name:
             common.CETAB.name = options.name
 
-        for h in hosts:
-            try:
-                logger.info("Connecting to %s..." % h)
-                ce = common.myconnect(logger, options.cefile, host=h)
-                logger.info("Getting jobs from %s..." % h)
-                jobs = getjobs(acct, ce, options.cetable)
-                logger.info("Sending new jobs from %s to accounting DB..." % h)
-                putjobs(acct, jobs)
-                logger.info("Done.")
-            except common.CEDBError, e:
-                msg = "%s: %s, but let's forget about it for now"
-                logger.warning(msg % (h, e))
+        # Share batched DB writers between harvesters
+        writers = max(options.writers, 1)
+        logger.info("Starting %d DB writers" % writers)
+        connections = [common.connect(logger, options.connfile, True)
+                       for _ in range(writers)]
+        pipeline = common.Pipeline(logger, common.CETAB, connections,
+                                   options.batchsize or common.BATCHSIZE,
+                                   options.queuesize, options.heartbeatdelta)
+
+        watermarks = Watermarks(options.statefile)
+        try:
+            watermarks.load()
+        except common.AcctError, e:
+            logger.error(e)
+            return 1
+
+        harvest(logger, pipeline, hosts, options.cefile, options.cetable,
+                options.harvesters, options.hosttimeout, watermarks,
+                options.resync)
     else:
         # Daemonise
         try:
@@ -307,23 +686,52 @@ each CE's DB)"""
 
         try:
             # Set up accounting DB connection
-            connection = common.connect(logger, options.connfile)
+            if options.spool:
+                spool = common.Spool(logger, options.spool, options.spoolsize)
+                connection = common.DBLink(logger, options.connfile, spool)
+            else:
+                connection = common.connect(logger, options.connfile)
+
+            # Set up DB writer threads
+            if options.writers == 0:
+                pipeline = None
+            else:
+                logger.info("Starting %d DB writers" % options.writers)
+                if options.spool:
+                    connections = [common.DBLink(logger, options.connfile,
+                                                 spool, True)
+                                   for _ in range(options.writers)]
+                else:
+                    connections = \
+                        [common.connect(logger, options.connfile, True)
+                         for _ in range(options.writers)]
+                batchsize = options.batchsize or common.BATCHSIZE
+                pipeline = common.Pipeline(logger, common.CETAB, connections,
+                                           batchsize, options.queuesize,
+                                           options.heartbeatdelta)
 
             # Set up pyinotify
             logger.info("Will be watching %s" % options.acctdir)
             wm = pyinotify.WatchManager()
+            checkpoint = common.Checkpoint(options.checkpoint)
             handler = EventHandler(logger, options.acctdir, connection,
-                                   options.heartbeatdelta)
+                                   options.heartbeatdelta, options.batchsize,
+                                   checkpoint, pipeline)
             notifier = pyinotify.Notifier(wm, handler)
 
             # BLAH accounting files don't seem to be subject to logrotation:
             # new files with a new name are simply created. Therefore, we're
             # only interested in file changes (i.e. files being appended
-            # new records) and file creation -- not file moves.
-            wm.add_watch(options.acctdir, IN_MODIFY)
+            # new records) and file creation (or files moved in, which
+            # amounts to the same) -- not files moved out.
+            wm.add_watch(options.acctdir, IN_MODIFY | IN_CREATE | IN_MOVED_TO)
+
+            # Catch up with what's been written while we weren't watching
+            handler.resume()
 
             # Loop and dispatch events forever
-            notifier.loop()
+            common.loop(notifier, handler, options.latency,
+                        options.maxevents)
         except common.AcctError, e:
             logger.error(e)
             return 1
@@ -41,6 +41,7 @@ rm -rf $RPM_BUILD_ROOT
 %config(noreplace) %{_sysconfdir}/batchacct
 %config(noreplace) %{_localstatedir}/log/batchacct
 %config(noreplace) %{_localstatedir}/run/batchacct
+%config(noreplace) %{_localstatedir}/lib/batchacct
 %config(noreplace) %{_sysconfdir}/logrotate.d/batchacct
 %doc
 
@@ -5,6 +5,10 @@ import sys
 import re
 import time
 import logging
+import threading
+import Queue
+import struct
+import cPickle
 from datetime import datetime, timedelta, date
 import cx_Oracle
 
@@ -17,6 +21,16 @@ HOLDERRE = re.compile('.*Holder Subject\s*:(?P<holder>[^\\n]*)\n.*', re.S)
 LOGGER = 'batchacct'
 HBDELTA = 180
 LOGBUNCH = 10000
+LATENCY = 500 # Milliseconds modification events may wait to be coalesced
+MAXEVENTS = 1000 # Modification events coalesced at most
+BATCHSIZE = 1000 # Rows per array-bound INSERT, unless told otherwise
+QUEUESIZE = 16 # Blocks of rows waiting to be written at most
+SPOOLSIZE = 1024 # Megabytes spooled at most while the DB is unreachable
+MINBACKOFF = 1 # Seconds before trying to reconnect to the DB the first time
+MAXBACKOFF = 600 # Seconds before trying to reconnect to the DB at most
+# ORA-nnnnn error codes meaning the connection to the DB is lost
+LOSTCODES = (28, 1012, 1033, 1034, 1089, 3113, 3114, 3135, 12152, 12153,
+             12157, 12170, 12514, 12528, 12537, 12541, 12543, 12560, 12571)
 ORAIDLIM = 31 # Max characters for Oracle identifier
 LOGDATEFMT = '%Y-%m-%d %H:%M:%S'
 
@@ -50,6 +64,7 @@ class DBTab:
         self.cols = cols
         self.pk = pk
         self.idxs = idxs
+        self.encoders = {}
         DBCol.pos = 1
 
     #def __iter__(self):
@@ -57,7 +72,7 @@ class DBTab:
 
     # Useful for debugging with print
     def __repr__(self):
-        return str([c.val for c in self.cols])
+        return str([c.col for c in self.cols])
 
     def __str__(self):
         return self.name
@@ -81,6 +96,17 @@ class DBTab:
     def __len__(self):
         return len(self.cols)
 
+    def encoder(self, slice=None):
+        '''
+        Return the DBEncoder for this table, optionally for a DB column slice
+        (useful for debugging). It's compiled the first time it's asked for
+        and cached afterwards -- unless the table has been renamed since.
+        '''
+        key = (self.name, slice)
+        if key not in self.encoders:
+            self.encoders[key] = DBEncoder(self, slice)
+        return self.encoders[key]
+
 class DBCol:
     '''
     Defines a mapping between a PyLSF event record and a database column.
@@ -138,46 +164,66 @@ class DBCol:
             return self._src
     src = property(src)
 
-    #@getter # If we ran Python 2.6
-    def param(self):
-        '''
-        Parameter (e.g. :arg_42) or the string 'NULL' if the value is NULL.
-        '''
-        type, len, nullable = parsetype(self.type)
-        if self.val is not None:
-            return ":arg_%d" % self.pos
-        else:
-            return 'NULL'
-    param = property(param)
+class DBEncoder:
+    '''
+    Turns event records into bind value tuples for a given DBTab.
+
+    Everything which only depends on the table template (column types and
+    lengths, source field names, post-processing functions, default values,
+    INSERT statement and bind input sizes) is worked out once and for all
+    upon instantiation, so that encoding a record is a single pass over
+    precomputed column layouts. DBCol instances are left untouched, which
+    makes encoders safe to share between threads.
+    '''
 
-    def eval(self, rec):
+    def __init__(self, tab, slice=None):
         '''
-        Compute value associated with this DBCol from an event record and
-        set operator (= or IS) approriately.
+        Compile encoder.
 
-        Expects a whole event record list. (I.e. with all the values, even
-        those having nothing to do with this DBCol. It's this function's
-        job to sort it all out.)
+        Expects a DBTab instance and optionally a DB column slice.
         '''
-        # Get type and attributes
-        type, len, nullable = parsetype(self.type)
+        self.cols = tab[:slice]
+
+        # Fixed bind parameter layout: NULLs are bound as None
+        fmt = 'INSERT INTO %s VALUES (%s)'
+        self.stmt = fmt % (tab, ', '.join([':arg_%d' % c.pos
+                                           for c in self.cols]))
+        self.sizes = inputsizes(self.cols)
+
+        self.layout = []
+        for c in self.cols:
+            type, len, nullable = parsetype(c.type)
+            if type.upper() != 'VARCHAR2':
+                len = None
+            self.layout.append((c.src, c.dftval, c.fn, len))
+
+    def encode(self, rec):
+        '''
+        Compute values associated with each column from an event record.
 
-        # Decide what to do with the raw value
-        if self.dftval is None: # Inline if-else doesn't work on Python 2.4
-            self.val = rec[self.src]
-        else:
-            self.val = self.dftval
-
-        self.op = '='
-        if self.fn:
-            self.val = self.fn(self.val)
-        if type.upper() == 'VARCHAR2' and len is not None:
-            self.val = self.val[:len]
-        if self.val == '':
-            # Empty string are regarded as NULL on Oracle. Misleading,
-            # yes, but there you go.
-            self.val = None 
-            self.op = 'IS'
+        Expects a whole event record (i.e. with all the values, even
+        those having nothing to do with the table) and returns a tuple of
+        values in bind parameter order. Raises KeyError if a field is
+        missing from the record.
+        '''
+        row = []
+        for src, dftval, fn, len in self.layout:
+            # Decide what to do with the raw value
+            if dftval is None: # Inline if-else doesn't work on Python 2.4
+                val = rec[src]
+            else:
+                val = dftval
+
+            if fn:
+                val = fn(val)
+            if len is not None:
+                val = val[:len]
+            if val == '':
+                # Empty string are regarded as NULL on Oracle. Misleading,
+                # yes, but there you go.
+                val = None
+            row.append(val)
+        return tuple(row)
 
 class DaemonError(Exception):
     pass
@@ -213,6 +259,74 @@ class AcctDBError(AcctError):
     def __str__(self):
         return "Accounting database error: %s" % self.args
 
+class Checkpoint:
+    '''
+    On-disk read position of a collector: the identity (device, inode and
+    name) of the file being read, the offset reached in it and the time of
+    the last event record read. It's only meant to be saved once what it
+    refers to has been committed, so that a collector restarting from it
+    neither misses out nor replays records.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.dev = None
+        self.ino = None
+        self.name = None
+        self.offset = 0
+        self.eventtime = 0
+
+    def load(self):
+        '''
+        Read checkpoint file. Returns True if there was a checkpoint to
+        read, False otherwise.
+        '''
+        try:
+            f = open(self.path)
+            l = f.readline()
+            f.close()
+        except IOError:
+            return False
+
+        try:
+            dev, ino, offset, eventtime, name = l[:-1].split(None, 4)
+            self.dev, self.ino = int(dev), int(ino)
+            self.offset = int(offset)
+            self.eventtime = float(eventtime)
+            self.name = name
+        except ValueError:
+            raise AcctError("Corrupted checkpoint file: %s" % self.path)
+        return True
+
+    def save(self, name, st, offset, eventtime):
+        '''
+        Atomically write checkpoint file.
+
+        Expects the file name, its os.stat() result, the offset reached
+        in it and the time of the last event record read.
+        '''
+        self.dev, self.ino = st.st_dev, st.st_ino
+        self.name = name
+        self.offset = offset
+        if eventtime is not None:
+            self.eventtime = eventtime
+
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        f.write('%d %d %d %f %s\n' % (self.dev, self.ino, self.offset,
+                                       self.eventtime, self.name))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, self.path)
+
+    def matches(self, st):
+        '''
+        Tell whether the os.stat() result passed as argument is that of the
+        checkpointed file.
+        '''
+        return (self.dev, self.ino) == (st.st_dev, st.st_ino)
+
 def ftab(lines, header):
     '''
     Format tables
@@ -459,7 +573,55 @@ CETAB = DBTab('ce',
     idxs=[['lrmsId']]
 )
 
-TABS = dict([(LOCALTAB.name, LOCALTAB), (CETAB.name, CETAB)])
+# Publication runs, for join.py to know which eventTime window is new
+# when publishing incrementally.
+PUBTAB = DBTab('pub',
+    (
+     # When the run took place
+     DBCol('published', 'DATE NOT NULL'),
+     # Last eventTime published during the run
+     DBCol('watermark', 'DATE NOT NULL'),
+     DBCol('events', 'NUMBER NOT NULL'),
+    ),
+    pk=['published'],
+)
+
+# Hourly aggregates of the local table, for cpuhours.py not to scan it
+# all over again. Waiting and wall times are in days (as Oracle date
+# differences are), CPU times in seconds. The h-prefixed sums are weighted
+# with hostFactor, for normalised plots.
+ROLLUPTAB = DBTab('lochourly',
+    (
+     DBCol('hour', 'DATE NOT NULL'),
+     DBCol('queue', 'VARCHAR2(255) NOT NULL'),
+     DBCol('chargedSAAP', 'VARCHAR2(255)'),
+     DBCol('userName', 'VARCHAR2(255) NOT NULL'),
+     DBCol('fromHost', 'VARCHAR2(255)'),
+     DBCol('jobs', 'NUMBER NOT NULL'),
+     DBCol('cpu', 'NUMBER NOT NULL'),
+     DBCol('wall', 'NUMBER NOT NULL'),
+     DBCol('wait', 'NUMBER NOT NULL'),
+     DBCol('hcpu', 'NUMBER NOT NULL'),
+     DBCol('hwall', 'NUMBER NOT NULL'),
+     DBCol('hwait', 'NUMBER NOT NULL'),
+    ),
+    idxs=[['hour', 'queue'],
+          ['queue', 'hour'],
+         ]
+)
+
+# Rollup refreshes: every hour before covered has been aggregated.
+ROLLSTATETAB = DBTab('rollup',
+    (
+     DBCol('refreshed', 'DATE NOT NULL'),
+     DBCol('covered', 'DATE NOT NULL'),
+    ),
+    pk=['refreshed'],
+)
+
+TABS = dict([(LOCALTAB.name, LOCALTAB), (CETAB.name, CETAB),
+             (PUBTAB.name, PUBTAB), (ROLLUPTAB.name, ROLLUPTAB),
+             (ROLLSTATETAB.name, ROLLSTATETAB)])
 
 def daemonise(logger, pidfile):
     # http://www.jejik.com/articles/2007/02/a_simple_unix_linux_daemon_in_python
@@ -506,53 +668,435 @@ def daemonise(logger, pidfile):
         logger.error("Couldn't write PID file: %s" % e)
         raise DaemonError()
 
+def dberror(logger, e, errorc):
+    '''
+    Log a DB error raised (or batch-reported) for a single record.
+
+    Expects a logger, a cx_Oracle error object (i.e. with a code attribute,
+    as found in DatabaseError arguments or batch errors) and the current
+    integer number of errors. Duplicates (ORA-00001) are only reported once
+    every LOGBUNCH times. Returns the updated number of errors.
+    '''
+    if e.code == 1: # ORA-00001: unique constraint
+        if errorc % LOGBUNCH == 0:
+            logger.warning(INSERTERR % str(e).rstrip())
+            fmt = "Next %d duplicates won't be reported"
+            logger.warning(fmt % LOGBUNCH)
+            errorc = 0
+    else:
+        # I don't know what to make of that: just log but don't
+        # reraise because I don't expect anyone to catch this and I
+        # don't want the script to stop.
+        logger.error(INSERTERR % str(e).rstrip())
+    return errorc + 1
+
+def inputsizes(cols):
+    '''
+    Return the list of cx_Oracle input sizes matching a DBCol sequence, so
+    that array binds don't need guessing types from the first row (which
+    may well be NULL).
+    '''
+    sizes = []
+    for c in cols:
+        type, len, nullable = parsetype(c.type)
+        if type.upper() == 'DATE':
+            sizes.append(cx_Oracle.DATETIME)
+        elif type.upper() == 'NUMBER':
+            sizes.append(cx_Oracle.NUMBER)
+        elif len is not None:
+            sizes.append(len)
+        else:
+            sizes.append(None)
+    return sizes
+
+def lost(e):
+    '''
+    Tell whether the cx_Oracle exception passed as argument means the
+    connection to the DB has been lost.
+    '''
+    if isinstance(e, cx_Oracle.InterfaceError):
+        return True # E.g. not connected
+    error, = e.args
+    return getattr(error, 'code', None) in LOSTCODES
+
+def insertmany(logger, cursor, stmt, rows, insertc, errorc, reraise=False):
+    '''
+    Send a block of rows with a single array-bound INSERT statement.
+
+    Expects a logger, a cursor whose input sizes have been set, a fully
+    parameterised INSERT statement, a list of bind value lists, an integer
+    number of successful insertions, an integer number of errors and
+    optionally whether to reraise the errors failing the whole block (e.g.
+    the DB connection being lost) rather than counting its rows as errors.
+    Rows failing (e.g. duplicates) are reported through batch errors
+    without aborting the rest of the block.
+
+    Returns the number of successful inserts, the number of errors and
+    whether the block went through, some of its rows having possibly been
+    rejected.
+    '''
+    try:
+        cursor.executemany(stmt, rows, batcherrors=True)
+    except cx_Oracle.DatabaseError, e:
+        if reraise:
+            raise
+        # The whole block went wrong, not just some rows
+        logger.error(INSERTERR % str(e)[:-1])
+        return insertc, errorc + len(rows), False
+
+    errors = cursor.getbatcherrors()
+    for error in errors:
+        errorc = dberror(logger, error, errorc)
+    return insertc + len(rows) - len(errors), errorc, True
+
+def commit(logger, connection, commitfn=None):
+    '''
+    Commit and, if it went well, call the function passed as optional third
+    argument. Returns whether it went well.
+    '''
+    try:
+        connection.commit()
+    except Exception, e:
+        logger.error(COMMITERR % e)
+        return False
+    else:
+        if commitfn is not None:
+            commitfn()
+        return True
+
+class Spool:
+    '''
+    Append-only file of blocks of encoded rows which couldn't be written to
+    the DB, each block being pickled and prefixed with its length. Blocks
+    are read back in the order they were spooled, once the DB is reachable
+    again. Spools are safe to share between threads.
+    '''
+
+    def __init__(self, logger, path, maxsize=SPOOLSIZE):
+        '''
+        Open spool.
+
+        Expects a logger, the spool file path and optionally the maximum
+        spool file size in megabytes. Whatever a previous run left in the
+        spool file is kept.
+        '''
+        self.logger = logger
+        self.path = path
+        self.maxsize = maxsize * 1024 * 1024
+        self.lock = threading.Lock()
+
+        self.depth = 0 # Spooled rows
+        self.size = 0
+        for rows in self.blocks():
+            self.depth += len(rows)
+        if os.path.exists(path) and os.path.getsize(path) > self.size:
+            # Don't append after a truncated block
+            logger.warning("Truncating spool %s" % path)
+            f = open(path, 'r+b')
+            f.truncate(self.size)
+            f.close()
+        if self.depth > 0:
+            logger.info("%d records left in spool %s" % (self.depth, path))
+
+    def blocks(self):
+        '''
+        Yield spooled blocks of rows, oldest first, setting the spool size
+        to what has been read. A truncated last block (e.g. if we crashed
+        while spooling it) is ignored.
+        '''
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+
+        self.size = 0
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                break
+            n, = struct.unpack('!I', head)
+            data = f.read(n)
+            if len(data) < n:
+                break
+            self.size += 4 + n
+            yield cPickle.loads(data)
+        f.close()
+
+    def append(self, rows):
+        '''
+        Spool a block of rows, unless the spool is full in which case
+        they're dropped. Returns whether they've been spooled.
+        '''
+        data = cPickle.dumps(rows, 2)
+
+        self.lock.acquire()
+        try:
+            if self.size + 4 + len(data) > self.maxsize:
+                fmt = "Spool full, dropping %d records"
+                self.logger.error(fmt % len(rows))
+                return False
+
+            f = open(self.path, 'ab')
+            f.write(struct.pack('!I', len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+            self.size += 4 + len(data)
+            self.depth += len(rows)
+            return True
+        finally:
+            self.lock.release()
+
+    def drain(self, send):
+        '''
+        Call the function passed as argument with each spooled block of
+        rows, oldest first, and empty the spool if none of the calls raised
+        anything. Otherwise the spool is left as is and will be drained again
+        from the start: blocks already sent will then be duplicates.
+        '''
+        self.lock.acquire()
+        try:
+            if self.depth == 0:
+                return
+            self.logger.info("Draining %d spooled records" % self.depth)
+            for rows in self.blocks():
+                send(rows)
+            open(self.path, 'wb').close()
+            self.depth = 0
+            self.size = 0
+        finally:
+            self.lock.release()
+
+class DBLink:
+    '''
+    DB connection which gets established again when it's lost, trying with
+    an exponential backoff between attempts. Meanwhile, the rows which
+    can't be written are spooled, if there's a spool, and they're drained
+    in bulk as soon as the connection is back.
+    '''
+
+    def __init__(self, logger, connfile, spool=None, threaded=False):
+        '''
+        Connect, or at least try to.
+
+        Expects a logger, a user/passwd@dsn-formatted connection file path,
+        optionally a Spool instance and optionally whether the connection
+        is to be used in a multithreaded process.
+        '''
+        self.logger = logger
+        self.connfile = connfile
+        self.spool = spool
+        self.threaded = threaded
+
+        self.connection = None
+        self.cursors = {} # Cursors with input sizes set, per statement
+        self.backoff = MINBACKOFF
+        self.retry = 0 # When to try to reconnect next
+        self.get()
+
+    def get(self):
+        '''
+        Return DB connection, trying to reconnect if it's been lost and if
+        it's time to. Returns None if there's no connection.
+        '''
+        if self.connection is None and time.time() >= self.retry:
+            try:
+                self.connection = connect(self.logger, self.connfile,
+                                          self.threaded)
+                self.backoff = MINBACKOFF
+            except AcctDBError:
+                self.retry = time.time() + self.backoff
+                fmt = "Will try to reconnect to DB in %d s"
+                self.logger.warning(fmt % self.backoff)
+                self.backoff = min(self.backoff * 2, MAXBACKOFF)
+        return self.connection
+
+    def lose(self, e):
+        '''
+        Drop the DB connection after the error passed as argument.
+        '''
+        self.logger.error("Lost DB connection: %s" % e)
+        try:
+            self.connection.close()
+        except (cx_Oracle.DatabaseError, cx_Oracle.InterfaceError):
+            pass
+        self.connection = None
+        self.cursors = {}
+
+    def cursor(self, encoder):
+        '''
+        Return a cursor ready to send rows encoded with the DBEncoder passed
+        as argument.
+        '''
+        if encoder.stmt not in self.cursors:
+            cursor = self.connection.cursor()
+            cursor.setinputsizes(*encoder.sizes)
+            self.cursors[encoder.stmt] = cursor
+        return self.cursors[encoder.stmt]
+
+    def rollback(self):
+        '''
+        Roll back whatever hasn't been committed, after an error which didn't
+        lose the DB connection. Returns whether the connection is still there.
+        '''
+        if self.connection is None:
+            return False
+        try:
+            self.connection.rollback()
+        except (cx_Oracle.DatabaseError, cx_Oracle.InterfaceError), e:
+            self.lose(e)
+            return False
+        return True
+
+    def send(self, encoder, rows, insertc, errorc):
+        '''
+        Send and commit a block of rows, after whatever has been spooled so
+        far. The rows are spooled if they can't be written, whether the DB
+        can't be reached or the block or its commit failed, and counted as
+        errors if they can't be spooled either. A spooled block which fails
+        again when drained is counted as errors and dropped, for it not to
+        hold back the rest of the spool. Drained event records being late,
+        the rollup table is rewound to the oldest of them.
+
+        Expects a DBEncoder instance, the list of rows it encoded, an
+        integer number of successful insertions and an integer number of
+        errors. Returns the number of successful inserts, the number of
+        errors and whether the rows have been committed or spooled.
+        '''
+        if self.get() is not None:
+            counts = [insertc, errorc] # Can't rebind from a nested function
+            oldest = [None] # eventTime drained, for the rollup to be rewound
+            names = [c.col for c in encoder.cols]
+            def send(rows):
+                counts[0], counts[1], _ = \
+                    insertmany(self.logger, self.cursor(encoder), encoder.stmt,
+                               rows, counts[0], counts[1], True)
+                self.connection.commit()
+
+            def drained(rows):
+                try:
+                    send(rows)
+                except cx_Oracle.DatabaseError, e:
+                    if lost(e) or not self.rollback():
+                        raise e
+                    self.logger.error(INSERTERR % str(e).rstrip())
+                    counts[1] += len(rows)
+                    return
+                if 'eventTime' in names:
+                    i = names.index('eventTime')
+                    t = min([row[i] for row in rows])
+                    if oldest[0] is None or t < oldest[0]:
+                        oldest[0] = t
+
+            try:
+                if self.spool is not None:
+                    self.spool.drain(drained)
+                    if oldest[0] is not None:
+                        rewind(self.connection.cursor(), oldest[0])
+                        self.connection.commit()
+                send(rows)
+                return counts[0], counts[1], True
+            except (cx_Oracle.DatabaseError, cx_Oracle.InterfaceError), e:
+                if lost(e):
+                    self.lose(e)
+                else:
+                    self.logger.error(INSERTERR % str(e).rstrip())
+                    self.rollback()
+                # Drained blocks are counted again when they are sent again
+
+        if self.spool is None or not self.spool.append(rows):
+            self.logger.error(INSERTERR % "block neither written nor spooled")
+            return insertc, errorc + len(rows), False
+        return insertc, errorc, True
+
+def sendblock(logger, connection, cursor, encoder, rows, insertc, errorc,
+              commitfn=None):
+    '''
+    Send and commit a block of rows, either through a DBLink, in which case
+    the rows may end up spooled, or through a plain connection.
+
+    Expects a logger, a DBLink instance or an opened DB connection, a
+    cursor with its input sizes set (if it's a plain connection), the
+    DBEncoder instance which encoded the rows, the list of rows, an integer
+    number of successful insertions, an integer number of errors and
+    optionally a function to call without arguments once the rows have been
+    committed (or spooled). It isn't called if they haven't.
+
+    Returns the number of successful inserts, the number of errors and
+    whether the rows have been committed (or spooled).
+    '''
+    if isinstance(connection, DBLink):
+        insertc, errorc, ok = connection.send(encoder, rows, insertc, errorc)
+        if ok and commitfn is not None:
+            commitfn()
+    else:
+        insertc, errorc, ok = insertmany(logger, cursor, encoder.stmt, rows,
+                                         insertc, errorc)
+        if ok:
+            ok = commit(logger, connection, commitfn)
+    return insertc, errorc, ok
+
 def insert(logger, tab, recs, connection, insertc, errorc, 
            heartbeat=datetime.today(), heartbeatdelta=HBDELTA, 
-           slice=None):
+           slice=None, batchsize=None, commitfn=None):
     '''
     Insert new rows into database.
     
     Expects a logger, a table template, an iterable lsb_geteventrec instance,
-    an opened Oracle DB connection, an integer number of successful insertions,
-    an integer number of errors, optionally a last heartbeat time, optionally
-    a heartbeat period and optionally a DB column slice (useful for debugging).
+    an opened Oracle DB connection or a DBLink instance (in which case
+    records are always sent by the block), an integer number of successful
+    insertions, an integer number of errors, optionally a last heartbeat
+    time, optionally a heartbeat period, optionally a DB column slice
+    (useful for debugging), optionally a batch size and optionally a
+    function to call without arguments after each successful commit (e.g.
+    to save a checkpoint). If a batch size is set, records are collected
+    into blocks of that many rows which are each sent with a single
+    array-bound INSERT and committed. If a block (or the final commit)
+    fails while there's a function to call, AcctDBError is raised rather than carrying on, not to
+    get past the rows which didn't make it: the caller is expected to stop
+    and resume from its last checkpoint.
 
     Returns the number of successful inserts, the number of errors and the
     last heartbeat.
     '''
-    cursor = connection.cursor()
+    encoder = tab.encoder(slice)
+    if isinstance(connection, DBLink):
+        # Rows may have to be spooled, which is done by the block
+        cursor = None
+        batchsize = batchsize or BATCHSIZE
+    else:
+        cursor = connection.cursor()
+        cursor.setinputsizes(*encoder.sizes)
+    rows = []
 
     for rec in recs:
         # Evaluate against actual value to see what we're up against
         try:
-            for c in tab[:slice]:
-                c.eval(rec)
-
-            fmt = 'INSERT INTO %s VALUES (%s)'
-            stmt = fmt % (tab, ', '.join([c.param for c in tab[:slice]]))
-
-            l = filter(lambda v: v is not None, [c.val for c in tab[:slice]])
-
-            cursor.execute(stmt, l)
-            insertc += 1
+            row = encoder.encode(rec)
+
+            if batchsize:
+                rows.append(row)
+                if len(rows) >= batchsize:
+                    insertc, errorc, ok = sendblock(logger, connection,
+                                                    cursor, encoder, rows,
+                                                    insertc, errorc, commitfn)
+                    if not ok and commitfn is not None:
+                        raise AcctDBError("Stopped writing after a block "
+                                          "failed")
+                    rows = []
+            else:
+                cursor.execute(encoder.stmt, row)
+                insertc += 1
+        except AcctDBError:
+            raise
         except cx_Oracle.DatabaseError, e:
             error, = e.args
-            if error.code == 1: # ORA-00001: unique constraint
-                if errorc % LOGBUNCH == 0:
-                    logger.warning(INSERTERR % str(e)[:-1])
-                    fmt = "Next %d duplicates won't be reported"
-                    logger.warning(fmt % LOGBUNCH)
-                    errorc = 0
-            else:
-                # I don't know what to make of that: just log but don't
-                # reraise because I don't expect anyone to catch this and I
-                # don't want the script to stop.
-                logger.error(INSERTERR % str(e)[:-1])
-
-                #for c in tab[:slice]:
-                #    print "%s %s '%s'" % (c.col, c.type, str(c.val)[:60])
-                #print
-            errorc += 1
+            errorc = dberror(logger, error, errorc)
+
+            #for c, v in zip(encoder.cols, row):
+            #    print "%s %s '%s'" % (c.col, c.type, str(v)[:60])
+            #print
         except KeyError, e:
             # When you miss out keys when reading unflushed BLAH files
             # (Shouldn't happen any more, though)
@@ -561,19 +1105,256 @@ def insert(logger, tab, recs, connection, insertc, errorc,
             logger.error(INSERTERR % e)
             errorc += 1
 
-    try:
-        connection.commit()
-    except Exception, e:
-        logger.error(COMMITERR % e)
+    # Send last, incomplete block if any
+    if rows:
+        insertc, errorc, ok = sendblock(logger, connection, cursor, encoder,
+                                        rows, insertc, errorc, commitfn)
+        if not ok and commitfn is not None:
+            raise AcctDBError("Stopped writing after a block failed")
+    elif cursor is None:
+        # Nothing left to commit
+        if commitfn is not None:
+            commitfn()
+    elif not commit(logger, connection, commitfn) and commitfn is not None:
+        raise AcctDBError("Stopped writing after a commit failed")
 
     t = datetime.today()
     if t - heartbeat > timedelta(minutes=heartbeatdelta):
         fmt = "Inserted %d records in the last %d minutes"
         logger.info(fmt % (insertc, heartbeatdelta))
+        if isinstance(connection, DBLink) and connection.spool is not None:
+            logger.info("%d records spooled" % connection.spool.depth)
         heartbeat = datetime.today()
         insertc = 0
     return insertc, errorc, heartbeat
 
+class Writer(threading.Thread):
+    '''
+    Thread writing the blocks of rows queued in a Pipeline to the DB with
+    its own connection (or DBLink).
+    '''
+
+    def __init__(self, pipeline, connection):
+        threading.Thread.__init__(self)
+        self.setDaemon(True) # Don't hold the process back when it exits
+        self.pipeline = pipeline
+        self.connection = connection
+        self.errorc = 0
+
+    def run(self):
+        pipeline = self.pipeline
+        if isinstance(self.connection, DBLink):
+            cursor = None
+        else:
+            cursor = self.connection.cursor()
+            cursor.setinputsizes(*pipeline.encoder.sizes)
+
+        while True:
+            seq, rows, callback = pipeline.queue.get()
+            insertc, ok = 0, True
+            try:
+                try:
+                    # Blocks may be empty, only there for their callback,
+                    # and those queued after a block which failed won't be
+                    # checkpointed anyway
+                    if rows and \
+                       (pipeline.failed is None or seq < pipeline.failed):
+                        insertc, self.errorc, ok = \
+                            sendblock(pipeline.logger, self.connection,
+                                      cursor, pipeline.encoder, rows, 0,
+                                      self.errorc)
+                except Exception, e:
+                    fmt = "Couldn't write block %d: %s"
+                    pipeline.logger.error(fmt % (seq, e))
+                    ok = False
+            finally:
+                # Always acknowledge the block, not to leave join() waiting
+                pipeline.done(seq, insertc, callback, ok)
+
+class Pipeline:
+    '''
+    Decouples reading event records from writing them to the DB.
+
+    The reader (typically the inotify loop) encodes records into blocks of
+    rows which are queued up to a bounded number of blocks: when the queue
+    is full, the reader waits for the writers to catch up. Each writer
+    thread has its own DB connection and sends blocks with array-bound
+    INSERTs. Writers may finish blocks in any order but each block's
+    callback (e.g. saving a checkpoint) is only called once it and all the
+    blocks queued before it have been committed (or spooled).
+
+    If a block can't be written, the pipeline stops: neither its callback
+    nor those of the blocks queued after it are called and queueing more
+    raises AcctDBError, for the reader to stop and resume from its last
+    checkpoint the next time it's run.
+    '''
+
+    def __init__(self, logger, tab, connections, batchsize=BATCHSIZE,
+                 queuesize=QUEUESIZE, heartbeatdelta=HBDELTA):
+        '''
+        Start writers.
+
+        Expects a logger, a DBTab instance, a list of DB connections or
+        DBLink instances (one per writer thread), optionally the number of
+        rows per block, optionally the maximum number of blocks waiting to
+        be written and optionally a heartbeat period.
+        '''
+        self.logger = logger
+        self.encoder = tab.encoder()
+        self.batchsize = batchsize
+        self.queue = Queue.Queue(queuesize)
+        self.heartbeatdelta = heartbeatdelta
+
+        self.lock = threading.Lock()
+        self.seq = 0 # Next block to be queued
+        self.next = 0 # Next block whose callback is due
+        self.finished = {} # Blocks written out of order
+        self.failed = None # First block which couldn't be written
+        self.outstanding = 0 # Blocks queued but not yet acknowledged
+        self.idle = threading.Condition(self.lock)
+        self.insertc = 0
+        self.errorc = 0
+        self.heartbeat = datetime.today()
+
+        self.writers = [Writer(self, c) for c in connections]
+        for w in self.writers:
+            w.start()
+
+    def put(self, recs, snapshot=None):
+        '''
+        Encode event records into blocks and queue them, waiting for room
+        in the queue if needs be.
+
+        Expects an event record iterable and optionally a function which,
+        called without arguments right after a block has been read, returns
+        the function to call once the block has been committed (or None).
+        '''
+        rows = []
+        for rec in recs:
+            try:
+                rows.append(self.encoder.encode(rec))
+            except KeyError, e:
+                # When you miss out keys when reading unflushed BLAH files
+                # (Shouldn't happen any more, though)
+                self.logger.error("%s: probably unflushed record for %s" %
+                                  (e, rec))
+            except Exception, e:
+                self.logger.error(INSERTERR % e)
+                self.errorc += 1
+
+            if len(rows) >= self.batchsize:
+                self.enqueue(rows, snapshot)
+                rows = []
+
+        if rows:
+            self.enqueue(rows, snapshot)
+
+    def enqueue(self, rows, snapshot=None):
+        '''
+        Queue a block of rows, waiting for room in the queue if needs be.
+        An empty block may be queued just to have the function returned by
+        snapshot called once all the blocks queued so far have been written.
+        Raises AcctDBError if the pipeline has stopped.
+        '''
+        if self.failed is not None:
+            raise AcctDBError("Stopped writing after a block failed")
+
+        callback = None
+        if snapshot is not None:
+            callback = snapshot()
+
+        # Blocks may be queued by several threads
+        self.lock.acquire()
+        try:
+            seq = self.seq
+            self.seq += 1
+            self.outstanding += 1
+        finally:
+            self.lock.release()
+        self.queue.put((seq, rows, callback))
+
+    def done(self, seq, insertc, callback, ok=True):
+        '''
+        Acknowledge a block, written unless told otherwise, and call the
+        callbacks of all the blocks which have now been written in order. A
+        block which hasn't been written, or whose callback fails, stops the
+        pipeline.
+        '''
+        self.lock.acquire()
+        try:
+            self.insertc += insertc
+            if not ok and (self.failed is None or seq < self.failed):
+                self.failed = seq
+                self.logger.error("Couldn't write block %d, stopping" % seq)
+            self.finished[seq] = callback
+            while self.next in self.finished and \
+                  (self.failed is None or self.next < self.failed):
+                callback = self.finished.pop(self.next)
+                if callback is not None:
+                    try:
+                        callback()
+                    except Exception, e:
+                        fmt = "Callback of block %d failed, stopping: %s"
+                        self.logger.error(fmt % (self.next, e))
+                        self.failed = self.next
+                        break
+                self.next += 1
+
+            t = datetime.today()
+            if t - self.heartbeat > timedelta(minutes=self.heartbeatdelta):
+                fmt = "Inserted %d records in the last %d minutes"
+                self.logger.info(fmt % (self.insertc, self.heartbeatdelta))
+                link = self.writers[0].connection
+                if isinstance(link, DBLink) and link.spool is not None:
+                    self.logger.info("%d records spooled" % link.spool.depth)
+                self.heartbeat = t
+                self.insertc = 0
+        finally:
+            self.outstanding -= 1
+            if self.outstanding == 0:
+                self.idle.notifyAll()
+            self.lock.release()
+
+    def join(self):
+        '''
+        Wait until all the queued blocks have been written (or failed).
+        '''
+        # Not Queue.join(), which Python 2.4 doesn't have
+        self.idle.acquire()
+        try:
+            while self.outstanding > 0:
+                self.idle.wait()
+        finally:
+            self.idle.release()
+
+def loop(notifier, handler, latency=LATENCY, maxevents=MAXEVENTS):
+    '''
+    Dispatch inotify events forever, coalescing file modification events.
+
+    Expects a pyinotify.Notifier instance and its event handler, which is
+    expected to count the modification events it's notified in a pending
+    attribute and to deal with all of them at once in a drain() method.
+    Pending events are drained when the first of them has been waiting for
+    latency milliseconds or when there are maxevents of them, whichever
+    comes first.
+    '''
+    since = None
+    while True:
+        timeout = None # Block until there's something to do
+        if handler.pending > 0:
+            if since is None:
+                since = time.time()
+            waited = (time.time() - since) * 1000
+            if handler.pending >= maxevents or waited >= latency:
+                handler.drain()
+                since = None
+            else:
+                timeout = latency - waited
+
+        if notifier.check_events(timeout):
+            notifier.read_events()
+            notifier.process_events()
+
 def gethosts(connection, table, clr, subclr=None):
     '''
     List CE hosts
@@ -630,6 +1411,55 @@ def shortid(cols, prefix):
     else:
         return prefix + '_'.join(cols)
 
+def covered(cursor):
+    '''
+    Return the time before which every hour has been aggregated in the
+    rollup table, or None if it's never been refreshed (or doesn't exist).
+    '''
+    try:
+        cursor.execute("SELECT MAX(covered) FROM %s" % ROLLSTATETAB)
+    except cx_Oracle.DatabaseError:
+        return None
+    c, = cursor.fetchone()
+    return c
+
+def rewind(cursor, t):
+    '''
+    Move what the rollup table covers and the publication watermark back to
+    the hour of the datetime passed as argument, if they were past it, for
+    rows that old which have been inserted late (e.g. backfilled or drained
+    from a spool) to be aggregated by the next refresh and joined by the
+    next incremental publication. Tables which don't exist are left alone.
+
+    Expects a DB cursor and an eventTime datetime. The caller commits.
+    '''
+    hour = t.replace(minute=0, second=0, microsecond=0)
+    for tab, col in ((ROLLSTATETAB, 'covered'), (PUBTAB, 'watermark')):
+        try:
+            # Not while a refresh (see rollup.py) or a publication (see
+            # join.py) is recording where it got to
+            cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE" % tab)
+            stmt = "UPDATE %s SET %s = :t WHERE %s > :t" % (tab, col, col)
+            cursor.execute(stmt, {'t': hour})
+        except cx_Oracle.DatabaseError:
+            pass
+
+def partbounds(cursor, tab):
+    '''
+    Return the sorted list of datetimes the partitions of a table are less
+    than, or an empty list if the table isn't partitioned.
+
+    Expects a DB cursor and the table name.
+    '''
+    # Partitions are named after the UNIX timestamp they're less than
+    select = "SELECT partition_name FROM user_tab_partitions"
+    where = "WHERE table_name = :t"
+    cursor.execute("%s %s" % (select, where), [tab.upper()])
+    bounds = [datetime.fromtimestamp(int(name.split(tab.upper())[-1]))
+              for name, in cursor]
+    bounds.sort()
+    return bounds
+
 def createstmts(tab, onlyidxs=False, noidxs=False, name=None, slice=None,
                 idxspace=None, partition=None):
     '''
@@ -698,26 +1528,28 @@ def insertstmt(tab):
     Return parameterised INSERT statement query based on a DBTab instance
     passed as only parameter.
     '''
-    fmt = 'INSERT INTO %s VALUES (%s)'
-    return fmt % (tab, ', '.join([c.param for c in tab]))
+    return tab.encoder().stmt
 
-def insertexec(cursor, stmt, cols, rec):
+def insertexec(cursor, stmt, tab, rec):
     '''
     Execute event record INSERT statement.
 
     Expects a cursor object, an INSERT statement string as returned by 
-    insertstmt(), a DBCol sequence and an event record iterator. Doesn't
-    return anything.
+    insertstmt(), a DBTab instance and an event record. Doesn't return
+    anything.
     '''
-    cursor.execute(stmt, [c.eval(rec) for c in cols])
+    cursor.execute(stmt, tab.encoder().encode(rec))
 
 # FIXME To be merged with the other connect() function, maybe?
-def myconnect(logger, connfile, host):
+def myconnect(logger, connfile, host, timeout=None):
     '''
     Connect to CE database.
     
     Expects a file name string containing a connection string a la
-    username/password@db. Returns a connection object.
+    username/password@db, a host name and optionally how many seconds to
+    wait at most for the connection and for each read from it, for a host
+    which hangs mid-query not to hold us forever. Returns a connection
+    object.
     '''
 
     import MySQLdb
@@ -731,7 +1563,17 @@ def myconnect(logger, connfile, host):
             username = m.group('username')
             password = m.group('password')
             db = m.group('dsn') # Not really dsn, in MySQL parlance, but well...
-            return MySQLdb.connect(host, username, password, db)
+            if timeout is None:
+                return MySQLdb.connect(host, username, password, db)
+            try:
+                return MySQLdb.connect(host, username, password, db,
+                                       connect_timeout=timeout,
+                                       read_timeout=timeout)
+            except TypeError:
+                # No read timeout before MySQLdb 1.2.5
+                logger.warning("Can't time out reads from %s" % host)
+                return MySQLdb.connect(host, username, password, db,
+                                       connect_timeout=timeout)
         else:
             msg = "Wrong conn str format: try user/passwd@db"
             logger.error(msg)
@@ -742,25 +1584,33 @@ def myconnect(logger, connfile, host):
     except MySQLdb.OperationalError, (errno, strerr):
         raise CEDBError(strerr)
 
-def connect(logger, connfile):
+def connect(logger, connfile, threaded=False):
     '''
     Connect to database.
     
     Expects a file name string containing a connection string a la
-    username/password@dsn. Returns a connection object.
+    username/password@dsn (or sqlite:///path for a SQLite DB) and
+    optionally whether the connection is to be used in a multithreaded
+    process. Returns a connection object.
     '''
     try:
         # Use supplied credentials file
         logger.info("Reading DB connection file: %s" % connfile)
         f = open(connfile)
-        m = re.search(RE, f.readline())
+        line = f.readline()
         f.close()
-        if m:
+        m = re.search(RE, line)
+        if line.startswith(SQLITEDSN):
+            path = line.strip()[len(SQLITEDSN):]
+            logger.info("Connecting to SQLite DB: %s" % path)
+            return SQLiteConnection(path)
+        elif m:
             username = m.group('username')
             password = m.group('password')
             dsn = m.group('dsn')
             logger.info("Connecting to custom DSN: %s" % dsn)
-            return cx_Oracle.connect(username, password, dsn)
+            return cx_Oracle.connect(username, password, dsn,
+                                     threaded=threaded)
         else:
             msg = "Wrong conn str format: try user/passwd@dsn"
             logger.error(msg)
@@ -774,6 +1624,388 @@ def connect(logger, connfile):
         logger.error(msg)
         raise AcctDBError(msg)
 
+# SQLite backend, for developing, testing and benchmarking without an Oracle
+# instance. Dates are stored as Julian day numbers (as SQLite's julianday()
+# returns them), so that date differences are in days, as on Oracle.
+SQLITEDSN = 'sqlite:///' # Followed by the DB file path (absolute if /-led)
+JULIANORD = 1721424.5 # Julian day number of proleptic Gregorian ordinal 0
+SQLITEPRAGMAS = ['PRAGMA journal_mode = WAL',
+                 'PRAGMA synchronous = NORMAL',
+                 'PRAGMA case_sensitive_like = ON'] # As Oracle's LIKE
+# Nothing is partitioned
+SQLITEVIEWS = ["CREATE TEMP VIEW user_tab_partitions AS SELECT NULL AS "
+               "partition_name, NULL AS table_name WHERE 0"]
+ADDPARTRE = re.compile(r'ALTER\s+TABLE\s+\w+\s+ADD\s+PARTITION\b', re.I)
+LOCKRE = re.compile(r'LOCK\s+TABLE\b', re.I) # Writes lock the whole DB
+PARTRE = re.compile(r'\s+PARTITION\s+BY\s+RANGE\b.*$', re.I | re.S)
+TABLESPACERE = re.compile(r'\s+(USING\s+INDEX\s+)?TABLESPACE\s+\w+', re.I)
+PKRE = re.compile(r'ALTER\s+TABLE\s+(?P<tab>\w+)\s+ADD\s+CONSTRAINT\s+'
+                  r'(?P<name>\w+)\s+PRIMARY\s+KEY\s*\((?P<cols>[^)]*)\)', re.I)
+DATELITRE = re.compile(r"\bDATE\s*'(\d{4})-(\d{1,2})-(\d{1,2})'", re.I)
+BINDRE = re.compile(r':\w+')
+NVLRE = re.compile(r'\bNVL\s*\(', re.I)
+FROMRE = re.compile(r'\sFROM\b', re.I)
+DATEITEMRE = re.compile(r'^(TRUNC\s*\(.*\)|(MIN|MAX)\s*\(\s*(\w+\.)?'
+                        r'(?P<col>\w+)\s*\))$', re.I | re.S)
+
+def julian(t):
+    '''
+    Return the Julian day number of a datetime or date.
+    '''
+    j = t.toordinal() + JULIANORD
+    if isinstance(t, datetime):
+        s = t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1e6
+        j += s / 86400.
+    return j
+
+def fromjulian(j):
+    '''
+    Return the datetime, to the second, of a Julian day number.
+    '''
+    days = float(j) - JULIANORD
+    ordinal = int(days)
+    return datetime.fromordinal(ordinal) + \
+        timedelta(seconds=int(round((days - ordinal) * 86400)))
+
+def sqlitetrunc(j, fmt='DDD'):
+    '''
+    Oracle's TRUNC for dates stored as Julian day numbers.
+    '''
+    if j is None:
+        return None
+    t = fromjulian(j)
+    fmt = fmt.upper()
+    if fmt == 'MI':
+        t = t.replace(second=0)
+    elif fmt in ('HH', 'HH24'):
+        t = t.replace(minute=0, second=0)
+    elif fmt in ('DD', 'DDD', 'J'):
+        t = datetime(t.year, t.month, t.day)
+    elif fmt == 'WW': # Weeks start on the weekday of 1 January
+        jan1 = datetime(t.year, 1, 1)
+        t = jan1 + timedelta(days=(t - jan1).days // 7 * 7)
+    elif fmt == 'IW':
+        t = datetime(t.year, t.month, t.day) - timedelta(days=t.weekday())
+    elif fmt in ('MM', 'MON', 'MONTH'):
+        t = datetime(t.year, t.month, 1)
+    elif fmt in ('Y', 'YY', 'YYY', 'YYYY', 'YEAR'):
+        t = datetime(t.year, 1, 1)
+    else:
+        raise ValueError("Unsupported TRUNC format: %s" % fmt)
+    return julian(t)
+
+def sqlitedecode(expr, *args):
+    '''
+    Oracle's DECODE, which deems NULLs equal.
+    '''
+    for i in range(0, len(args) - 1, 2):
+        if expr == args[i]:
+            return args[i + 1]
+    if len(args) % 2:
+        return args[-1]
+    return None
+
+def sqlitewidthbucket(expr, low, high, n):
+    '''
+    Oracle's WIDTH_BUCKET, buckets being numbered from 1 to n, 0 and n + 1
+    being out of range.
+    '''
+    if expr is None:
+        return None
+    if expr < low:
+        return 0
+    if expr >= high:
+        return n + 1
+    return int((expr - low) * n / (high - low)) + 1
+
+def datecols():
+    '''
+    Return the set of lower case names of the DATE columns of all tables.
+    '''
+    cols = set()
+    for tab in TABS.values() + [OLDLOCTAB]:
+        for c in tab.cols:
+            if parsetype(c.type)[0].upper() == 'DATE':
+                cols.add(c.col.lower())
+    return cols
+
+def datealias(stmt):
+    '''
+    Alias the items of a SELECT list which are dates but don't have a
+    declared type (TRUNC and MIN or MAX of DATE columns) for sqlite3 to
+    convert them back to datetimes.
+    '''
+    if stmt[:6].upper() != 'SELECT':
+        return stmt
+
+    # Top-level items up to FROM
+    items, depth, quoted, start, end = [], 0, False, 6, len(stmt)
+    i = 6
+    while i < len(stmt):
+        c = stmt[i]
+        if c == "'":
+            quoted = not quoted
+        elif quoted:
+            pass
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and c == ',':
+            items.append(stmt[start:i])
+            start = i + 1
+        elif depth == 0 and FROMRE.match(stmt, i):
+            end = i
+            break
+        i += 1
+    items.append(stmt[start:end])
+
+    cols = None
+    for n, item in enumerate(items):
+        m = DATEITEMRE.match(item.strip())
+        if m is None:
+            continue
+        if m.group('col') is not None:
+            if cols is None:
+                cols = datecols()
+            if m.group('col').lower() not in cols:
+                continue
+        items[n] = '%s AS "d%d [DATE]"' % (item.rstrip(), n)
+    return stmt[:6] + ','.join(items) + stmt[end:]
+
+SQLITESTMTS = {} # Translated statements, by statement and bind style
+
+def sqlitestmt(stmt, named=False):
+    '''
+    Translate an Oracle statement as built by this module and its users to
+    SQLite, or return None if there's nothing to do on SQLite (e.g. adding a
+    partition or locking a table).
+
+    Expects a statement string and optionally whether parameters are bound
+    by name rather than position. Translated statements are cached.
+    '''
+    key = (stmt, named)
+    try:
+        return SQLITESTMTS[key]
+    except KeyError:
+        pass
+
+    s = stmt.strip()
+    if ADDPARTRE.match(s) or LOCKRE.match(s):
+        SQLITESTMTS[key] = None
+        return None
+
+    # DDL
+    s = PARTRE.sub('', s)
+    s = TABLESPACERE.sub('', s)
+    m = PKRE.match(s)
+    if m:
+        s = 'CREATE UNIQUE INDEX %s ON %s (%s)' % \
+            (m.group('name'), m.group('tab'), m.group('cols'))
+
+    # Date literals
+    s = DATELITRE.sub(lambda m: repr(julian(date(*[int(g)
+                                                   for g in m.groups()]))),
+                      s)
+
+    # Outside of string literals: positional binds, exact divisions, NVL
+    parts = s.split("'")
+    for i in range(0, len(parts), 2):
+        p = parts[i]
+        if not named:
+            p = BINDRE.sub('?', p)
+        p = p.replace('/', '* 1.0 /')
+        p = NVLRE.sub('IFNULL(', p)
+        parts[i] = p
+    s = datealias("'".join(parts))
+
+    SQLITESTMTS[key] = s
+    return s
+
+class SQLiteError:
+    '''
+    Stand-in for cx_Oracle error objects, as found in DatabaseError
+    arguments and batch errors. Constraint violations have the ORA-00001
+    code.
+    '''
+
+    def __init__(self, code, message, offset=0):
+        self.code = code
+        self.message = message + '\n' # As Oracle's
+        self.offset = offset
+
+    def __str__(self):
+        return self.message
+
+class SQLiteConnection:
+    '''
+    SQLite database connection behaving like the parts of cx_Oracle
+    connections this module and its users rely on. Transactions are begun
+    on the first statement after a commit or rollback, DDL statements being
+    committed straight away as on Oracle. Statements are serialised, for
+    the connection to be shared between threads. Errors are raised as
+    cx_Oracle.DatabaseError.
+    '''
+
+    def __init__(self, path):
+        '''
+        Expects the DB file path.
+        '''
+        import sqlite3
+        self.sqlite3 = sqlite3
+        sqlite3.register_adapter(datetime, julian)
+        sqlite3.register_adapter(date, julian)
+        sqlite3.register_converter('DATE', fromjulian)
+
+        try:
+            types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+            self.db = sqlite3.connect(path, detect_types=types,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+            self.db.text_factory = str
+            self.db.create_function('TRUNC', -1, sqlitetrunc)
+            self.db.create_function('DECODE', -1, sqlitedecode)
+            self.db.create_function('WIDTH_BUCKET', 4, sqlitewidthbucket)
+            for stmt in SQLITEPRAGMAS + SQLITEVIEWS:
+                self.db.execute(stmt)
+        except sqlite3.Error, e:
+            raise cx_Oracle.DatabaseError(SQLiteError(None, str(e)))
+        self.lock = threading.RLock()
+        self.intx = False
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def run(self, fn, stmt, *args):
+        '''
+        Call a sqlite3 cursor execute function with a translated statement
+        and its arguments within a transaction. Returns what it returns.
+        '''
+        self.lock.acquire()
+        try:
+            try:
+                if stmt.split(None, 1)[0].upper() in ('CREATE', 'ALTER',
+                                                      'DROP'):
+                    self.end('COMMIT')
+                elif not self.intx:
+                    self.db.execute('BEGIN')
+                    self.intx = True
+                return fn(stmt, *args)
+            except self.sqlite3.IntegrityError, e:
+                raise cx_Oracle.DatabaseError(SQLiteError(1, str(e)))
+            except self.sqlite3.Error, e:
+                raise cx_Oracle.DatabaseError(SQLiteError(None, str(e)))
+        finally:
+            self.lock.release()
+
+    def end(self, how):
+        '''
+        End the transaction if any, how being COMMIT or ROLLBACK.
+        '''
+        self.lock.acquire()
+        try:
+            try:
+                if self.intx:
+                    self.intx = False
+                    self.db.execute(how)
+            except self.sqlite3.Error, e:
+                raise cx_Oracle.DatabaseError(SQLiteError(None, str(e)))
+        finally:
+            self.lock.release()
+
+    def commit(self):
+        self.end('COMMIT')
+
+    def rollback(self):
+        self.end('ROLLBACK')
+
+    def close(self):
+        self.rollback()
+        self.db.close()
+
+class SQLiteCursor:
+    '''
+    Cursor of a SQLiteConnection, translating statements with sqlitestmt()
+    and supporting batch errors.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.db.cursor()
+        self.arraysize = self.cursor.arraysize
+        self.errors = []
+
+    def __getattr__(self, name):
+        # E.g. rowcount, description
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def setinputsizes(self, *sizes):
+        pass # Types are dynamic
+
+    def execute(self, stmt, params=()):
+        s = sqlitestmt(stmt, isinstance(params, dict))
+        if s is not None:
+            self.connection.run(self.cursor.execute, s, params)
+
+    def executemany(self, stmt, rows, batcherrors=False):
+        '''
+        Execute a statement for each row. With batcherrors, rows violating
+        constraints are reported by getbatcherrors() rather than aborting
+        the others: the block is first executed at once and, should it
+        fail, again row by row.
+        '''
+        s = sqlitestmt(stmt)
+        self.errors = []
+        if s is None:
+            return
+        if not batcherrors:
+            self.connection.run(self.cursor.executemany, s, rows)
+            return
+
+        self.connection.lock.acquire()
+        try:
+            self.connection.run(self.cursor.execute, 'SAVEPOINT block')
+            try:
+                self.connection.run(self.cursor.executemany, s, rows)
+            except cx_Oracle.DatabaseError, e:
+                error, = e.args
+                if error.code != 1:
+                    raise
+                self.connection.run(self.cursor.execute,
+                                    'ROLLBACK TO block')
+                for i, row in enumerate(rows):
+                    try:
+                        self.connection.run(self.cursor.execute, s, row)
+                    except cx_Oracle.DatabaseError, e:
+                        error, = e.args
+                        if error.code != 1:
+                            raise
+                        error.offset = i
+                        self.errors.append(error)
+            self.connection.run(self.cursor.execute, 'RELEASE block')
+        finally:
+            self.connection.lock.release()
+
+    def getbatcherrors(self):
+        return self.errors
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
 def accounting(logger, acctfile):
     '''
     Set up PyLSF and return accounting file name.
@@ -804,53 +2036,50 @@ def parse(fileobj, evthdl=None):
     Read new lines coming in fileobj, parse fields we're interested in
     publishing and order them as the DB expect them before yielding them in
     a list.
+
+    If an event handler is passed, reading starts at its byte offset, which
+    is moved past each whole line as it's yielded. An improperly flushed
+    last line is left alone until it's complete.
     '''
 
     # Skip what we've already processed
     if evthdl is not None:
-        for _ in range(evthdl.offset): 
-            # Can't rely on anything like self.insert + self.errorc because
-            # self.insert is periodically reset for logging purposes.
-            # It's worth noting self.offset is incremented within the
-            # generator itself.
-            fileobj.next()
-
-    while True: # Not a for loop because we need to keep newlines
-        l = fileobj.next()
-        try:
-            if l[-1] == '\n': # If it's a whole line...
-                # ... proceed as usual in yielding the resulting dictionary
-                fields = {}
-                for f in RERECORD.findall(evthdl.buf + l): # For each field
-                    k, v = f.split('=', 1)
-                    if k == USERFQAN: 
-                        # The userFQAN fields deserves some special treatment
-                        # as there can be several of these and they have to
-                        # be listed
-                        if USERFQAN in fields:
-                            fields[USERFQAN] += ' ' + v
-                        else:
-                            fields[USERFQAN] = v
-                    elif k == TIMESTAMP: 
-                        # The timestamp field also deserves some special
-                        # treatment because it needs parsing
-                        fields[k] = time.mktime(time.strptime(v, TFMT))
-                    elif k == LRMSID:
-                        # The lrmsID also also deserves some special treatment
-                        # as I need it to be a real int. (Before you know it,
-                        # everything will need some special treatment.)
-                        fields[k] = int(v)
-                    else:
-                        fields[k] = v
-
-                # Yield the resulting dictionary
-                if evthdl is not None:
-                    evthdl.offset += 1
-                yield fields
-
-                evthdl.buf = ''
-            else: # If it's not a whole line...
-                # ... buffer it for later on
-                evthdl.buf = l
-        except StopIteration:
-            pass
+        # Not a for loop, which reads ahead and would make tell() and
+        # the offset meaningless.
+        fileobj.seek(evthdl.offset)
+
+    while True:
+        l = fileobj.readline()
+        if l == '' or l[-1] != '\n':
+            # Nothing more or not a whole line: we'll read it again from
+            # the current offset once it's been properly flushed.
+            break
+
+        fields = {}
+        for f in RERECORD.findall(l): # For each field
+            k, v = f.split('=', 1)
+            if k == USERFQAN: 
+                # The userFQAN fields deserves some special treatment
+                # as there can be several of these and they have to
+                # be listed
+                if USERFQAN in fields:
+                    fields[USERFQAN] += ' ' + v
+                else:
+                    fields[USERFQAN] = v
+            elif k == TIMESTAMP: 
+                # The timestamp field also deserves some special
+                # treatment because it needs parsing
+                fields[k] = time.mktime(time.strptime(v, TFMT))
+            elif k == LRMSID:
+                # The lrmsID also also deserves some special treatment
+                # as I need it to be a real int. (Before you know it,
+                # everything will need some special treatment.)
+                fields[k] = int(v)
+            else:
+                fields[k] = v
+
+        # Yield the resulting dictionary
+        if evthdl is not None:
+            evthdl.offset += len(l)
+            evthdl.eventtime = fields.get(TIMESTAMP)
+        yield fields
@@ -11,5 +11,6 @@ setup(name='batchacct-common',
                     ('/etc/logrotate.d', ['logrotate/batchacct']),
                     ('/var/log/batchacct', []),
                     ('/var/run/batchacct', []),
+                    ('/var/lib/batchacct', []),
                  ]
      )
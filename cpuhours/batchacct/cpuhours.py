@@ -8,10 +8,14 @@ import os, os.path
 import string
 import time
 import math
+import re
+import hashlib
+import struct
 from itertools import izip, islice
 # Let's not look at the exit status or info: guess a job can run, consume & fail
 from common import STTCOND, CPUCOND
 import common
+import extract
 
 EPOCH = datetime.datetime(1970, 1, 1, 1, 0, 0)
 CFG = '.cpuhours.cfg'
@@ -29,30 +33,62 @@ END = time.mktime(datetime.date.today().timetuple())
 PLANCOLS = ['id', 'operation', 'options', 'optimizer', 'cost', 'cardinality',
             'bytes', 'cpu_cost', 'io_cost', 'time']
 
+CACHEDIR = '~/.batchacct/cache'
+CACHESIZE = 64 # Megabytes
+CACHEEXPIRY = 24 # Hours after which cached bins are queried again
+LATENESS = datetime.timedelta(hours=1) # After which bins are deemed closed
+
+# Binnings coarse enough to be read from the rollup table
+ROLLUPBINNINGS = ('HH24', 'DDD', 'WW')
+
+WORKERS = 4 # Batch plot rendering worker processes
+
+# Measures of batch plot definitions, in measureflags() order after cpu
+MEASURES = ('cpu', 'count', 'walltime', 'waiting', 'cumuwaiting', 'started')
+
+# Percentile measures and the quantiles worked out for them by default
+PCTMEASURES = ('waiting', 'efficiency')
+QUANTILES = '50,90,99'
+
 DELTA = {'HH24': datetime.timedelta(hours=1),
          'DDD': datetime.timedelta(days=1),
          'WW': datetime.timedelta(weeks=1),
          'MI': datetime.timedelta(minutes=1),
         }
 
-def fillgaps(xs, ys, binning):
+def fillgaps(xs, ys, binning, fill=0):
     '''
-    Look for missing bins where no value has been found and set 0 to them.
-
-    Expect xs and ys values as well as the Oracle (MI, HH24, DDD, WW ...) and
-    fill in the gaps in xs and ys in place.
+    Look for missing bins where no value has been found and set 0 to them,
+    or whatever fill value is passed as argument.
+
+    Expect sorted datetime64 xs and ys arrays as well as the Oracle (MI,
+    HH24, DDD, WW ...) binning and return xs and ys arrays over the full
+    bin grid. Gaps are measured from the bin before each of them, as weekly
+    bins don't line up across years. The ys array may have several
+    columns.
     '''
+    import numpy as npy
 
-    i = 1
-    try:
-        while True:
-            if xs[i] - xs[i - 1] > DELTA[binning]:
-                xs.insert(i, xs[i - 1] + DELTA[binning])
-                ys.insert(i, 0)
-            else:
-                i += 1
-    except IndexError:
-        pass
+    if len(xs) < 2:
+        return xs, ys
+    delta = npy.timedelta64(DELTA[binning]).astype('timedelta64[s]')
+
+    # How many bins are missing after each one
+    gaps = npy.diff(xs)
+    second = npy.timedelta64(1, 's')
+    missing = npy.where(gaps > delta, (gaps - second) // delta, 0)
+    runs = npy.append(missing, 0) + 1
+
+    # Full bin grid, each bin followed by its missing ones
+    where = npy.arange(len(xs)) + npy.append(0, npy.cumsum(missing))
+    steps = npy.arange(runs.sum()) - npy.repeat(where, runs)
+    grid = npy.repeat(xs, runs) + steps * delta
+
+    # Reindex
+    filled = npy.empty((len(grid),) + ys.shape[1:])
+    filled.fill(fill)
+    filled[where] = ys
+    return grid, filled
 
 def labels(plt, count, walltime, waiting, cumuwaiting, started, nonorm):
     '''
@@ -174,15 +210,46 @@ def mkcond(items, column):
                                               for i, op in enumerate(fops)])
     return itemcond, items
 
+def wallbins(xmax):
+    '''
+    Pick a sensible unit and binning for a walltime histogram.
+
+    Expect the rightmost walltime in hours and return the unit name, how
+    many units make an hour, the rightmost bin edge in units and the number
+    of bins.
+    '''
+
+    if xmax < .5:           # If < 30 minutes, then 10s/bin
+        unit = 'minute'         # 30 minutes in minutes easy to fathom
+        xright = 30
+        return unit, 60, xright, int(round(xright / (10. / 60)))
+    elif xmax < 3:          # If < 3 hour,     then 1min/bin
+        unit = 'minute'         # 3 hours in minutes easy to fathom
+        xright = 180
+        return unit, 60, xright, xright
+    elif xmax < 24:         # If < 24 hour,    then 10min/bin
+        unit = 'hours'          # 24 hours in hours easy to fathom
+        xright = 24
+        return unit, 1, xright, int(round(xright / (10. / 60)))
+    else:                   # Otherwise,            1h/bin
+        unit = 'hours'          # Hours should still be OK
+        xright = int(math.ceil(xmax))
+        return unit, 1, xright, xright
+
 def walldistdbread(logger, connfile, table, begin, end, crits, users, hosts,
-                   title, plan, norm):
+                   title, plan, norm, crop=None):
     '''
-    Connect to DB, run query and store x values into a list which is returned.
+    Connect to DB, have it bin walltimes and return the unit name, an array
+    of job counts and an array of bin edges, or None if there are no jobs.
 
     Specific to getting data for plotting a histogram of the waiting
     distribution, i.e. dbread() isn't really suitable for doing it (not
     least because we don't have time on the x axis, we have walltimes).
+    The binning depends on the maximum walltime, cropped to crop seconds if
+    passed, so it's queried first. Jobs beyond the rightmost bin are left
+    out.
     '''
+    import numpy as npy
 
     # Connect
     c = common.connect(logger, os.path.expanduser(connfile))
@@ -205,7 +272,7 @@ def walldistdbread(logger, connfile, table, begin, end, crits, users, hosts,
 
     # Query
     # Difference is already in days by virtue of Oracle
-    sel = "SELECT (eventTime - startTime) * 24 %s" % factor
+    expr = "(eventTime - startTime) * 24 %s" % factor
     tab = "FROM %s" % table
 
     # Time condition is compulsory and there are default values anyway
@@ -213,47 +280,261 @@ def walldistdbread(logger, connfile, table, begin, end, crits, users, hosts,
     span = [datetime.date.fromtimestamp(begin),
             datetime.date.fromtimestamp(end)]
 
-    # Statement
-    stmt = '%s %s %s AND %s AND %s %s' % \
-        (sel, tab, timecond, STTCOND, CPUCOND, critcond + hostcond + usercond)
+    # Statements
+    where = '%s %s AND %s AND %s %s' % \
+        (tab, timecond, STTCOND, CPUCOND, critcond + hostcond + usercond)
     params = span + [EPOCH] + crits + hosts + users
+    maxstmt = "SELECT MAX(%s) %s" % (expr, where)
 
     print "Querying..."
     t = time.time()
+    if plan:
+        mkplan(cursor, maxstmt)
+    cursor.execute(maxstmt, params)
+    xmax, = cursor.fetchone()
+    if xmax is None:
+        return None
+
+    # Crop (logic in hours)
+    if crop and crop / 60. / 60 < xmax:
+        xmax = crop / 60. / 60
+
+    # Bins are numbered from 1, 0 and nbins + 1 being out of range
+    unit, scale, xright, nbins = wallbins(xmax)
+    bucket = "WIDTH_BUCKET(%s, 0, %f, %d)" % \
+        (expr, float(xright) / scale, nbins)
+    stmt = "SELECT %s, COUNT(*) %s GROUP BY %s" % (bucket, where, bucket)
     if plan:
         mkplan(cursor, stmt)
-
     cursor.execute(stmt, params)
 
-    # Run query and store values
-    f = open(title.translate(TRANS) + '.data', 'w')
-    xs = []
-    for x, in cursor:
-        print >>f, '%f' % x
-        xs.append(x)
+    # Run query and store counts
+    n = npy.zeros(nbins)
+    for b, count in cursor:
+        if 1 <= b <= nbins:
+            n[int(b) - 1] = count
+    bins = npy.linspace(0, xright, nbins + 1)
     print "Queried in %f s" % (time.time() - t)
-    f.close()
-    return xs
+    npy.savetxt(title.translate(TRANS) + '.data',
+                npy.column_stack((bins[:-1], n)), fmt=['%f', '%d'])
+    return unit, n, bins
 
-def dbread(logger, connfile, table, begin, end, crits, users, hosts, title,
-           binning, count, walltime, waiting, cumuwaiting, started, plan, norm):
+def binfloor(t, binning):
     '''
-    Connect to DB, run query and store x and y values into two separate
-    lists returned in two separate tuples.
+    Return the start of the bin the datetime passed as argument falls in,
+    the way Oracle's TRUNC would work it out with the binning passed as
+    argument, weeks starting on the weekday of 1 January.
+    '''
+    if binning == 'WW':
+        jan1 = datetime.datetime(t.year, 1, 1)
+        return jan1 + datetime.timedelta(days=(t - jan1).days // 7 * 7)
+    elif binning == 'DDD':
+        return datetime.datetime(t.year, t.month, t.day)
+    elif binning == 'HH24':
+        return t.replace(minute=0, second=0, microsecond=0)
+    return t.replace(second=0, microsecond=0)
+
+def binceil(t, binning):
+    '''
+    Return the first bin start from the datetime passed as argument on.
+    '''
+    b = binfloor(t, binning)
+    if b == t:
+        return b
+    if binning == 'WW':
+        # The last week of the year is cut short by the next one
+        return min(b + DELTA[binning], datetime.datetime(b.year + 1, 1, 1))
+    return b + DELTA[binning]
+
+class Cache:
+    '''
+    Local cache of query results. Each query, as identified by everything
+    but its time range, has a file holding the time range it covers and
+    its bins in binary form. Only whole bins are cached, for them not to
+    depend on the time range they were first queried for: the bins cut by
+    the time range asked for are queried, as are the bins missing from the
+    cache and those still open. Cached bins expire, for late rows (e.g.
+    backfilled) to eventually show. The least recently used files are
+    removed to keep the cache under a maximum size.
     '''
 
-    # Connect
-    c = common.connect(logger, os.path.expanduser(connfile))
-    cursor = c.cursor()
+    HEADER = '!4sqqq' # Magic, covered time range, when first queried
+    BIN = '!qd' # x as a UNIX timestamp, y
+    MAGIC = 'BAC2'
+
+    def __init__(self, path, maxsize=CACHESIZE, lateness=LATENESS,
+                 expiry=CACHEEXPIRY):
+        '''
+        Expects the cache directory path, optionally its maximum size in
+        megabytes, optionally the timedelta after which rows are deemed
+        to have all been inserted and optionally how many hours cached bins
+        may be used for. Raises OSError if the directory can't be created.
+        '''
+        self.path = os.path.expanduser(path)
+        self.maxsize = maxsize * 1024 * 1024
+        self.lateness = lateness
+        self.expiry = datetime.timedelta(hours=expiry)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def key(self, *args):
+        '''
+        Return the cache key of the normalised query passed as arguments.
+        '''
+        return hashlib.sha1(repr(args)).hexdigest()
+
+    def load(self, key):
+        '''
+        Return the (begin, end, written, bins) tuple cached under the key
+        passed as argument, written being when its oldest bins were queried
+        and bins a dictionary of y values by x value, or None if there's
+        nothing cached or if it's expired.
+        '''
+        path = os.path.join(self.path, key)
+        try:
+            f = open(path, 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            return None
 
-    # Queues or groups
-    critcond, crits = mkcritcond(crits)
+        n = struct.calcsize(self.HEADER)
+        try:
+            magic, begin, end, written = struct.unpack(self.HEADER, data[:n])
+        except struct.error:
+            return None
+        if magic != self.MAGIC:
+            return None
+        if datetime.datetime.fromtimestamp(written) < \
+           datetime.datetime.now() - self.expiry:
+            return None
+
+        bins = {}
+        m = struct.calcsize(self.BIN)
+        for i in xrange(n, len(data) - m + 1, m):
+            x, y = struct.unpack(self.BIN, data[i:i + m])
+            bins[datetime.datetime.fromtimestamp(x)] = y
+
+        os.utime(path, None) # Recently used
+        return (datetime.datetime.fromtimestamp(begin),
+                datetime.datetime.fromtimestamp(end), written, bins)
+
+    def save(self, key, begin, end, bins, written=None):
+        '''
+        Atomically write the time range and bins passed as arguments under
+        the key passed as argument, then evict least recently used files if
+        the cache is too large. The bins expire from when they were written
+        unless told otherwise by the optional UNIX timestamp, for bins added
+        to a cache file not to hold back the expiry of those already there.
+        '''
+        if written is None:
+            written = int(time.time())
+        path = os.path.join(self.path, key)
+        data = [struct.pack(self.HEADER, self.MAGIC, ts(begin), ts(end),
+                            written)]
+        for x, y in sorted(bins.items()):
+            data.append(struct.pack(self.BIN, ts(x), y))
+        f = open(path + '.tmp', 'wb')
+        f.write(''.join(data))
+        f.close()
+        os.rename(path + '.tmp', path)
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used files until the cache is small enough.
+        '''
+        entries = []
+        for e in os.listdir(self.path):
+            st = os.stat(os.path.join(self.path, e))
+            entries.append((st.st_mtime, st.st_size, e))
+        size = sum([e[1] for e in entries])
+        for _, n, e in sorted(entries):
+            if size <= self.maxsize:
+                break
+            os.remove(os.path.join(self.path, e))
+            size -= n
+
+    def get(self, key, begin, end, binning, query):
+        '''
+        Return the bins from begin to end (excluded) as a dictionary of y
+        values by x value.
+
+        Expects a key as returned by key(), begin and end datetimes, the
+        binning and the function to call with a begin and end datetime to
+        query the bins missing from the cache.
+        '''
+        # Whole closed bins, which are the only ones cached
+        horizon = datetime.datetime.now() - self.lateness
+        first = binceil(begin, binning)
+        last = binfloor(min(end, horizon), binning)
+        if first >= last:
+            return query(begin, end)
+
+        cached = self.load(key)
+        if cached is None or first > cached[1] or last < cached[0]:
+            # Nothing useful cached: start again from scratch
+            lo, hi, written, bins = first, first, None, {}
+        else:
+            lo, hi, written, bins = cached
+
+        # Query whole closed bins which aren't cached yet
+        missing = []
+        if first < lo:
+            missing.append((first, lo))
+        if hi < last:
+            missing.append((hi, last))
+        for b, e in missing:
+            for x, y in query(b, e).items():
+                bins[x] = bins.get(x, 0) + y
+        if missing:
+            try:
+                self.save(key, min(lo, first), max(hi, last), bins, written)
+            except (IOError, OSError), e:
+                print >>sys.stderr, "Couldn't cache query results: %s" % e
 
-    # Submit hosts
-    hostcond, hosts = mkcond(hosts, 'fromHost')
+        rows = dict([(x, y) for x, y in bins.items() if first <= x < last])
 
-    # Users
-    usercond, users = mkcond(users, 'userName')
+        # Query the bins cut by begin or end and those still open, but
+        # don't cache them
+        for b, e in ((begin, first), (last, end)):
+            if b < e:
+                for x, y in query(b, e).items():
+                    rows[x] = rows.get(x, 0) + y
+        return rows
+
+def ts(t):
+    '''
+    Return the UNIX timestamp integer of the datetime passed as argument.
+    '''
+    return int(time.mktime(t.timetuple()))
+
+def rollupcol(count, walltime, waiting, cumuwaiting, norm):
+    '''
+    Return the SELECT expression of the measure passed as argument as read
+    from the rollup table.
+    '''
+
+    # Normalised sums are already weighted with hostFactor
+    if norm == None:
+        prefix, factor = '', ''
+    else:
+        prefix, factor = 'h', ' * %s' % norm
+
+    if count:
+        return "SUM(jobs)"
+    elif walltime:
+        return "SUM(%swall)%s" % (prefix, factor)
+    elif waiting or cumuwaiting:
+        return "SUM(%swait)%s" % (prefix, factor)
+    else:
+        return "SUM(%scpu)%s / 60 / 60 / 24" % (prefix, factor)
+
+def localcol(count, walltime, waiting, cumuwaiting, started, norm):
+    '''
+    Return the column to bin by and the SELECT expression of the measure
+    passed as argument as read from the local table.
+    '''
 
     # Group
     if started:
@@ -278,25 +559,199 @@ def dbread(logger, connfile, table, begin, end, crits, users, hosts, title,
         col = "SUM((startTime - submitTime) %s)" % factor
     else:
         col = "SUM((ru_stime + ru_utime) %s / 60 / 60 / 24)" % factor
+    return grp, col
 
-    # Query
-    # DDD if we had wanted HEPSPEC06 in days
-    sel = "SELECT TRUNC(%s, '%s'), %s" % (grp, binning, col)
-    tab = "FROM %s" % table
+def binstmts(cursor, table, binning, grp, col, rcol, begin, end, conds,
+             params, keys=[]):
+    '''
+    Return the (statement, parameters) tuples binning a measure from begin
+    to end (excluded), the rows of which are the bin, the keys if any and
+    the value.
+
+    Expects a cursor, the table name, the binning, the column to bin by and
+    the SELECT expression as returned by localcol(), the SELECT expression
+    as returned by rollupcol() or None not to read from the rollup table,
+    begin and end datetimes, the extra conditions with their parameters and
+    optionally a list of extra columns to group by. Whatever part of the
+    time range the rollup table covers is read from it, bins possibly
+    straddling both tables.
+    '''
+    span = [begin, end]
+    stmts = []
+    if keys:
+        keysel = ', ' + ', '.join(keys)
+    else:
+        keysel = ''
+
+    # Read from the rollup table whatever it covers
+    if rcol is not None and binning in ROLLUPBINNINGS and \
+       str(table) == str(common.LOCALTAB):
+        covered = common.covered(cursor)
+        if covered is not None and covered > begin:
+            sel = "SELECT TRUNC(hour, '%s')%s, %s" % (binning, keysel, rcol)
+            tab = "FROM %s" % common.ROLLUPTAB
+            timecond = "WHERE hour >= :begin AND hour < :end"
+            grpexpr = "GROUP BY TRUNC(hour, '%s')%s" % (binning, keysel)
+            stmt = '%s %s %s %s %s' % (sel, tab, timecond, conds, grpexpr)
+            stmts.append((stmt, [begin, min(covered, end)] + params))
+            if covered < end:
+                span = [covered, end]
+            else:
+                span = None
 
-    # Time condition is compulsory and there are default values anyway
-    if started:
-        timecond = "WHERE startTime BETWEEN :begin AND :end"
+    # Fall back on the local table for the rest
+    if span is not None:
+        # DDD if we had wanted HEPSPEC06 in days
+        sel = "SELECT TRUNC(%s, '%s')%s, %s" % (grp, binning, keysel, col)
+        tab = "FROM %s" % table
+        timecond = "WHERE %s >= :begin AND %s < :end" % (grp, grp)
+        grpexpr = "GROUP BY TRUNC(%s, '%s')%s" % (grp, binning, keysel)
+        stmt = '%s %s %s AND %s AND %s %s %s' % \
+            (sel, tab, timecond, STTCOND, CPUCOND, conds, grpexpr)
+        stmts.append((stmt, span + [EPOCH] + params))
+
+    return stmts
+
+def dbread(logger, connfile, table, begin, end, crits, users, hosts, title,
+           binning, count, walltime, waiting, cumuwaiting, started, plan, norm,
+           rollup=True, cache=None):
+    '''
+    Connect to DB, run query and return sorted datetime64 x values and y
+    values as two separate arrays.
+
+    Whatever part of the time range the rollup table covers is read from it
+    rather than from the local table, unless told otherwise, as long as the
+    binning is coarse enough and finished jobs are being looked at. If a
+    Cache instance is passed as argument, only the bins it doesn't have yet
+    are queried. Cumulative waiting time is left to the caller to work out
+    once the gaps are filled.
+    '''
+    import numpy as npy
+
+    # Connect
+    c = common.connect(logger, os.path.expanduser(connfile))
+    cursor = c.cursor()
+
+    # Queues or groups
+    critcond, crits = mkcritcond(crits)
+
+    # Submit hosts
+    hostcond, hosts = mkcond(hosts, 'fromHost')
+
+    # Users
+    usercond, users = mkcond(users, 'userName')
+
+    grp, col = localcol(count, walltime, waiting, cumuwaiting, started, norm)
+    if rollup and not started:
+        rcol = rollupcol(count, walltime, waiting, cumuwaiting, norm)
     else:
-        timecond = "WHERE eventTime BETWEEN :begin AND :end"
+        rcol = None
+
+    # Time condition is compulsory and there are default values anyway
     span = [datetime.date.fromtimestamp(begin),
             datetime.date.fromtimestamp(end)]
+    begin, end = [datetime.datetime(*d.timetuple()[:3]) for d in span]
+    conds = critcond + hostcond + usercond
+
+    def query(begin, end):
+        '''
+        Query bins from begin to end (excluded) and return a dictionary of
+        y values by x value.
+        '''
+        rows = {}
+        for stmt, params in binstmts(cursor, table, binning, grp, col, rcol,
+                                     begin, end, conds, crits + hosts + users):
+            if plan:
+                mkplan(cursor, stmt)
+
+            # Bins may straddle the rollup and local tables
+            cursor.execute(stmt, params)
+            for x, y in cursor:
+                rows[x] = rows.get(x, 0) + y
+        return rows
+
+    print "Querying..."
+    t = time.time()
+    if cache is None:
+        rows = query(begin, end)
+    else:
+        # Cumulative waiting time is worked out from waiting time
+        measure = [m for m, b in (('count', count), ('started', started),
+                                  ('walltime', walltime),
+                                  ('waiting', waiting or cumuwaiting))
+                   if b] or ['cpu']
+        key = cache.key(str(table), conds, crits, hosts, users, binning,
+                        measure[0], norm)
+        rows = cache.get(key, begin, end, binning, query)
+
+    # Sort and store values
+    xs = npy.array(rows.keys(), dtype='datetime64[s]')
+    ys = npy.array(rows.values(), dtype=float)
+    order = npy.argsort(xs)
+    xs, ys = xs[order], ys[order]
+    print "Queried in %f s" % (time.time() - t)
+    datawrite(title, xs, ys)
+
+    return xs, ys
+
+def pctcol(measure, quantiles):
+    '''
+    Return the expression a percentile measure is computed from, the extra
+    conditions it needs and the PERCENTILE_CONT SELECT expressions of the
+    quantiles passed as argument.
+    '''
+
+    if measure == 'waiting':
+        expr = "(startTime - submitTime) * 24"
+        conds = ''
+    else:
+        # As in common.TSHCOND, jobs with no walltime left out
+        expr = "%s / %s" % (common.CPUTIME, common.WALLTIME)
+        conds = " AND eventTime > startTime AND %s" % common.HOSTCOND
+    cols = ["PERCENTILE_CONT(%s) WITHIN GROUP (ORDER BY %s)" % (q / 100., expr)
+            for q in quantiles]
+    return expr, conds, cols
+
+def pctdbread(logger, connfile, table, begin, end, crits, users, hosts, title,
+              binning, measure, quantiles, plan):
+    '''
+    Connect to DB, have it work out percentiles of a measure per bin and
+    return sorted datetime64 x values and an array of y values with one
+    column per quantile.
+
+    Expects the measure (any of PCTMEASURES) and a list of quantiles in
+    percent, and otherwise the same arguments as dbread(). Percentiles
+    don't add up, so the rollup table and the cache can't be used: bins
+    are worked out by a single aggregate query over the local table.
+    '''
+    import numpy as npy
 
-    grpexpr = "GROUP BY TRUNC(%s, '%s')" % (grp, binning)
+    # Connect
+    c = common.connect(logger, os.path.expanduser(connfile))
+    cursor = c.cursor()
+
+    # Queues or groups
+    critcond, crits = mkcritcond(crits)
+
+    # Submit hosts
+    hostcond, hosts = mkcond(hosts, 'fromHost')
+
+    # Users
+    usercond, users = mkcond(users, 'userName')
+
+    _, conds, cols = pctcol(measure, quantiles)
+
+    # Time condition is compulsory and there are default values anyway
+    span = [datetime.date.fromtimestamp(begin),
+            datetime.date.fromtimestamp(end)]
+    span = [datetime.datetime(*d.timetuple()[:3]) for d in span]
 
-    # Statement
-    stmt = '%s %s %s AND %s AND %s %s %s' % \
-        (sel, tab, timecond, STTCOND, CPUCOND,
+    sel = "SELECT TRUNC(eventTime, '%s'), %s" % (binning, ', '.join(cols))
+    tab = "FROM %s" % table
+    timecond = "WHERE eventTime >= :begin AND eventTime < :end"
+    grpexpr = "GROUP BY TRUNC(eventTime, '%s')" % binning
+    stmt = '%s %s %s AND %s AND %s%s %s %s' % \
+        (sel, tab, timecond, STTCOND, CPUCOND, conds,
          critcond + hostcond + usercond, grpexpr)
     params = span + [EPOCH] + crits + hosts + users
 
@@ -304,43 +759,518 @@ def dbread(logger, connfile, table, begin, end, crits, users, hosts, title,
     t = time.time()
     if plan:
         mkplan(cursor, stmt)
-
     cursor.execute(stmt, params)
-
-    # Run query and store values
-    f = open(title.translate(TRANS) + '.data', 'w')
-    xs, ys = [], []
-    # FIXME What's this i here for?
-    for i, (x, y) in enumerate(sorted(cursor, key=lambda r: r[0])):
-        print >>f, '%d %f' % (time.mktime(x.timetuple()), y)
-        xs.append(x)
-        if cumuwaiting:
-            try:
-                ys.append(ys[-1] + y)
-            except IndexError: # First time
-                ys.append(y)
-        else:
-            ys.append(y)
+    rows = sorted(cursor.fetchall())
     print "Queried in %f s" % (time.time() - t)
-    f.close()
 
+    xs = npy.array([r[0] for r in rows], dtype='datetime64[s]')
+    ys = npy.array([r[1:] for r in rows], dtype=float).reshape(len(rows),
+                                                               len(cols))
+    datawrite(title, xs, ys)
     return xs, ys
 
+def trunc(ts, binning):
+    '''
+    Return the datetime64 bins of an array of extract seconds the way
+    Oracle's TRUNC would work them out with the binning passed as argument,
+    weeks starting on the weekday of 1 January.
+    '''
+    import numpy as npy
+
+    xs = ts.astype('datetime64[s]')
+    if binning == 'WW':
+        jan1 = xs.astype('datetime64[Y]').astype('datetime64[D]')
+        days = (xs.astype('datetime64[D]') - jan1).astype('int64')
+        return (jan1 + days // 7 * 7).astype('datetime64[s]')
+    units = {'MI': 'm', 'HH24': 'h', 'DDD': 'D'}
+    return xs.astype('datetime64[%s]' % units[binning]).astype('datetime64[s]')
+
+def codematch(ext, rows, col, patterns):
+    '''
+    Return a boolean array telling which rows of a dictionary-encoded
+    column match any of the patterns passed as argument, which may have
+    %-wildcards.
+    '''
+    import numpy as npy
+
+    matches = [likere(p).match for p in patterns]
+    codes = [i for i, s in enumerate(ext.dictionary(col))
+             if [m for m in matches if m(s)]]
+    return npy.in1d(rows[col], codes)
+
+def extractrows(directory, table, begin, end, crits, users, hosts, cols,
+                tcol='eventTime'):
+    '''
+    Return a dictionary of arrays of the columns passed as argument, for
+    the rows of the table extract which dbread() would query.
+
+    Expects the extract directory and otherwise the same criteria as
+    dbread(), with begin and end datetimes, as well as the time column to
+    select rows by.
+    '''
+    ext = extract.Extract(directory, table)
+
+    # Queues or groups
+    _, crits = mkcritcond(crits)
+
+    # Submit hosts
+    _, hosts = mkcond(hosts, 'fromHost')
+
+    # Users
+    _, users = mkcond(users, 'userName')
+
+    need = set(cols + ['startTime', 'ru_stime', 'ru_utime'])
+    if crits:
+        need.update(['queue', 'chargedSAAP'])
+    if hosts:
+        need.add('fromHost')
+    if users:
+        need.add('userName')
+    rows = ext.columns(list(need), begin, end, tcol)
+
+    # STTCOND and CPUCOND
+    mask = (rows['startTime'] != extract.EPOCHSECS) & \
+           (rows['ru_stime'] != -1) & (rows['ru_utime'] != -1)
+    if crits:
+        saaps = [c for c in crits if c[0] == '/']
+        queues = [c for c in crits if c[0] != '/']
+        mask &= codematch(ext, rows, 'chargedSAAP', saaps) | \
+                codematch(ext, rows, 'queue', queues)
+    if hosts:
+        mask &= codematch(ext, rows, 'fromHost', hosts)
+    if users:
+        mask &= codematch(ext, rows, 'userName', users)
+
+    return dict([(col, rows[col][mask]) for col in cols])
+
+def extractread(directory, table, begin, end, crits, users, hosts, title,
+                binning, count, walltime, waiting, cumuwaiting, started,
+                norm):
+    '''
+    Answer what dbread() would from the table extract in the directory
+    passed as first argument: return sorted datetime64 x values and y
+    values as two separate arrays.
+    '''
+    import numpy as npy
+
+    # Group
+    if started:
+        grp = 'startTime'
+    else:
+        grp = 'eventTime'
+
+    if count or started:
+        cols = []
+    elif walltime:
+        cols = ['eventTime', 'startTime']
+    elif waiting or cumuwaiting:
+        cols = ['startTime', 'submitTime']
+    else:
+        cols = ['ru_stime', 'ru_utime']
+    if norm is not None:
+        cols.append('hostFactor')
+
+    # Time condition is compulsory and there are default values anyway
+    span = [datetime.date.fromtimestamp(begin),
+            datetime.date.fromtimestamp(end)]
+    begin, end = [datetime.datetime(*d.timetuple()[:3]) for d in span]
+
+    print "Reading extract..."
+    t = time.time()
+    rows = extractrows(directory, table, begin, end, crits, users, hosts,
+                       list(set(cols + [grp])), grp)
+
+    # Values in days, as in dbread()
+    if count or started:
+        ys = npy.ones(len(rows[grp]))
+    elif walltime:
+        ys = (rows['eventTime'] - rows['startTime']) / 86400.
+    elif waiting or cumuwaiting:
+        ys = (rows['startTime'] - rows['submitTime']) / 86400.
+    else:
+        ys = (rows['ru_stime'] + rows['ru_utime']) / 86400.
+    if norm is not None and not (count or started):
+        ys = ys * rows['hostFactor'] * float(norm)
+
+    xs = trunc(rows[grp], binning)
+    bins = npy.unique(xs)
+    ys = reindex(bins, xs, ys)
+    print "Read in %f s" % (time.time() - t)
+    datawrite(title, bins, ys)
+
+    return bins, ys
+
+def walldistextractread(directory, table, begin, end, crits, users, hosts,
+                        title, norm, crop=None):
+    '''
+    Answer what walldistdbread() would from the table extract in the
+    directory passed as first argument: return the unit name, an array of
+    job counts and an array of bin edges, or None if there are no jobs.
+    '''
+    import numpy as npy
+
+    cols = ['eventTime', 'startTime']
+    if norm is not None:
+        cols.append('hostFactor')
+
+    # Time condition is compulsory and there are default values anyway,
+    # both ends included as in walldistdbread()
+    span = [datetime.date.fromtimestamp(begin),
+            datetime.date.fromtimestamp(end)]
+    begin, end = [datetime.datetime(*d.timetuple()[:3]) for d in span]
+
+    print "Reading extract..."
+    t = time.time()
+    rows = extractrows(directory, table, begin,
+                       end + datetime.timedelta(seconds=1), crits, users,
+                       hosts, cols)
+
+    # Hours
+    xs = (rows['eventTime'] - rows['startTime']) / 3600.
+    if norm is not None:
+        xs = xs * rows['hostFactor'] * float(norm)
+    if len(xs) == 0:
+        return None
+    xmax = xs.max()
+
+    # Crop (logic in hours)
+    if crop and crop / 60. / 60 < xmax:
+        xmax = crop / 60. / 60
+
+    unit, scale, xright, nbins = wallbins(xmax)
+    n, bins = npy.histogram(xs * scale, bins=nbins, range=(0, xright))
+    print "Read in %f s" % (time.time() - t)
+    npy.savetxt(title.translate(TRANS) + '.data',
+                npy.column_stack((bins[:-1], n)), fmt=['%f', '%d'])
+    return unit, n, bins
+
+def datawrite(title, xs, ys):
+    '''
+    Write x and y arrays to the data file of the title passed as argument,
+    for a later run of this script to read with fileread(). The y array may
+    have several columns. x values are written as UNIX timestamps of local
+    times, as they always have been.
+    '''
+    import numpy as npy
+
+    stamps = npy.array([ts(x) for x in xs.astype(object)], dtype='int64')
+    columns = npy.column_stack((stamps, ys))
+    npy.savetxt(title.translate(TRANS) + '.data', columns,
+                fmt=['%d'] + ['%f'] * (columns.shape[1] - 1))
+
 def fileread(title):
     '''
     Read data file which has been generated by a previous run of this script
-    to build and return a tuple of x and y lists.
+    to build and return a tuple of x and y arrays.
     '''
+    import numpy as npy
 
-    f = open(title.translate(TRANS) + '.data', 'r')
-    xs, ys = [], []
-    for l in f:
-        x, y = l.split()
-        xs.append(datetime.date.fromtimestamp(float(x)))
-        ys.append(float(y))
-    f.close()
+    data = npy.loadtxt(title.translate(TRANS) + '.data', ndmin=2)
+    if len(data) == 0:
+        return npy.array([], dtype='datetime64[s]'), npy.array([])
+    xs = npy.array([datetime.datetime.fromtimestamp(x) for x in data[:, 0]],
+                   dtype='datetime64[s]')
+    return xs, data[:, 1]
 
-    return xs, ys
+def matches(keys, what):
+    '''
+    Return a boolean array telling which grouped rows match a queue or
+    group list.
+
+    Expects a dictionary of key value arrays by column name (queue and
+    chargedSAAP) and a comma-separated list of queues or groups, which may
+    have %-wildcards.
+    '''
+    import numpy as npy
+
+    mask = npy.zeros(len(keys.values()[0]), dtype=bool)
+    for crit in what.split(','):
+        if crit[0] == '/':
+            column = keys['chargedSAAP']
+        else:
+            column = keys['queue']
+        if '%' in crit or crit[0] == '/':
+            match = likere(crit).match
+            mask |= npy.array([v is not None and match(v) is not None
+                               for v in column], dtype=bool)
+        else:
+            mask |= column == crit
+    return mask
+
+def reindex(grid, xs, ys):
+    '''
+    Return the sums of the ys values of each bin of the sorted grid array
+    passed as first argument, all of the xs values being in the grid.
+    '''
+    import numpy as npy
+
+    return npy.bincount(npy.searchsorted(grid, xs), weights=ys,
+                        minlength=len(grid))
+
+def align(series, binning):
+    '''
+    Return a common bin grid array and an array of y values on that grid
+    per series, gaps being filled with 0.
+
+    Expects a list of (xs, ys) tuples of sorted datetime64 and value arrays
+    and the binning.
+    '''
+    import numpy as npy
+
+    if series:
+        xs = npy.unique(npy.concatenate([xs for xs, _ in series]))
+    else:
+        xs = npy.array([], dtype='datetime64[s]')
+    grid, _ = fillgaps(xs, npy.zeros(len(xs)), binning)
+    return grid, npy.array([reindex(grid, xs, ys) for xs, ys in series])
+
+def stackdbread(logger, connfile, table, begin, end, stack, users, hosts,
+                binning, count, walltime, waiting, cumuwaiting, started, plan,
+                norm, rollup=True):
+    '''
+    Connect to DB, run a single query grouped by the queue or chargedSAAP
+    column, or both, and return a common bin grid array and an array of y
+    values on that grid per queue or group.
+
+    Expects the comma-separated list of queues or groups to stack, which
+    may have %-wildcards, and otherwise the same arguments as dbread().
+    Each series is written to a data file titled after its queue or group
+    for a later --file run to read from.
+    '''
+    import numpy as npy
+
+    # Connect
+    c = common.connect(logger, os.path.expanduser(connfile))
+    cursor = c.cursor()
+
+    crits = [s.strip() for s in stack.split(',')]
+    keys = []
+    if [crit for crit in crits if crit[0] != '/']:
+        keys.append('queue')
+    if [crit for crit in crits if crit[0] == '/']:
+        keys.append('chargedSAAP')
+
+    # Submit hosts
+    hostcond, hosts = mkcond(hosts, 'fromHost')
+
+    # Users
+    usercond, users = mkcond(users, 'userName')
+
+    grp, col = localcol(count, walltime, waiting, cumuwaiting, started, norm)
+    if rollup and not started:
+        rcol = rollupcol(count, walltime, waiting, cumuwaiting, norm)
+    else:
+        rcol = None
+
+    # Time condition is compulsory and there are default values anyway
+    span = [datetime.date.fromtimestamp(begin),
+            datetime.date.fromtimestamp(end)]
+    begin, end = [datetime.datetime(*d.timetuple()[:3]) for d in span]
+
+    print "Querying..."
+    t = time.time()
+    rows = []
+    for stmt, params in binstmts(cursor, table, binning, grp, col, rcol,
+                                 begin, end, hostcond + usercond,
+                                 hosts + users, keys):
+        if plan:
+            mkplan(cursor, stmt)
+        cursor.execute(stmt, params)
+        rows.extend(cursor.fetchall())
+    print "Queried in %f s" % (time.time() - t)
+
+    # Columns of the grouped rows
+    columns = zip(*rows) or [[]] * (len(keys) + 2)
+    xs = npy.array(columns[0], dtype='datetime64[s]')
+    ys = npy.array(columns[-1], dtype=float)
+    values = dict([(k, npy.array(v, dtype=object))
+                   for k, v in zip(keys, columns[1:-1])])
+
+    # Bins may straddle the rollup and local tables
+    series = []
+    for crit in crits:
+        mask = matches(values, crit)
+        bins = npy.unique(xs[mask])
+        series.append((bins, reindex(bins, xs[mask], ys[mask])))
+        datawrite(crit, *series[-1])
+    return align(series, binning)
+
+def measureflags(measure):
+    '''
+    Return the (count, walltime, waiting, cumuwaiting, started) flags of the
+    measure name passed as argument, as found in batch plot definitions.
+    '''
+    if measure not in MEASURES:
+        raise ValueError("Unknown measure %s (any of %s)" %
+                         (measure, ', '.join(MEASURES)))
+    return tuple([measure == m for m in MEASURES[1:]])
+
+def render(job):
+    '''
+    Plot and save a time series.
+
+    Expects a (title, xs, ys, flags, colour, bar, log, nonorm) tuple, xs
+    being datetime64 values and flags being the (count, walltime, waiting,
+    cumuwaiting, started) tuple of the measure plotted.
+    '''
+    import matplotlib.pyplot as plt
+
+    title, xs, ys, flags, colour, bar, log, nonorm = job
+    count, walltime, waiting, cumuwaiting, started = flags
+    xs = xs.astype(object) # Plain datetimes for matplotlib
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    if bar:
+        ax.bar(xs, ys, color=colour, width=BARW / max(len(ys), 1),
+               linewidth=0, log=log)
+    else:
+        if log:
+            ax.semilogy(xs, ys, colour)
+        else:
+            ax.plot(xs, ys, colour)
+    fig.autofmt_xdate()
+
+    plt.title(title)
+    labels(plt, count, walltime, waiting, cumuwaiting, started, nonorm)
+
+    if count:
+        plt.savefig(title.translate(TRANS) + '-count')
+    elif walltime:
+        plt.savefig(title.translate(TRANS) + '-walltime')
+    elif waiting:
+        plt.savefig(title.translate(TRANS) + '-waiting')
+    elif cumuwaiting:
+        plt.savefig(title.translate(TRANS) + '-cumuwaiting')
+    elif started:
+        plt.savefig(title.translate(TRANS) + '-started')
+    else:
+        plt.savefig(title.translate(TRANS))
+    plt.close(fig)
+    return title
+
+def likere(pattern):
+    '''
+    Return a compiled regular expression matching what the SQL LIKE pattern
+    passed as argument does.
+    '''
+    return re.compile('^%s$' % '.*'.join([re.escape(p)
+                                          for p in pattern.split('%')]))
+
+def batchread(path, opts):
+    '''
+    Read the plot definitions file passed as argument and return a list of
+    dictionaries, one per section, with title, what, measure, binning,
+    colour, bar and log keys. Settings missing from a section default to
+    the command line options passed as second argument.
+    '''
+    defaults = {'what': '', 'measure': 'cpu', 'binning': opts.binning,
+                'colour': opts.colour, 'bar': str(bool(opts.bar)),
+                'log': str(bool(opts.log))}
+    cfg = ConfigParser.RawConfigParser(defaults)
+    if not cfg.read([path]):
+        raise IOError("Couldn't read plot definitions from %s" % path)
+
+    plots = []
+    for section in cfg.sections():
+        plot = {'title': section}
+        for k in ('what', 'measure', 'binning', 'colour'):
+            plot[k] = cfg.get(section, k)
+        for k in ('bar', 'log'):
+            plot[k] = cfg.getboolean(section, k)
+        measureflags(plot['measure'])
+        if plot['binning'] not in DELTA:
+            raise ValueError("Unknown binning %s in %s" %
+                             (plot['binning'], section))
+        plots.append(plot)
+    return plots
+
+def batch(logger, opts, norm):
+    '''
+    Generate all the plots defined in the file of the --batch option.
+
+    Plots are grouped by measure and binning and each group is queried
+    once, with queue and chargedSAAP as extra group keys, over a single DB
+    connection. Each plot is then worked out from the rows of its group
+    matching its queues or groups and rendered in a pool of worker
+    processes. The users and submit hosts options apply to all plots.
+    '''
+    import multiprocessing
+    import numpy as npy
+
+    plots = batchread(opts.batch, opts)
+    groups = {}
+    for plot in plots:
+        groups.setdefault((plot['measure'], plot['binning']), []).append(plot)
+
+    # Connect once and for all
+    c = common.connect(logger, os.path.expanduser(opts.connfile))
+    cursor = c.cursor()
+
+    hostcond, hosts = mkcond(opts.fromhosts, 'fromHost')
+    usercond, users = mkcond(opts.users, 'userName')
+    span = [datetime.date.fromtimestamp(opts.begin),
+            datetime.date.fromtimestamp(opts.end)]
+    begin, end = [datetime.datetime(*d.timetuple()[:3]) for d in span]
+
+    jobs = []
+    for (measure, binning), members in sorted(groups.items()):
+        flags = measureflags(measure)
+        count, walltime, waiting, cumuwaiting, started = flags
+        grp, col = localcol(count, walltime, waiting, cumuwaiting, started,
+                            norm)
+        if opts.norollup or started:
+            rcol = None
+        else:
+            rcol = rollupcol(count, walltime, waiting, cumuwaiting, norm)
+
+        print "Querying %s by %s..." % (measure, binning)
+        t = time.time()
+        rows = []
+        for stmt, params in binstmts(cursor, opts.table, binning, grp, col,
+                                     rcol, begin, end, hostcond + usercond,
+                                     hosts + users, ['queue', 'chargedSAAP']):
+            if opts.plan:
+                mkplan(cursor, stmt)
+            cursor.execute(stmt, params)
+            rows.extend(cursor.fetchall())
+        print "Queried in %f s" % (time.time() - t)
+
+        # Columns of the grouped rows
+        if rows:
+            xs, queues, saaps, ys = zip(*rows)
+        else:
+            xs, queues, saaps, ys = [], [], [], []
+        xs = npy.array(xs, dtype='datetime64[s]')
+        ys = npy.array(ys, dtype=float)
+        keys = {'queue': npy.array(queues, dtype=object),
+                'chargedSAAP': npy.array(saaps, dtype=object)}
+
+        # Fan out
+        for plot in members:
+            if plot['what']:
+                mask = matches(keys, plot['what'])
+            else:
+                mask = npy.ones(len(xs), dtype=bool)
+
+            # Sum the keys of each bin
+            bins = npy.unique(xs[mask])
+            sums = reindex(bins, xs[mask], ys[mask])
+            datawrite(plot['title'], bins, sums)
+
+            bins, sums = fillgaps(bins, sums, binning)
+            if cumuwaiting:
+                sums = npy.cumsum(sums)
+            jobs.append((plot['title'], bins, sums, flags, plot['colour'],
+                         plot['bar'], plot['log'], opts.nonorm))
+    c.close()
+
+    print "Plotting %d plots..." % len(jobs)
+    pool = multiprocessing.Pool(opts.workers)
+    for title in pool.imap_unordered(render, jobs):
+        logger.info("Plotted %s" % title)
+    pool.close()
+    pool.join()
 
 def main():
     # Args
@@ -374,7 +1304,8 @@ def main():
     p.add_option("-f", "--file", action='store_true', default=False, help=help)
     help='table (defaults to %s)' % common.LOCALTAB
     p.add_option("-r", "--table", default=common.LOCALTAB, help=help)
-    help = "stack plots for comma-sep'd list of data title (file without ext)"
+    help = "stack plots for comma-sep'd list of queues or groups (supports"
+    help += " %-wildcards), or of data titles (file without ext) with --file"
     p.add_option("-s", "--stack", help=help)
     help = 'plot finished job count instead of CPU time'
     p.add_option("-n", "--count", action='store_true', help=help)
@@ -392,13 +1323,48 @@ def main():
     p.add_option("--walldist", action='store_true', help=help)
     help = 'percent waiting time cumulative distribution (with --walldist)'
     p.add_option("-q", "--percent", action='store_true', help=help)
+    help = 'plot percentiles of %s per bin' % ' or '.join(PCTMEASURES)
+    p.add_option("--percentiles", choices=PCTMEASURES, metavar='MEASURE',
+                 help=help)
+    help = "comma-sep'd list of percentiles to plot with --percentiles"
+    help += ' (defaults to %s)' % QUANTILES
+    p.add_option("--quantiles", default=QUANTILES, help=help)
     help = 'binning (any of MI, HH24, DDD, WW, defaults to %s)' % BINNING
     # 'a' for aggregate
     p.add_option("-a", "--binning", default=BINNING, help=help)
     p.add_option("-p", "--plan", action='store_true', help='explain query plan')
     p.add_option("-z", "--nonorm", action='store_true', help="don't normalise")
+    help = "don't read from the %s rollup table, only from --table" % \
+        common.ROLLUPTAB
+    p.add_option("--norollup", action='store_true', help=help)
+    help = 'query cache directory (defaults to %s)' % CACHEDIR
+    p.add_option("--cachedir", default=CACHEDIR, help=help)
+    help = 'query cache size in megabytes (defaults to %d)' % CACHESIZE
+    p.add_option("--cachesize", type='int', default=CACHESIZE, help=help)
+    p.add_option("--nocache", action='store_true', help="don't cache queries")
+    help = 'how many hours cached query results may be used for, for late '
+    help += 'rows to show (defaults to %d)' % CACHEEXPIRY
+    p.add_option("--cacheexpiry", type='int', default=CACHEEXPIRY, help=help)
+    help = "generate all the plots defined in this file, one section each"
+    help += " (see the example in cpuhours/plots)"
+    p.add_option("--batch", metavar='SPEC', help=help)
+    help = 'number of batch plot rendering worker processes (defaults to %d)'
+    p.add_option("--workers", type='int', default=WORKERS,
+                 help=help % WORKERS)
+    help = "where to read from: db or a table extract as written by "
+    help += "extract.py (plain and --walldist plots only, defaults to db)"
+    p.add_option("--source", choices=('db', 'extract'), default='db',
+                 help=help)
+    help = 'table extract directory (defaults to %s)' % extract.EXTRACTDIR
+    p.add_option("--extractdir", default=extract.EXTRACTDIR, help=help)
     opts, args = p.parse_args()
 
+    if opts.source == 'extract' and \
+       (opts.batch or opts.stack or opts.percentiles):
+        print >>sys.stderr, "Only plain and --walldist plots can be read from"
+        print >>sys.stderr, "an extract"
+        return 1
+
     # Import later to avoid X errors when you only want to get the help menu
     import numpy as npy
     import matplotlib.pyplot as plt
@@ -423,15 +1389,35 @@ def main():
     else:
         norm = cfg.get('main', 'factor')
 
-    # Stack only works with data files (not DB -- too heavy)
-    if opts.stack is not None:
-        # Collect all yss
-        print "Loading data..."
-        yss = []
+    if opts.batch is not None:
+        try:
+            batch(logger, opts, norm)
+        except (IOError, ValueError, ConfigParser.Error,
+                common.AcctDBError), e:
+            print >>sys.stderr, e
+            return 1
+    elif opts.stack is not None:
+        title = opts.title or opts.stack
         files = [f.strip() for f in opts.stack.split(',')]
-        for f in files:
-            xs, ys = fileread(f)
-            yss.append(ys)
+
+        # Align all series on a common bin grid
+        try:
+            if opts.file:
+                print "Loading data..."
+                xs, yss = align([fileread(f) for f in files], opts.binning)
+            else:
+                xs, yss = stackdbread(logger, opts.connfile, opts.table,
+                                      opts.begin, opts.end, opts.stack,
+                                      opts.users, opts.fromhosts,
+                                      opts.binning, opts.count, opts.walltime,
+                                      opts.waiting, opts.cumuwaiting,
+                                      opts.started, opts.plan, norm,
+                                      not opts.norollup)
+        except common.AcctDBError, e:
+            print >>sys.stderr, e
+            return 1
+        if opts.cumuwaiting:
+            yss = npy.cumsum(yss, axis=1)
         yss = npy.cumsum(yss, axis=0)
 
         # Stack it all up
@@ -440,6 +1426,7 @@ def main():
         ax = fig.add_subplot(111)
 
         colours = cm.prism(npy.arange(0, 1, 1. / len(yss)))
+        xs = xs.astype(object) # Plain datetimes for matplotlib
         ax.fill_between(xs, yss[0], 0, facecolor=colours[0])
         for i, ys in enumerate(islice(yss, 1, None), 1):
             ax.fill_between(xs, yss[i - 1], yss[i], facecolor=colours[i])
@@ -453,64 +1440,95 @@ def main():
         labels(plt, opts.count, opts.walltime, opts.waiting, opts.cumuwaiting,
                opts.started, opts.nonorm)
         fig.autofmt_xdate()
-        plt.title(opts.stack)
-        plt.savefig(opts.stack + '-stacked.pdf')
+        plt.title(title)
+        plt.savefig(title.translate(TRANS) + '-stacked.pdf')
+    elif opts.percentiles is not None:
+        # Set a title
+        title = mktitle(opts.title, opts.what, opts.users, opts.fromhosts)
+
+        try:
+            quantiles = [float(q) for q in opts.quantiles.split(',')]
+        except ValueError:
+            quantiles = []
+        if not quantiles or [q for q in quantiles if not 0 <= q <= 100]:
+            print >>sys.stderr, "Bad percentiles: %s" % opts.quantiles
+            return 1
+
+        # Get data
+        try:
+            xs, ys = pctdbread(logger, opts.connfile, opts.table, opts.begin,
+                               opts.end, opts.what, opts.users, opts.fromhosts,
+                               title, opts.binning, opts.percentiles,
+                               quantiles, opts.plan)
+        except common.AcctDBError, e:
+            print >>sys.stderr, e
+            return 1
+
+        # Break lines where there are no jobs rather than drop to 0
+        xs, ys = fillgaps(xs, ys, opts.binning, npy.nan)
+
+        # Plot
+        print "Plotting..."
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        xs = xs.astype(object) # Plain datetimes for matplotlib
+        for i, q in enumerate(quantiles):
+            if opts.log:
+                ax.semilogy(xs, ys[:, i], label='%gth percentile' % q)
+            else:
+                ax.plot(xs, ys[:, i], label='%gth percentile' % q)
+        plt.legend()
+        fig.autofmt_xdate()
+
+        plt.title(title)
+        if opts.percentiles == 'waiting':
+            plt.ylabel('waiting time (hours)')
+        else:
+            plt.ylabel('CPU efficiency')
+        plt.axis(ymin=0)
+        plt.savefig(title.translate(TRANS) + '-%s-percentiles' %
+                    opts.percentiles)
     elif opts.walldist:
         try:
             # Set a title
             title = mktitle(opts.title, opts.what, opts.users, opts.fromhosts)
 
             # Get data
-            xs = walldistdbread(logger, opts.connfile, opts.table, opts.begin,
-                                opts.end, opts.what, opts.users, opts.fromhosts,
-                                title, opts.plan, norm)
+            if opts.source == 'extract':
+                hist = walldistextractread(opts.extractdir, opts.table,
+                                           opts.begin, opts.end, opts.what,
+                                           opts.users, opts.fromhosts, title,
+                                           norm, opts.crop)
+            else:
+                hist = walldistdbread(logger, opts.connfile, opts.table,
+                                      opts.begin, opts.end, opts.what,
+                                      opts.users, opts.fromhosts, title,
+                                      opts.plan, norm, opts.crop)
+            if hist is None:
+                print >>sys.stderr, "No jobs to plot"
+                return 1
+            unit, n, bins = hist
 
             # XXX What not use label()?
 
-            # Crop (logic in hours)
-            if opts.crop and opts.crop / 60 / 60 < max(xs):
-                xmax = opts.crop / 60 / 60
-            else:
-                xmax = max(xs)
-
-            # Pick sensible unit and binning (logic in hours)
-            if xmax < .5:           # If < 30 minutes, then 10s/bin
-                unit = 'minute'         # 30 minutes in minutes easy to fathom
-                xs = [x * 60 for x in xs]
-                xright = 30
-                binning = xright / (10. / 60)
-            elif xmax < 3:          # If < 3 hour,     then 1min/bin
-                unit = 'minute'         # 3 hours in minutes easy to fathom
-                xs = [x * 60 for x in xs]
-                xright = 180
-                binning = xright
-            elif xmax < 24:         # If < 24 hour,    then 10min/bin
-                unit = 'hours'          # 24 hours in hours easy to fathom
-                xright = 24
-                binning = xright / (10. / 60)
-            else:                   # Otherwise,            1h/bin
-                unit = 'hours'          # Hours should still be OK
-                xright = math.ceil(xmax)
-                binning = xright
-
             # Plot histogram
             print "Plotting..."
             fig = plt.figure()
             ax1 = fig.add_subplot(111)
             for l in ax1.get_xticklabels():
                 l.set_rotation(30)
-            n, bins, _ = ax1.hist(xs, bins=binning, log=opts.log,
-                color=opts.colour, range=(0, xright))
+            ax1.bar(bins[:-1], n, width=bins[1] - bins[0], log=opts.log,
+                    color=opts.colour, align='edge')
             plt.ylabel('number of jobs')
             plt.xlabel(unit)
 
             # Plot cumulated derivative
             ax2 = plt.twinx()
+            d = npy.cumsum(n)
             if opts.percent:
-                d = [float(v) / sum(n) * 100 for v in npy.cumsum(n)]
+                d = d / n.sum() * 100
                 plt.ylabel('cumulative derivative (%)')
             else:
-                d = [float(v) for v in npy.cumsum(n)]
                 plt.ylabel('cumulative derivative (absolute)')
             if opts.log:
                 # Not 'log' because it misbehaves with plt.axis()
@@ -520,7 +1538,7 @@ def main():
 
             plt.title(title)
             plt.savefig(title.translate(TRANS) + '-walldist')
-        except common.AcctDBError, e:
+        except (IOError, common.AcctDBError), e:
             print >>sys.stderr, e
             return 1
     else:
@@ -531,49 +1549,39 @@ def main():
         try:
             if opts.file:
                 xs, ys = fileread(title)
+            elif opts.source == 'extract':
+                xs, ys = extractread(opts.extractdir, opts.table, opts.begin,
+                                     opts.end, opts.what, opts.users,
+                                     opts.fromhosts, title, opts.binning,
+                                     opts.count, opts.walltime, opts.waiting,
+                                     opts.cumuwaiting, opts.started, norm)
             else:
+                cache = None
+                if not opts.nocache:
+                    try:
+                        cache = Cache(opts.cachedir, opts.cachesize,
+                                      expiry=opts.cacheexpiry)
+                    except OSError, e:
+                        print >>sys.stderr, "Not caching queries: %s" % e
                 xs, ys = dbread(logger, opts.connfile, opts.table, opts.begin,
                                 opts.end, opts.what, opts.users, opts.fromhosts,
                                 title, opts.binning, opts.count, opts.walltime,
                                 opts.waiting, opts.cumuwaiting, opts.started,
-                                opts.plan, norm)
-        except common.AcctDBError, e:
+                                opts.plan, norm, not opts.norollup, cache)
+        except (IOError, common.AcctDBError), e:
             print >>sys.stderr, e
             return 1
 
-        # Fill in missing zeros if any
-        fillgaps(xs, ys, opts.binning)
+        # Fill in missing zeros if any, then accumulate
+        xs, ys = fillgaps(xs, ys, opts.binning)
+        if opts.cumuwaiting:
+            ys = npy.cumsum(ys)
 
         # Plot
         print "Plotting..."
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        if opts.bar:
-            ax.bar(xs, ys, color=opts.colour, width=BARW / len(ys),
-                   linewidth=0, log=opts.log)
-        else:
-            if opts.log:
-                ax.semilogy(xs, ys, opts.colour)
-            else:
-                ax.plot(xs, ys, opts.colour)
-        fig.autofmt_xdate()
-
-        plt.title(title)
-        labels(plt, opts.count, opts.walltime, opts.waiting, opts.cumuwaiting,
-               opts.started, opts.nonorm)
-
-        if opts.count:
-            plt.savefig(title.translate(TRANS) + '-count')
-        elif opts.walltime:
-            plt.savefig(title.translate(TRANS) + '-walltime')
-        elif opts.waiting:
-            plt.savefig(title.translate(TRANS) + '-waiting')
-        elif opts.cumuwaiting:
-            plt.savefig(title.translate(TRANS) + '-cumuwaiting')
-        elif opts.started:
-            plt.savefig(title.translate(TRANS) + '-started')
-        else:
-            plt.savefig(title.translate(TRANS))
+        render((title, xs, ys, (opts.count, opts.walltime, opts.waiting,
+                                opts.cumuwaiting, opts.started),
+                opts.colour, opts.bar, opts.log, opts.nonorm))
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,431 @@
+#! /usr/bin/env python
+
+'''
+Extract the local table (and optionally the CE table) to columnar files on
+local disk, for cpuhours.py to read from with --source extract rather than
+from the DB.
+
+Each table extract is a directory of chunks, one per partition (or month if
+the table isn't partitioned) and one per subsequent incremental run. Chunks
+are directories named after the range of times they cover, as low-high UNIX
+timestamps, with one NumPy .npy file per column, so that they can be
+memory-mapped:
+
+- dates become int64 seconds since 1970-01-01 00:00, times being taken as
+  they're stored (0 for NULL),
+- numbers become float64 (NaN for NULL),
+- strings become int32 codes (-1 for NULL) into a per-table dictionary
+  shared by all chunks, stored next to them as a pickled list.
+
+Only times older than the lateness are extracted, for chunks to hold every
+row of their range. Rows inserted later still (e.g. backfilled or drained
+from a spool) are caught by comparing the row count of every chunk with that
+of the DB on each run, and extracting again the chunks which differ.
+'''
+
+import sys
+import os, os.path
+import shutil
+import datetime, time
+import cPickle
+import optparse
+import logging
+import cx_Oracle
+import common
+
+EXTRACTDIR = '~/.batchacct/extract'
+ARRAYSIZE = 5000 # Rows fetched per round trip
+LATENESS = 1 # Hours after which rows are deemed to have all been inserted
+UNIXEPOCH = datetime.datetime(1970, 1, 1)
+# Time column of each table chunks are cut by
+TIMECOLS = {str(common.LOCALTAB): 'eventTime', str(common.CETAB): 'timestamp'}
+
+def seconds(t):
+    '''
+    Return the seconds since 1970-01-01 00:00 of the datetime passed as
+    argument, as it's stored, i.e. without any time zone conversion.
+    '''
+    d = t - UNIXEPOCH
+    return d.days * 24 * 60 * 60 + d.seconds
+
+# EPOCH as the startTime of jobs which never started (see common.STTCOND)
+EPOCHSECS = seconds(datetime.datetime(1970, 1, 1, 1, 0, 0))
+
+def kind(col):
+    '''
+    Return 'date', 'number' or 'string' depending on the type of the DBCol
+    passed as argument.
+    '''
+    type, _, _ = common.parsetype(col.type)
+    if type.upper() == 'DATE':
+        return 'date'
+    elif type.upper() in ('VARCHAR', 'VARCHAR2'):
+        return 'string'
+    else:
+        return 'number'
+
+def chunks(path):
+    '''
+    Return the sorted (low, high, path) tuples of the chunks of the table
+    extract directory passed as argument, low and high being seconds.
+    '''
+    l = []
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            try:
+                low, high = [int(t) for t in name.split('-')]
+            except ValueError: # Dictionaries, temporary chunks
+                continue
+            l.append((low, high, os.path.join(path, name)))
+    l.sort()
+    return l
+
+def ranges(cursor, tab, tcol, begin, horizon):
+    '''
+    Work out the time ranges to extract as chunks: one per partition (or
+    month if the table isn't partitioned) from begin to the horizon.
+
+    Expects a DB cursor, the table name, its time column, a begin datetime
+    (or None to start with the oldest row) and a horizon datetime. Returns
+    a list of (low, high) datetime pairs.
+    '''
+    if begin is None:
+        cursor.execute("SELECT MIN(%s) FROM %s" % (tcol, tab))
+        begin, = cursor.fetchone()
+        if begin is None:
+            return []
+    if begin >= horizon:
+        return []
+
+    bounds = common.partbounds(cursor, tab)
+    if not bounds:
+        # Not partitioned: go by month
+        m = begin.year * 12 + begin.month
+        while True:
+            b = datetime.datetime(m / 12, m % 12 + 1, 1)
+            if b >= horizon:
+                break
+            bounds.append(b)
+            m += 1
+
+    bounds = [b for b in bounds if begin < b < horizon]
+    bounds = [begin] + bounds + [horizon]
+    return zip(bounds[:-1], bounds[1:])
+
+class Dictionary:
+    '''
+    String dictionary of a table extract column, mapping strings to the
+    codes they're encoded with.
+    '''
+
+    def __init__(self, path):
+        '''
+        Expects the path of the dictionary file, which may not exist yet.
+        '''
+        self.path = path
+        try:
+            f = open(path, 'rb')
+            self.strings = cPickle.load(f)
+            f.close()
+        except IOError:
+            self.strings = []
+        self.codes = dict([(s, i) for i, s in enumerate(self.strings)])
+
+    def encode(self, values):
+        '''
+        Return the int32 array of codes of the strings passed as argument,
+        adding the ones never seen before to the dictionary.
+        '''
+        import numpy as npy
+
+        codes = npy.empty(len(values), dtype='int32')
+        for i, v in enumerate(values):
+            if v is None:
+                codes[i] = -1
+            else:
+                try:
+                    codes[i] = self.codes[v]
+                except KeyError:
+                    codes[i] = self.codes[v] = len(self.strings)
+                    self.strings.append(v)
+        return codes
+
+    def save(self):
+        '''
+        Atomically write the dictionary.
+        '''
+        f = open(self.path + '.tmp', 'wb')
+        cPickle.dump(self.strings, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+def extract(logger, cursor, tab, name, path, low, high, dictionaries):
+    '''
+    Extract the rows of a time range to a chunk.
+
+    Expects a logger, a DB cursor, a DBTab instance, the table name, the
+    table extract directory, low and high datetimes and a dictionary of
+    Dictionary instances by string column name. The chunk is written under
+    a temporary name and renamed once complete, after the dictionaries have
+    been saved. Returns the number of rows extracted.
+    '''
+    import numpy as npy
+
+    tcol = TIMECOLS[str(tab)]
+    kinds = [(c.col, kind(c)) for c in tab]
+    sel = []
+    for col, k in kinds:
+        if k == 'date':
+            # Oracle date differences are in days
+            expr = "NVL(ROUND((%s - DATE '1970-01-01') * 86400), 0)"
+            sel.append(expr % col)
+        else:
+            sel.append(col)
+    stmt = "SELECT %s FROM %s WHERE %s >= :l AND %s < :h" % \
+        (', '.join(sel), name, tcol, tcol)
+
+    chunk = '%d-%d' % (seconds(low), seconds(high))
+    tmp = os.path.join(path, '.%s.tmp' % chunk)
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    # Encode a fetch at a time
+    t = time.time()
+    cursor.execute(stmt, [low, high])
+    columns = [[] for _ in kinds]
+    n = 0
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        n += len(rows)
+        for (col, k), values, arrays in zip(kinds, zip(*rows), columns):
+            if k == 'date':
+                arrays.append(npy.array(values, dtype='int64'))
+            elif k == 'number':
+                arrays.append(npy.array(values, dtype=float)) # None is NaN
+            else:
+                arrays.append(dictionaries[col].encode(values))
+
+    # Write columns, then dictionaries, then make chunk visible
+    for (col, k), arrays in zip(kinds, columns):
+        if arrays:
+            a = npy.concatenate(arrays)
+        elif k == 'date':
+            a = npy.array([], dtype='int64')
+        elif k == 'number':
+            a = npy.array([], dtype=float)
+        else:
+            a = npy.array([], dtype='int32')
+        npy.save(os.path.join(tmp, col + '.npy'), a)
+    for d in dictionaries.values():
+        d.save()
+    dest = os.path.join(path, chunk)
+    if os.path.isdir(dest):
+        # Replace a stale chunk, which readers may still have mapped
+        old = os.path.join(path, '.%s.old' % chunk)
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        os.rename(dest, old)
+        os.rename(tmp, dest)
+        shutil.rmtree(old)
+    else:
+        os.rename(tmp, dest)
+
+    fmt = "Extracted %d rows of %s from %s to %s in %f s"
+    logger.info(fmt % (n, name, low, high, time.time() - t))
+    return n
+
+def stale(logger, cursor, name, tcol, done):
+    '''
+    Work out the time ranges to extract again because rows were inserted
+    into them (or deleted from them) after they were extracted: those of
+    the chunks the row count of which differs from the DB, as well as
+    those older than the first chunk if the DB now has rows there.
+
+    Expects a logger, a DB cursor, the table name, its time column and the
+    list of chunks as returned by chunks(). Returns a list of (low, high)
+    datetime pairs.
+    '''
+    import numpy as npy
+
+    todo = ranges(cursor, name, tcol,
+                  None, UNIXEPOCH + datetime.timedelta(seconds=done[0][0]))
+
+    stmt = "SELECT COUNT(*) FROM %s WHERE %s >= :l AND %s < :h" % \
+        (name, tcol, tcol)
+    for low, high, path in done:
+        low = UNIXEPOCH + datetime.timedelta(seconds=low)
+        high = UNIXEPOCH + datetime.timedelta(seconds=high)
+        cursor.execute(stmt, [low, high])
+        count, = cursor.fetchone()
+        t = npy.load(os.path.join(path, tcol + '.npy'), mmap_mode='r')
+        if count != len(t):
+            fmt = "%s has %d rows from %s to %s but the extract has %d"
+            logger.info(fmt % (name, count, low, high, len(t)))
+            todo.append((low, high))
+    return todo
+
+def update(logger, cursor, tab, name, directory, horizon):
+    '''
+    Extract whatever rows of a table the extract doesn't have yet up to the
+    horizon: chunks which went stale and then new ones, starting where the
+    last chunk left off.
+
+    Expects a logger, a DB cursor, a DBTab instance, the table name, the
+    extract directory and a horizon datetime.
+    '''
+    path = os.path.join(directory, name)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    tcol = TIMECOLS[str(tab)]
+    done = chunks(path)
+    if done:
+        todo = stale(logger, cursor, name, tcol, done)
+        begin = UNIXEPOCH + datetime.timedelta(seconds=done[-1][1])
+    else:
+        todo = []
+        begin = None
+
+    dictionaries = {}
+    for c in tab:
+        if kind(c) == 'string':
+            dictionaries[c.col] = Dictionary(os.path.join(path,
+                                                          c.col + '.dict'))
+
+    todo += ranges(cursor, name, tcol, begin, horizon)
+    if not todo:
+        logger.info("Nothing new to extract from %s" % name)
+    for low, high in todo:
+        extract(logger, cursor, tab, name, path, low, high, dictionaries)
+
+class Extract:
+    '''
+    Read-only view of a table extract, the chunks of which are
+    memory-mapped.
+    '''
+
+    def __init__(self, directory, table):
+        '''
+        Expects the extract directory and the table name. Raises IOError if
+        the table was never extracted.
+        '''
+        self.path = os.path.join(os.path.expanduser(directory), str(table))
+        self.tcol = TIMECOLS.get(str(table), 'eventTime')
+        self.chunks = chunks(self.path)
+        if not self.chunks:
+            raise IOError("No extract of %s in %s" % (table, self.path))
+        self.dictionaries = {}
+
+    def dictionary(self, col):
+        '''
+        Return the list of strings of a dictionary-encoded column, the codes
+        being their indices.
+        '''
+        if col not in self.dictionaries:
+            path = os.path.join(self.path, col + '.dict')
+            self.dictionaries[col] = Dictionary(path).strings
+        return self.dictionaries[col]
+
+    def columns(self, cols, begin, end, tcol=None):
+        '''
+        Return a dictionary of arrays of the columns passed as argument, for
+        the rows the time column of which is from begin to end (excluded).
+
+        Expects a list of column names, begin and end datetimes and
+        optionally the time column to select rows by, which defaults to the
+        one chunks are cut by. Other time columns are assumed not to be
+        later than the chunk one (e.g. startTime and eventTime).
+        '''
+        import numpy as npy
+
+        if tcol is None:
+            tcol = self.tcol
+        b, e = seconds(begin), seconds(end)
+
+        parts = dict([(col, []) for col in cols])
+        for low, high, path in self.chunks:
+            if high <= b or (tcol == self.tcol and low >= e):
+                continue
+            t = npy.load(os.path.join(path, tcol + '.npy'), mmap_mode='r')
+            mask = (t >= b) & (t < e)
+            for col in cols:
+                a = npy.load(os.path.join(path, col + '.npy'), mmap_mode='r')
+                parts[col].append(a[mask])
+
+        result = {}
+        for col in cols:
+            if parts[col]:
+                result[col] = npy.concatenate(parts[col])
+            else:
+                a = npy.load(os.path.join(self.chunks[0][2], col + '.npy'),
+                             mmap_mode='r')
+                result[col] = npy.array([], dtype=a.dtype)
+        return result
+
+def main():
+    # Read arguments
+    desc = "Extract accounting tables to columnar files on local disk."
+    p = optparse.OptionParser(description=desc)
+    help = "user/passwd@dsn-formatted database connection file path"
+    p.add_option("-c", "--connfile", help=help)
+    help = "extract directory (defaults to %s)" % EXTRACTDIR
+    p.add_option("-d", "--directory", default=EXTRACTDIR, help=help)
+    help = "table name (defaults to %s)" % common.LOCALTAB
+    p.add_option("-t", "--table", default=str(common.LOCALTAB), help=help)
+    help = "also extract the %s table" % common.CETAB
+    p.add_option("--ce", action='store_true', help=help)
+    help = "how many hours rows may be inserted late (defaults to %d)" % \
+        LATENESS
+    p.add_option("--lateness", type='int', default=LATENESS, help=help)
+    help = "rows fetched per round trip (defaults to %d)" % ARRAYSIZE
+    p.add_option("--arraysize", type='int', default=ARRAYSIZE, help=help)
+    help = "log file absolute path (defaults to standard error)"
+    p.add_option("-l", "--logfile", help=help)
+    options, args = p.parse_args()
+
+    if options.connfile is None:
+        p.print_help()
+        return 1
+
+    # Set up logging
+    if options.logfile is None:
+        h = logging.StreamHandler()
+    else:
+        h = logging.FileHandler(options.logfile)
+    fmt = "%(asctime)s %(name)s: %(levelname)s %(message)s"
+    h.setFormatter(logging.Formatter(fmt, common.LOGDATEFMT))
+    logger = logging.getLogger(common.LOGGER)
+    logger.addHandler(h)
+    logger.setLevel(logging.INFO)
+
+    tabs = [(common.LOCALTAB, options.table)]
+    if options.ce:
+        tabs.append((common.CETAB, str(common.CETAB)))
+
+    # Only extract complete hours older than the lateness
+    horizon = datetime.datetime.now().replace(minute=0, second=0,
+                                              microsecond=0)
+    horizon -= datetime.timedelta(hours=options.lateness)
+
+    directory = os.path.expanduser(options.directory)
+    try:
+        connection = common.connect(logger,
+                                    os.path.expanduser(options.connfile))
+        cursor = connection.cursor()
+        cursor.arraysize = options.arraysize
+        for tab, name in tabs:
+            update(logger, cursor, tab, name, directory, horizon)
+        connection.close()
+    except common.AcctDBError, e:
+        logger.error(e)
+        return 1
+    except (cx_Oracle.DatabaseError, IOError, OSError), e:
+        logger.error("Couldn't extract: %s" % e)
+        return 1
+    logger.info("Done")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -40,6 +40,7 @@ rm -rf $RPM_BUILD_ROOT
 %{python_sitelib}/*
 %{_sysconfdir}/init.d/batchacctd
 %{_sysconfdir}/cron.d/batchacct-partition.cron
+%{_sysconfdir}/cron.d/batchacct-rollup.cron
 %doc
 
 
@@ -13,6 +13,7 @@ import time
 import optparse
 import logging
 import datetime
+import re
 import pyinotify
 from pyinotify import IN_CREATE, IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO
 import cx_Oracle
@@ -20,9 +21,72 @@ import pylsf
 import common
 
 PIDFILE = '/var/run/batchacctd.pid'
+CKPTFILE = '/var/lib/batchacct/batchacctd.ckpt'
 LOGFILE = '/tmp/batchacct.log'
+WORKERS = 4
 
-# FIXME: add catch-up from old logfiles once we know the actual format
+def firsttime(path):
+    '''
+    Return the event time of the first event record in the accounting file
+    whose path is passed as argument, or None if it's empty.
+    '''
+    for rec in pylsf.lsb_geteventrec(path):
+        return rec['eventTime']
+
+def rotated(acctfile):
+    '''
+    List logrotated accounting files (e.g. lsb.acct.1, lsb.acct.2, ...)
+    found next to the accounting file whose path is passed as argument.
+
+    Returns a list of paths, oldest records first. The order is that of the
+    first event record in each file, not that of the file name suffixes,
+    which logrotation keeps shifting.
+    '''
+    acctdir, name = os.path.split(acctfile)
+    rename = re.compile('^%s\.\d+$' % re.escape(name))
+
+    files = []
+    for e in os.listdir(acctdir or '.'):
+        if rename.match(e):
+            path = os.path.join(acctdir, e)
+            t = firsttime(path)
+            if t is not None:
+                files.append((t, path))
+    files.sort()
+
+    return [path for t, path in files]
+
+def backfill(args):
+    '''
+    Send all the event records of an accounting file to the DB, typically
+    in a worker process.
+
+    Expects a (connection file, accounting file, batch size) tuple and
+    returns a (accounting file, number of inserts, number of errors) tuple.
+    '''
+    connfile, path, batchsize = args
+    logger = logging.getLogger(common.LOGGER)
+    connection = common.connect(logger, connfile)
+
+    # Segfaults if file doesn't exist -- No exception thrown
+    if not os.path.isfile(path):
+        logger.error("Couldn't open acct file: %s" % path)
+        return path, 0, 0
+
+    logger.info("Backfilling from %s" % path)
+    first = firsttime(path)
+    recs = pylsf.lsb_geteventrec(path)
+    insertc, errorc, heartbeat = \
+        common.insert(logger, common.LOCALTAB, recs, connection, 0, 0,
+                      datetime.datetime.today(), batchsize=batchsize)
+
+    # Have the hours backfilled aggregated again by the next rollup refresh
+    if first is not None:
+        common.rewind(connection.cursor(), common.ots(first))
+        common.commit(logger, connection)
+    connection.close()
+
+    return path, insertc, errorc
 
 class EventHandler(pyinotify.ProcessEvent):
     '''
@@ -32,17 +96,23 @@ class EventHandler(pyinotify.ProcessEvent):
     '''
 
     def __init__(self, logger, acctfile, connection,
-                 heartbeatdelta=common.HBDELTA, dryrun=False):
+                 heartbeatdelta=common.HBDELTA, dryrun=False, batchsize=None,
+                 checkpoint=None, pipeline=None):
         '''
         Instantiation method.
         
         Expects an iterable lsb_geteventrec instance
         (well, lsb_geteventrec instances are iterable by design anyway)
-        and a database cursor.
+        and a database cursor. Records are inserted in blocks of batchsize
+        rows if batchsize is set and the read position is saved to the
+        checkpoint if any. Records are handed over to the pipeline, if any,
+        instead of being written to the DB right away.
         '''
 
         self.acctfile = acctfile
+        self.path = acctfile # Either acctfile or a logrotated file
         self.recs = None
+        self.stat = None
         self.connection = connection
         self.logger = logger
         self.insertc = 0
@@ -50,40 +120,237 @@ class EventHandler(pyinotify.ProcessEvent):
         self.heartbeatdelta = heartbeatdelta
         self.heartbeat = datetime.datetime.today()
         self.dryrun = dryrun
+        self.batchsize = batchsize
+        self.checkpoint = checkpoint
+        self.pipeline = pipeline
+        self.pending = 0 # Modification events not dealt with yet
+
+        # pylsf doesn't tell where it is in the file, so the offset is
+        # counted in event records rather than in bytes.
+        self.offset = 0
+        self.eventtime = None
+
+    def open(self, path=None):
+        '''
+        Open accounting file, or the logrotated file whose path is passed
+        as optional argument, with a new lsb_geteventrec instance. Returns
+        False if it couldn't be opened.
+        '''
+        if path is None:
+            path = self.acctfile
+
+        # Segfaults if file doesn't exist -- No exception thrown
+        if os.path.isfile(path):
+            # Previous file implicitly closed here when the lsb_geteventrec
+            # is deallocated
+            self.path = path
+            self.stat = os.stat(path)
+            self.recs = pylsf.lsb_geteventrec(path)
+            self.offset = 0
+            return True
+        else:
+            # Report to log
+            strerr = "No such file or directory"
+            self.logger.error("Couldn't open acct file: %s" % strerr)
+            return False
+
+    def records(self, since=None):
+        '''
+        Yield event records from the lsb_geteventrec instance, keeping track
+        of how many have been read and of the last event time. Records older
+        than the optional since UNIX timestamp are read but not yielded.
+        '''
+        for rec in self.recs:
+            self.offset += 1
+            if since is not None and rec['eventTime'] < since:
+                continue
+            self.eventtime = rec['eventTime']
+            yield rec
+
+    def skip(self, n):
+        '''
+        Read past the first n records of the current file, as they've
+        already been committed.
+        '''
+        if n > 0:
+            for _ in self.records():
+                if self.offset == n:
+                    break
+
+    def collect(self, since=None, batchsize=None):
+        '''
+        Send new event records from the current file to the DB, optionally
+        only those not older than a since UNIX timestamp and optionally in
+        blocks of another batch size than the usual one.
+        '''
+        if self.pipeline is not None:
+            self.pipeline.put(self.records(since), self.snapshot)
+            return
+
+        if batchsize is None:
+            batchsize = self.batchsize
+
+        insertc, errorc, heartbeat = \
+            common.insert(self.logger, common.LOCALTAB, self.records(since),
+                          self.connection, self.insertc, self.errorc,
+                          self.heartbeat, self.heartbeatdelta,
+                          batchsize=batchsize, commitfn=self.save)
+        self.insertc = insertc
+        self.errorc = errorc
+        self.heartbeat = heartbeat
+
+    def snapshot(self):
+        '''
+        Return a function saving the checkpoint as it stands now, to be
+        called once the records read so far have been committed, or None if
+        there's no checkpoint.
+        '''
+        if self.checkpoint is None:
+            return None
+
+        path, stat, offset, eventtime = \
+            self.path, self.stat, self.offset, self.eventtime
+        def save():
+            try:
+                self.checkpoint.save(path, stat, offset, eventtime)
+            except (IOError, OSError), e:
+                self.logger.error("Couldn't save checkpoint: %s" % e)
+        return save
+
+    def save(self):
+        '''
+        Save checkpoint, once the records read so far have been committed.
+        '''
+        if self.pipeline is not None:
+            # Not before whatever has been queued so far has been written
+            self.pipeline.enqueue([], self.snapshot)
+            return
+
+        save = self.snapshot()
+        if save is not None:
+            save()
+
+    def catchup(self):
+        '''
+        Send the event records the logrotated files hold and which haven't
+        made it to the DB yet, according to the checkpoint.
+
+        The file the checkpoint refers to is resumed from where it was left
+        and the ones which were logrotated after it are sent in full. If the
+        checkpointed file can't be found any more (e.g. if it's been
+        compressed), anything as recent as the last checkpointed event
+        record is sent instead -- duplicates will be told off by the DB.
+        '''
+        files = rotated(self.acctfile)
+        stats = [os.stat(path) for path in files]
+
+        # Where to start from
+        start, since = 0, self.checkpoint.eventtime
+        for i, st in enumerate(stats):
+            if self.checkpoint.matches(st):
+                start, since = i, None
+                break
+
+        batchsize = self.batchsize or common.BATCHSIZE
+        for i in range(start, len(files)):
+            if not self.open(files[i]):
+                continue
+            self.logger.info("Catching up from %s" % files[i])
+            if since is None and i == start:
+                self.skip(self.checkpoint.offset)
+            self.collect(since, batchsize)
+
+        # Back to the accounting file
+        if self.open():
+            self.collect(since, batchsize)
+
+    def rewind(self, eventtime):
+        '''
+        Have the rollup table aggregate again the hours from the UNIX
+        timestamp passed as argument, once whatever has been collected so
+        far has been written, as records that old may have been inserted
+        after the hours were refreshed.
+        '''
+        if self.pipeline is not None:
+            self.pipeline.join()
+
+        connection = self.connection
+        if isinstance(connection, common.DBLink):
+            # If it's lost, records are spooled and rewound when drained
+            connection = connection.get()
+            if connection is None:
+                return
+        try:
+            common.rewind(connection.cursor(), common.ots(eventtime))
+        except (cx_Oracle.DatabaseError, cx_Oracle.InterfaceError), e:
+            self.logger.error("Couldn't rewind rollup: %s" % e)
+            return
+        common.commit(self.logger, connection)
+
+    def resume(self):
+        '''
+        Pick up where the last checkpoint says we stopped, if there's any
+        checkpoint, and send whatever has been written since, catching up
+        from logrotated files if the checkpoint is about one of them. The
+        rollup table is then rewound to the checkpoint.
+        '''
+        if self.dryrun or not self.open():
+            return
+
+        since = 0 # No event time recorded
+        if self.checkpoint is not None and self.checkpoint.load():
+            since = self.checkpoint.eventtime
+            if self.checkpoint.matches(self.stat):
+                # Skip records already committed
+                self.skip(self.checkpoint.offset)
+                fmt = "Resuming %s from record %d"
+                self.logger.info(fmt % (self.acctfile, self.offset))
+                self.collect()
+            else:
+                fmt = "Checkpointed file %s has been logrotated"
+                self.logger.warning(fmt % self.checkpoint.name)
+                self.catchup()
+        else:
+            self.collect()
+
+        # The outage may have been longer than the rollup looks back
+        if since > 0:
+            self.rewind(since)
 
     def process_IN_MODIFY(self, event):
         '''
         Handles a file modification event, typically when one or more event
-        records have been appended to the accounting file. The new records
-        are sent to the accounting database here.
+        records have been appended to the accounting file. The event is
+        merely counted here and the new records are sent to the accounting
+        database when pending events are drained.
         '''
 
         if event.name == os.path.basename(self.acctfile):
-            if self.dryrun:
-                self.logger.info("Would normally send records")
-            else:
-                if self.recs == None:
-                    # Segfaults if file doesn't exist -- No exception thrown
-                    if os.path.isfile(self.acctfile):
-                        self.recs = pylsf.lsb_geteventrec(self.acctfile)
-                    else:
-                        # Report to log
-                        fmt = "Couldn't open acct file: %s"
-                        strerr = "No such file or directory"
-                        self.logger.error(fmt % strerr)
-                        return
-
-                insertc, errorc, heartbeat = common.insert(self.logger,
-                                                           common.LOCALTAB,
-                                                           self.recs,
-                                                           self.connection,
-                                                           self.insertc,
-                                                           self.errorc,
-                                                           self.heartbeat,
-                                                           self.heartbeatdelta)
-                self.insertc = insertc
-                self.errorc = errorc
-                self.heartbeat = heartbeat
+            self.pending += 1
+
+    def drain(self):
+        '''
+        Deal with all pending file modification events at once.
+        '''
+        self.pending = 0
+        if self.dryrun:
+            self.logger.info("Would normally send records")
+        else:
+            if self.recs == None and not self.open():
+                return
+            self.collect()
+
+    def process_IN_Q_OVERFLOW(self, event):
+        '''
+        Handles an inotify event queue overflow, after which there's no
+        telling which events have been missed out: everything is read again
+        from the last checkpoint, once whatever is being written has been.
+        '''
+        self.logger.warning("Event queue overflow, rescanning from checkpoint")
+        if self.pipeline is not None:
+            self.pipeline.join()
+        self.pending = 0
+        self.resume()
 
     def process_IN_MOVED_FROM(self, event):
         '''
@@ -117,30 +384,44 @@ class EventHandler(pyinotify.ProcessEvent):
             # created atomically.
             # It's possible to do it this way because seems to be targeting
             # inodes, not file names.
+            self.pending = 0
             if self.dryrun:
                 self.logger.info("Would normally send records")
             elif self.recs != None:
-                insertc, errorc, heartbeat = common.insert(self.logger,
-                                                           common.LOCALTAB,
-                                                           self.recs,
-                                                           self.connection,
-                                                           self.insertc,
-                                                           self.errorc,
-                                                           self.heartbeat,
-                                                           self.heartbeatdelta)
-                self.insertc = insertc
-                self.errorc = errorc
-                self.heartbeat = heartbeat
+                self.collect()
 
             self.logger.info('Created %s' % event.name)
-            if os.path.isfile(self.acctfile):
-                # Previous file implicitly closed here when the lsb_geteventrec
-                # is deallocated
-                self.recs = pylsf.lsb_geteventrec(self.acctfile)
-            else:
-                # Report to log
-                strerr = "No such file or directory"
-                self.logger.error("Couldn't open acct file: %s" % strerr)
+            if self.open() and not self.dryrun:
+                self.save()
+
+def backfillmain(logger, options, files):
+    '''
+    Send the records of the accounting files passed as last argument to
+    the DB with several worker processes, each with its own DB connection.
+    '''
+    import multiprocessing
+
+    if options.dryrun:
+        for path in files:
+            logger.info("Would normally backfill from %s" % path)
+        return 0
+
+    common.accounting(logger, files[0])
+    batchsize = options.batchsize or common.BATCHSIZE
+    pool = multiprocessing.Pool(options.workers)
+    try:
+        results = pool.map(backfill, [(options.connfile, path, batchsize)
+                                      for path in files])
+    except common.AcctDBError, e:
+        logger.error(e)
+        return 1
+    pool.close()
+    pool.join()
+
+    for path, insertc, errorc in results:
+        fmt = "Backfilled %d records from %s (%d errors)"
+        logger.info(fmt % (insertc, path, errorc))
+    return 0
 
 def main():
     '''
@@ -162,6 +443,37 @@ def main():
            common.HBDELTA
     p.add_option("-b", "--heartbeatdelta", type='int',
                  help=help, default=common.HBDELTA)
+    help = "insert records in array-bound blocks of BATCHSIZE rows"
+    p.add_option("--batchsize", type='int', help=help)
+    help = "checkpoint file absolute path (defaults to %s)" % CKPTFILE
+    p.add_option("-k", "--checkpoint", help=help, default=CKPTFILE)
+    help = "don't run as a daemon but send all the records of the "
+    help += "accounting files passed as arguments and exit"
+    p.add_option("--backfill", action='store_true', help=help)
+    help = "number of backfilling worker processes (defaults to %d)" % WORKERS
+    p.add_option("--workers", type='int', help=help, default=WORKERS)
+    help = "number of DB writer threads, each with its own connection "
+    help += "(defaults to 0, i.e. records are written as they are read)"
+    p.add_option("--writers", type='int', help=help, default=0)
+    help = "how many blocks of records may wait to be written when there are "
+    help += "writer threads (defaults to %d)" % common.QUEUESIZE
+    p.add_option("--queuesize", type='int', help=help,
+                 default=common.QUEUESIZE)
+    help = "how many milliseconds modification events may wait to be "
+    help += "dealt with together (defaults to %d)" % common.LATENCY
+    p.add_option("--latency", type='int', help=help, default=common.LATENCY)
+    help = "how many modification events may be dealt with together "
+    help += "(defaults to %d)" % common.MAXEVENTS
+    p.add_option("--maxevents", type='int', help=help,
+                 default=common.MAXEVENTS)
+    help = "spool file absolute path where to keep the records which can't "
+    help += "be written while the DB is unreachable, in which case "
+    help += "connections are also established again (defaults to none)"
+    p.add_option("--spool", help=help)
+    help = "how many megabytes may be spooled at most (defaults to %d)" % \
+           common.SPOOLSIZE
+    p.add_option("--spoolsize", type='int', help=help,
+                 default=common.SPOOLSIZE)
     help = "Don't touch the DB"
     p.add_option("-d", "--dryrun", action='store_true', help=help)
     options, args = p.parse_args()
@@ -180,6 +492,12 @@ def main():
     logger.addHandler(h)
     logger.setLevel(logging.INFO)
 
+    if options.backfill:
+        if len(args) == 0:
+            p.print_help()
+            return 1
+        return backfillmain(logger, options, args)
+
     # Try to connect before daemonising to exit with a useful code
     try:
         if not options.dryrun:
@@ -202,9 +520,29 @@ def main():
         if options.dryrun:
             logger.info("Would normally connect to DB")
             connection = None
+        elif options.spool:
+            spool = common.Spool(logger, options.spool, options.spoolsize)
+            connection = common.DBLink(logger, options.connfile, spool)
         else:
             connection = common.connect(logger, options.connfile)
 
+        # Set up DB writer threads
+        if options.dryrun or options.writers == 0:
+            pipeline = None
+        else:
+            logger.info("Starting %d DB writers" % options.writers)
+            if options.spool:
+                connections = [common.DBLink(logger, options.connfile, spool,
+                                             True)
+                               for _ in range(options.writers)]
+            else:
+                connections = [common.connect(logger, options.connfile, True)
+                               for _ in range(options.writers)]
+            pipeline = common.Pipeline(logger, common.LOCALTAB, connections,
+                                       options.batchsize or common.BATCHSIZE,
+                                       options.queuesize,
+                                       options.heartbeatdelta)
+
         # Set up LSF
         acctfile = common.accounting(logger, options.acctfile)
     except common.AcctDBError, e:
@@ -214,8 +552,10 @@ def main():
     # Set up pyinotify
     logger.info("Pyinotify will be watching %s" % acctfile)
     wm = pyinotify.WatchManager()
+    checkpoint = common.Checkpoint(options.checkpoint)
     handler = EventHandler(logger, acctfile, connection,
-                           options.heartbeatdelta, options.dryrun)
+                           options.heartbeatdelta, options.dryrun,
+                           options.batchsize, checkpoint, pipeline)
     notifier = pyinotify.Notifier(wm, handler)
 
     # IN_MOVE_SELF isn't much use to me here, it seems: when watching a file,
@@ -233,9 +573,20 @@ def main():
         logger.error(e)
         return 1
 
+    # Catch up with what's been written while we weren't watching
+    try:
+        handler.resume()
+    except common.AcctError, e:
+        logger.error(e)
+        return 1
+
     # Loop and dispatch events forever
     try:
-        notifier.loop()
+        common.loop(notifier, handler, options.latency, options.maxevents)
+    except common.AcctDBError, e:
+        # Writing has stopped: the next run resumes from the checkpoint
+        logger.error(e)
+        return 1
     except pyinotify.NotifierError, e:
         logger.error(e)
         return 1
@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+
+'''
+Aggregate the local table by the hour into the rollup table which
+cpuhours.py reads from whenever it can.
+'''
+
+import sys
+import datetime, time
+import optparse
+import logging
+import cx_Oracle
+import common
+
+LOGFILE = '/var/log/batchacct/batchacct-rollup.log'
+LOOKBACK = 48 # Hours before what's covered to aggregate again, for late rows
+EPOCH = datetime.datetime(1970, 1, 1, 1, 0, 0)
+KEYCOLS = ['queue', 'chargedSAAP', 'userName', 'fromHost']
+# Aggregates, in the order of the rollup table columns
+AGGS = [('jobs', "COUNT(*)"),
+        ('cpu', "SUM(ru_stime + ru_utime)"),
+        ('wall', "SUM(eventTime - startTime)"),
+        ('wait', "SUM(startTime - submitTime)"),
+        ('hcpu', "SUM((ru_stime + ru_utime) * hostFactor)"),
+        ('hwall', "SUM((eventTime - startTime) * hostFactor)"),
+        ('hwait', "SUM((startTime - submitTime) * hostFactor)"),
+       ]
+
+def mergestmt(tab, rolluptab):
+    '''
+    Build the MERGE statement aggregating the local table rows of an
+    eventTime range (:b, :t) into the rollup table. Hours are aggregated
+    all over again rather than added to, so that refreshing a range twice
+    does no harm.
+
+    Expects the local table name and the rollup table name. Returns a
+    statement string.
+    '''
+    keys = ', '.join(KEYCOLS)
+    aggs = ', '.join(['%s %s' % (expr, col) for col, expr in AGGS])
+    using = "SELECT TRUNC(eventTime, 'HH24') hour, %s, %s FROM %s" % \
+        (keys, aggs, tab)
+    using += " WHERE eventTime >= :b AND eventTime < :t AND %s AND %s" % \
+        (common.STTCOND, common.CPUCOND)
+    using += " GROUP BY TRUNC(eventTime, 'HH24'), %s" % keys
+
+    # Some key columns are nullable
+    on = ' AND '.join(['r.hour = l.hour'] +
+                      ['DECODE(r.%s, l.%s, 1, 0) = 1' % (c, c)
+                       for c in KEYCOLS])
+    update = ', '.join(['r.%s = l.%s' % (col, col) for col, _ in AGGS])
+    cols = ['hour'] + KEYCOLS + [col for col, _ in AGGS]
+    insert = "(%s) VALUES (%s)" % (', '.join(['r.%s' % c for c in cols]),
+                                   ', '.join(['l.%s' % c for c in cols]))
+
+    stmt = "MERGE INTO %s r USING (%s) l ON (%s)" % (rolluptab, using, on)
+    stmt += " WHEN MATCHED THEN UPDATE SET %s" % update
+    stmt += " WHEN NOT MATCHED THEN INSERT %s" % insert
+    return stmt
+
+def refresh(logger, connection, tab, begin, end, chunk, dryrun=False):
+    '''
+    Aggregate the local table rows from begin to end into the rollup table,
+    chunk by chunk, recording what's covered after each one. If late rows
+    have rewound what's covered meanwhile (see common.rewind()), what's
+    covered is left as is and the refresh stops there, for the next one to
+    start from it.
+
+    Expects a logger, a DB connection, the local table name, begin and end
+    datetimes (on the hour), a chunk timedelta and optionally whether to
+    only print what would be done.
+    '''
+    cursor = connection.cursor()
+    stmt = mergestmt(tab, common.ROLLUPTAB)
+    lock = "LOCK TABLE %s IN EXCLUSIVE MODE" % common.ROLLSTATETAB
+    state = "INSERT INTO %s VALUES (:r, :c)" % common.ROLLSTATETAB
+    if dryrun:
+        print stmt
+    covered = common.covered(cursor)
+
+    b = begin
+    while b < end:
+        t = min(b + chunk, end)
+        logger.info("Aggregating %s from %s to %s" % (tab, b, t))
+        if not dryrun:
+            start = time.time()
+            cursor.execute(stmt, [b, t, EPOCH])
+            fmt = "Aggregated %d hourly groups in %f s"
+            logger.info(fmt % (cursor.rowcount, time.time() - start))
+            cursor.execute(lock)
+            c = common.covered(cursor)
+            if covered is not None and c is not None and c < covered:
+                connection.commit()
+                logger.warning("Rewound to %s by late rows, stopping" % c)
+                return
+            cursor.execute(state, [datetime.datetime.now(), t])
+            connection.commit()
+            if covered is None or t > covered:
+                covered = t # As covered() will have it
+        b = t
+
+def main():
+    # Read arguments
+    p = optparse.OptionParser()
+    help = "user/passwd@dsn-formatted database connection file path"
+    p.add_option("-c", "--connfile", help=help)
+    help = "table name (defaults to %s)" % common.LOCALTAB
+    p.add_option("-t", "--table", default=str(common.LOCALTAB), help=help)
+    help = "how many hours before what's covered to aggregate again, for "
+    help += "rows inserted late (defaults to %d)" % LOOKBACK
+    p.add_option("-k", "--lookback", type='int', default=LOOKBACK, help=help)
+    help = "aggregate from this UNIX timestamp on, whatever is covered "
+    help += "(e.g. to build the rollup table from scratch)"
+    p.add_option("-b", "--begin", type='int', help=help)
+    help = "how many days to aggregate per transaction (defaults to 7)"
+    p.add_option("--chunk", type='int', default=7, help=help)
+    help="don't do anything, only SQL-print what would be done"
+    p.add_option("-d", "--dryrun", action='store_true', help=help)
+    help = "log file absolute path (defaults to %s)" % LOGFILE
+    p.add_option("-l", "--logfile", help=help, default=LOGFILE)
+    options, args = p.parse_args()
+
+    if options.connfile is None:
+        p.print_help()
+        return 1
+
+    # Set up logging
+    h = logging.FileHandler(options.logfile)
+    fmt = "%(asctime)s %(name)s: %(levelname)s %(message)s"
+    h.setFormatter(logging.Formatter(fmt, common.LOGDATEFMT))
+    logger = logging.getLogger(common.LOGGER)
+    logger.addHandler(h)
+    logger.setLevel(logging.INFO)
+
+    try:
+        connection = common.connect(logger, options.connfile)
+        cursor = connection.cursor()
+
+        # Only aggregate complete hours
+        end = datetime.datetime.now().replace(minute=0, second=0,
+                                              microsecond=0)
+        if options.begin is not None:
+            begin = datetime.datetime.fromtimestamp(options.begin)
+        else:
+            begin = common.covered(cursor)
+            if begin is None:
+                # Never refreshed: start with the oldest row
+                cursor.execute("SELECT MIN(eventTime) FROM %s" % options.table)
+                begin, = cursor.fetchone()
+                if begin is None:
+                    logger.info("Nothing to aggregate")
+                    return 0
+            else:
+                begin -= datetime.timedelta(hours=options.lookback)
+        begin = begin.replace(minute=0, second=0, microsecond=0)
+
+        refresh(logger, connection, options.table, begin, end,
+                datetime.timedelta(days=options.chunk), options.dryrun)
+    except common.AcctDBError, e:
+        logger.error(e)
+        return 1
+    except cx_Oracle.DatabaseError, e:
+        logger.error("Couldn't aggregate %s: %s" % (options.table, e))
+        return 1
+    logger.info("Done")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,10 +13,12 @@ In short: suitable only for python setup.py bdist_rpm
 setup(name='batchacct-loccol',
       description='Batch Accounting - Local Collection',
       version='1.1',
-      py_modules=['batchacct.acct', 'batchacct.create', 'batchacct.partition'],
+      py_modules=['batchacct.acct', 'batchacct.create', 'batchacct.partition',
+                  'batchacct.rollup'],
       data_files=[
                   ('/etc/init.d', ['batchacctd']),
-                  ('/etc/cron.d', ['batchacct-partition.cron']),
+                  ('/etc/cron.d', ['batchacct-partition.cron',
+                                   'batchacct-rollup.cron']),
                  ],
       options={'bdist_rpm': {'post_install':  'post_install',
                              'pre_uninstall': 'pre_uninstall'}}
@@ -8,11 +8,14 @@ message to stdout'''
 # be consumed).
 
 import sys
+import os
 import common
 import re
 import optparse
 import logging
 import time, datetime
+import threading
+import Queue
 import stomp
 import cx_Oracle
 
@@ -27,6 +30,13 @@ NONLCG = '/local-nonlcg'
 EPOCH = datetime.datetime(1970, 1, 1, 1, 0)
 LOGFILE = '/var/log/batchacct/batchacct-pub.log'
 GRIDCECOND = "(lrmsId IS NOT NULL OR queue NOT LIKE 'grid_%')"
+LOOKBACK = 48 # Hours before the watermark to join again in incremental mode
+ARRAYSIZE = 5000 # Rows fetched at a time
+FORMATTERS = 2 # Threads formatting messages
+QUEUESIZE = 8 # Bunches of rows waiting to be formatted at most
+RECEIPTTIMEOUT = 60 # Seconds to wait for the broker to acknowledge a message
+WORKERS = 4 # Backlog worker processes
+CKPTFILE = '/var/lib/batchacct/batchacct-pub-backlog.ckpt'
 
 class APELFieldError(Exception):
     def __init__(self, field):
@@ -35,13 +45,49 @@ class APELFieldError(Exception):
     def __str__(self):
         return "No value for %s" % self.field
 
+class AckError(Exception):
+    def __init__(self, receipt):
+        self.receipt = receipt
+
+    def __str__(self):
+        return "Message %s not acknowledged by broker" % self.receipt
+
 class MsgLstnr:
+    def __init__(self):
+        self.receipts = set()
+        self.cond = threading.Condition()
+
     def on_error(self, headers, message):
         print 'received an error %s' % message
 
     def on_message(self, headers, message):
         print 'received a message %s' % message
 
+    def on_receipt(self, headers, message):
+        self.cond.acquire()
+        try:
+            self.receipts.add(headers.get('receipt-id'))
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def wait(self, receipt, timeout=RECEIPTTIMEOUT):
+        '''
+        Wait for the broker to acknowledge the message sent with the
+        receipt passed as argument, raising AckError if it takes too long.
+        '''
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while receipt not in self.receipts:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise AckError(receipt)
+                self.cond.wait(left)
+            self.receipts.remove(receipt)
+        finally:
+            self.cond.release()
+
 class APELField:
     '''Maps APEL field to accounting DB column, providing processing functions
     if needs be'''
@@ -132,97 +178,370 @@ def inf(userfqan):
 
 ### End of Callbacks ###########################################################
 
-def send(logger, msg, j, mq=None, ssm=None):
+def formatter(fields):
+    '''
+    Compile the APEL fields passed as argument into a function formatting
+    a joined row into an APEL record.
+
+    Which row values each field takes, through which callback, and what
+    constant or default value it may fall back on is worked out once and for
+    all here rather than for each row. The returned function expects a row
+    and a list which it appends the record lines to, so that a whole message
+    can be joined in one go.
     '''
-    Send message to broker
+    steps = []
+    for c in fields:
+        if c.col != None:
+            # Prefer DB value than constant
+            steps.append(('%s: %%s\n' % c, c.colidxs, c.fn, c.mty))
+        elif c.val != None:
+            # Constant, default value if we don't mean to look at the DB for
+            # this field.
+            steps.append(('%s: %s\n' % (c, c.val), None, None, None))
+        else:
+            # We're not looking at the DB and we didn't plan any constant,
+            # default value: we have a problem.
+            raise APELFieldError(c)
+
+    def fmt(row, buf):
+        for line, colidxs, fn, mty in steps:
+            if colidxs is None:
+                buf.append(line)
+                continue
+
+            if fn is None:
+                # If there's no function assigned, we can't be dealing with
+                # more than one DB column.
+                val = row[colidxs[0]]
+            else:
+                # Assigned functions should typically raise an APELFieldError
+                # if any of the parameter is None.
+                val = fn(*[row[i] for i in colidxs])
+
+            if val is not None:
+                buf.append(line % (val,))
+            elif mty is not None:
+                # Compulsory APEL field for which we have no data
+                buf.append(line % (mty,))
+            # Otherwise, shave the value off the message entirely
+        buf.append('%%\n')
+
+    return fmt
 
-    Not necessary when using the APEL SSM. 
+class SSMWriter:
+    '''
+    Writes APEL messages into the SSM outgoing directory so that the SSM
+    never sees half-written files: each file is written under a temporary
+    name, synced and renamed into place. File names are made of the time,
+    the PID and a sequence number so that they never collide. Several
+    messages may be grouped into one file up to a byte budget, so that
+    there are fewer files for the SSM to poll.
+    '''
+
+    def __init__(self, logger, path, budget=0):
+        '''
+        Expects a logger, the SSM outgoing directory path and optionally a
+        byte budget per file (if 0, each message gets its own file).
+        '''
+        self.logger = logger
+        self.path = path
+        self.budget = budget
+        self.seq = 0
+        self.bodies = [] # Messages waiting to be written, minus the header
+        self.size = len(HEADER)
+
+    def write(self, msg):
+        '''
+        Add message to the current file, writing the file first if the
+        message doesn't fit in it and writing it afterwards if the byte
+        budget is reached. Returns how many messages have made it to the
+        SSM directory, oldest first, which may or may not include this one.
+        '''
+        body = msg[len(HEADER):]
+        written = 0
+        if self.bodies and self.size + len(body) > self.budget:
+            written = self.flush()
+        self.bodies.append(body)
+        self.size += len(body)
+        if self.size < self.budget:
+            return written
+        return written + self.flush()
+
+    def flush(self):
+        '''
+        Write the current file if there are messages waiting in it. Returns
+        how many there were.
+        '''
+        if not self.bodies:
+            return 0
+
+        name = '%d-%d-%06d' % (time.time(), os.getpid(), self.seq)
+        tmp = os.path.join(self.path, '.%s.tmp' % name)
+        f = open(tmp, 'w')
+        f.write(HEADER)
+        f.write(''.join(self.bodies))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, os.path.join(self.path, name))
+
+        self.logger.info("Wrote %s (%d bytes)" % (name, self.size))
+        written = len(self.bodies)
+        self.seq += 1
+        self.bodies = []
+        self.size = len(HEADER)
+        return written
+
+def send(logger, msg, j, mq=None, ssm=None, lstnr=None):
+    '''
+    Send message to broker, or hand it over to the SSMWriter passed as
+    argument.
+
+    If a listener is passed as argument, wait for the broker to acknowledge
+    the message. Returns how many of the messages not sent so far have now
+    been sent, oldest first: with an SSMWriter grouping messages, this one
+    may not be sent yet while previous ones may just have been.
     '''
 
     log = "Sending APEL message for %d events so far" % (j + 1)
     logger.info(log)
     if ssm != None:
-        try:
-            f = open(ssm + '/' + str(time.time()), 'a')
-            f.write(msg)
-            f.close()
-        except IOError, e:
-            logger.error(e)
-            raise
+        return ssm.write(msg)
     elif mq != None:
-        mq.send(msg, destination=QUEUE)
+        if lstnr is None:
+            mq.send(msg, destination=QUEUE)
+        else:
+            receipt = 'batchacct-%d-%d' % (os.getpid(), j)
+            mq.send(msg, destination=QUEUE, receipt=receipt)
+            lstnr.wait(receipt)
+    return 1
 
 def mark(updatecursor, pubs, t):
     '''
-    Flag a job accounting record as published with its publication date
+    Flag job accounting records as published with their publication date
+
+    Expects a DB cursor, a list of (jobId, idx, eventTime) primary key
+    tuples, which gets emptied, and the publication date. Always the same
+    statement is sent with array binds, so that it's only parsed once.
     '''
 
-    update = "UPDATE %s SET %s.published = :t" % \
-        (common.LOCALTAB, common.LOCALTAB)
-    where = "WHERE %s.jobId IN (%s)" % \
-        (common.LOCALTAB, ', '.join(str(p) for p in pubs))
+    update = "UPDATE %s SET published = :t" % common.LOCALTAB
+    where = "WHERE jobId = :j AND idx = :i AND eventTime = :e"
     stmt = '%s %s' % (update, where)
-    updatecursor.execute(stmt, [t])
+    updatecursor.executemany(stmt, [(t,) + p for p in pubs])
     del pubs[:]
 
-def main():
-    # Read arguments
-    p = optparse.OptionParser()
-    help = "user/passwd@dsn-formatted accounting DB connection file path"
-    p.add_option("-a", "--acctdbfile", help=help)
-    help = "number of events per APEL message (default is %d)" % BUNCH
-    p.add_option("-b", "--bunch", default=BUNCH, type='int', help=help)
-    p.add_option("-c", "--conf", help="configuration file")
-    help="VO file (containing VO-group mappings)"
-    p.add_option("-v", "--vofile", help=help)
-    p.add_option("-s", "--ssm", help="SSM home directory")
-    help = "log file absolute path (defaults to %s)" % LOGFILE
-    p.add_option("-l", "--logfile", help=help, default=LOGFILE)
-    p.add_option("-m", "--msgbroker", help="message broker host")
-    options, args = p.parse_args()
+class Publisher:
+    '''
+    Publishes joined rows with a pipeline: a thread fetches them by the
+    bunch, a pool of threads formats each bunch into an APEL message and
+    the calling thread sends messages in order, only marking a bunch of
+    events as published (and committing) once its message has been sent
+    and acknowledged.
+    '''
 
-    # Set up logging
-    #logging.basicConfig(level=logging.INFO, format=fmt)
-    #h = logging.StreamHandler()
-    h = logging.FileHandler(options.logfile)
-    fmt = '%(asctime)s %(levelname)s %(message)s'
-    h.setFormatter(logging.Formatter(fmt, common.LOGDATEFMT))
-    logger = logging.getLogger(common.LOGGER)
-    logger.addHandler(h)
-    logger.setLevel(logging.INFO)
+    def __init__(self, logger, connection, cursor, fmt, bunch, eventTimeIdx,
+                 pkIdx, mq=None, ssm=None, lstnr=None, formatters=FORMATTERS,
+                 queuesize=QUEUESIZE):
+        '''
+        Expects a logger, a threaded DB connection, a cursor on the executed
+        join, a formatter() function, the number of events per message,
+        the eventTime and primary key row indexes, optionally a broker
+        connection, an SSMWriter and a broker listener (to wait for
+        acknowledgements), optionally the number of formatting threads and
+        optionally how many bunches of rows may wait to be formatted.
+        '''
+        self.logger = logger
+        self.connection = connection
+        self.cursor = cursor
+        self.fmt = fmt
+        self.bunch = bunch
+        self.eventTimeIdx = eventTimeIdx
+        self.pkIdx = pkIdx
+        self.mq = mq
+        self.ssm = ssm
+        self.lstnr = lstnr
+        self.formatters = formatters
+
+        self.todo = Queue.Queue(queuesize)
+        self.cond = threading.Condition()
+        self.done = {} # Formatted bunches by sequence number
+        self.total = None # Number of bunches, once all have been fetched
+        self.error = None # Exception raised in a thread
+
+        # First, last and maximum eventTime published
+        self.start, self.end, self.last = 0, 0, 0
+
+    def fail(self, e):
+        self.cond.acquire()
+        try:
+            if self.error is None:
+                self.error = e
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def fetch(self):
+        seq = 0
+        try:
+            while True:
+                rows = self.cursor.fetchmany(self.bunch)
+                if not rows:
+                    break
+                self.todo.put((seq, rows))
+                seq += 1
+        except Exception, e:
+            self.fail(e)
+
+        self.cond.acquire()
+        try:
+            self.total = seq
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for _ in range(self.formatters):
+            self.todo.put(None)
+
+    def format(self):
+        while True:
+            item = self.todo.get()
+            if item is None:
+                break
+            seq, rows = item
+
+            try:
+                buf = [HEADER] # Joined once per message
+                for row in rows:
+                    self.fmt(row, buf)
+                pubs = [tuple(row[self.pkIdx:]) for row in rows]
+                times = [row[self.eventTimeIdx] for row in rows]
+                result = ''.join(buf), pubs, times[0], times[-1], max(times)
+            except Exception, e:
+                self.fail(e)
+                break
+
+            self.cond.acquire()
+            try:
+                self.done[seq] = result
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def next(self, seq):
+        '''
+        Wait for bunch seq to be formatted and return it, or None if there
+        are no more bunches. Reraises whatever went wrong in other threads.
+        '''
+        self.cond.acquire()
+        try:
+            while True:
+                if self.error is not None:
+                    raise self.error
+                if seq in self.done:
+                    return self.done.pop(seq)
+                if self.total is not None and seq >= self.total:
+                    return None
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def mark(self, updatecursor, sent, t):
+        '''
+        Mark the events of the messages which have been sent, as a list of
+        lists of primary key tuples, as published at time t and commit.
+        '''
+        pubs = []
+        for p in sent:
+            pubs.extend(p)
+        mark(updatecursor, pubs, t)
+        self.connection.commit()
+
+    def run(self, t):
+        '''
+        Publish all the rows, marking them as published at time t. Returns
+        the number of events published.
+        '''
+        threads = [threading.Thread(target=self.fetch)]
+        threads += [threading.Thread(target=self.format)
+                    for _ in range(self.formatters)]
+        for thread in threads:
+            thread.setDaemon(True) # Don't hang if the sender gives up
+            thread.start()
+
+        updatecursor = self.connection.cursor()
+        seq, n = 0, 0
+        unmarked = [] # Events of each message which hasn't been sent yet
+        while True:
+            result = self.next(seq)
+            if result is None:
+                break
+            msg, pubs, first, end, last = result
+            n += len(pubs)
+
+            unmarked.append(pubs)
+            sent = send(self.logger, msg, n - 1, self.mq, self.ssm,
+                        self.lstnr)
+            if sent:
+                self.mark(updatecursor, unmarked[:sent], t)
+                del unmarked[:sent]
+
+            if self.start == 0:
+                self.start = first
+            self.end = end
+            if self.last == 0 or last > self.last:
+                self.last = last
+            seq += 1
+
+        # Write the last, incomplete SSM file if any
+        if self.ssm is not None and self.ssm.flush():
+            self.mark(updatecursor, unmarked, t)
+
+        for thread in threads:
+            thread.join()
+        return n
+
+def watermark(cursor):
+    '''
+    Return the last eventTime published as recorded in the publication
+    table, or None if nothing has been published yet.
+    '''
+    cursor.execute("SELECT MAX(watermark) FROM %s" % common.PUBTAB)
+    w, = cursor.fetchone()
+    return w
 
-    if options.acctdbfile is None or options.vofile is None:
-        p.print_help()
-        return 1
+def record(cursor, t, w, n, since=None):
+    '''
+    Record publication run in publication table
 
-    try:
-        # Set configuration
-        conf = {}
-        if options.conf:
-            f = open(options.conf, 'r')
-            for l in f:
-                key, val = l.split(None, 1)
-                # Try to force it an integer
-                try:
-                    conf[key] = int(val[:-1]) # Remove trailing newline
-                except ValueError:
-                    conf[key] = val[:-1] # Remove trailing newline
-            f.close()
+    Expects a DB cursor, the publication time, the last eventTime published,
+    the number of events published and optionally the watermark the run
+    started from. If late rows have rewound the watermark below it meanwhile
+    (see common.rewind()), the rewound watermark is recorded instead, for
+    the next run to join them.
+    '''
+    cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE" % common.PUBTAB)
+    if since is not None:
+        rewound = watermark(cursor)
+        if rewound is not None and rewound < since:
+            w = min(w, rewound)
+    stmt = "INSERT INTO %s VALUES (:t, :w, :n)" % common.PUBTAB
+    cursor.execute(stmt, [t, w, n])
+
+def publish(logger, options, conf, vogroups, rge=None):
+    '''
+    Join local and CE job event records, publish them and mark them as
+    published.
 
-        # Load VO-group mapping from file
-        f = open(options.vofile, 'r')
-        vogroups = {}
-        for l in f:
-            key, val = l.split()
-            vogroups[key] = val
-        f.close()
-    except IOError, e:
-        logger.error(e)
-        return 1
+    Expects a logger, the command-line options, the configuration
+    dictionary, the VO-group mapping dictionary and optionally a (low, high)
+    eventTime range to restrict the join to. Returns 1 if anything went
+    wrong.
+    '''
 
     # Perform join, publish message, etc.
-    connection = common.connect(logger, options.acctdbfile)
+    connection = common.connect(logger, options.acctdbfile, True)
     cursor = connection.cursor()
+    cursor.arraysize = options.arraysize
 
     ce = common.CETAB
     local = common.LOCALTAB
@@ -233,6 +552,7 @@ def main():
     fqan.logger = logger
     fqan.unknowns = set()
 
+    APELField.i = 0 # Row indexes start again for each join
     fields = [
         APELField('Site', val=conf['site']),
         APELField('SubmitHost', ['%s.ceId' % ce], mty=conf['cluster']),
@@ -264,8 +584,8 @@ def main():
         APELField('Infrastructure', ['%s.userFQAN' % ce], fn=inf),
              ]
 
-    conf['fields'] = conf['fields'].split()
-    fields = [f for f in fields if f.apelfield in conf['fields']]
+    names = conf['fields'].split()
+    fields = [f for f in fields if f.apelfield in names]
 
     # But why not use DBCol there too? Because it's not about creating
     # a table, because we don't care about types but we are, however,
@@ -331,29 +651,55 @@ def main():
     dbcols = [f for f in fields if f.col != None]
 
     # Useful row indexes for later on
-    jobIdIdx = idx(dbcols, '%s.jobId' % common.LOCALTAB)
     eventTimeIdx = idx(dbcols, '%s.eventTime' % common.LOCALTAB)
     lrmsJobIdIdx = idx(dbcols, '%s.lrmsId' % common.CETAB)
 
     # Write SELECT statement
     try:
         select =  "SELECT %s" % ', '.join(', '.join(c.col) for c in dbcols)
+
+        # Append primary key, hidden from the message, to mark events with
+        pkIdx = sum([len(c.col) for c in dbcols])
+        select += ', %s' % ', '.join('%s.%s' % (common.LOCALTAB, c)
+                                     for c in common.LOCALTAB.pk)
         tables = "FROM %s LEFT JOIN %s" % (common.LOCALTAB, common.CETAB)
         on = "ON %s.jobId = %s.lrmsId" % (common.LOCALTAB, common.CETAB)
         where = "WHERE published = :e AND %s AND %s AND %s" % \
             (GRIDCECOND, common.STTCOND, common.CPUCOND)
+        args = [EPOCH, EPOCH]
+
+        # Only join the new eventTime window, which spares partitions
+        since = None
+        if options.incremental:
+            since = w = watermark(cursor)
+            if w is None:
+                logger.info("Nothing published yet, joining all events")
+            else:
+                w -= datetime.timedelta(hours=options.lookback)
+                logger.info("Joining events from %s on" % w)
+                where += " AND %s.eventTime >= :w" % common.LOCALTAB
+                args.append(w)
+
+        # Only join an eventTime range, e.g. a partition, in backlog mode
+        if rge is not None:
+            where += " AND %s.eventTime >= :l AND %s.eventTime < :h" % \
+                (common.LOCALTAB, common.LOCALTAB)
+            args.extend(rge)
+
         stmt = '%s %s %s %s' % (select, tables, on, where)
-        cursor.execute(stmt, [EPOCH, EPOCH])
+        cursor.execute(stmt, args)
     except cx_Oracle.DatabaseError, e:
         logger.error("Couldn't join local and CE job records: %s" % e)
         return 1
 
     # Connect to message broker
     if options.ssm == None:
+        ssm = None
         logger.info("Connecting to message broker on %s" % options.msgbroker)
         try:
             mq = stomp.Connection(host_and_ports=[(options.msgbroker, PORT)])
-            mq.set_listener('', MsgLstnr())
+            lstnr = MsgLstnr()
+            mq.set_listener('', lstnr)
             mq.start()
             mq.connect()
         except stomp.exception.ReconnectFailedException, e:
@@ -361,96 +707,30 @@ def main():
             return 1
     else:
         mq = None
+        lstnr = None
+        ssm = SSMWriter(logger, options.ssm, options.ssmbudget)
 
     # Retrieve rows and send messages to broker as you go
     logger.info("Performing join between %s and %s",
                 common.LOCALTAB, common.CETAB)
-    msg = HEADER
-    pubs = []
-    updatecursor = connection.cursor()
-    start, end = 0, 0
     t = datetime.datetime.now()
     try:
-        j = 0 # In case the cursor is empty
-        for j, row in enumerate(cursor):
-            for c in fields:
-                # Prefer DB value than constant because we absolutely need to
-                # increment i if we're dealing with a DB column for later on
-                if c.col != None:
-                    if c.fn is None:
-                        # If there's no function assigned, we can't be dealing 
-                        # with more than one DB column and we can therefore 
-                        # take just the one from the first (and assumingly 
-                        # only) index.
-                        val = row[c.colidxs[0]]
-                    else:
-                        # If there's an assigned function, use it and pass it
-                        # all the indexed columns as arguments.
-
-                        # Assigned functions should typically raise an
-                        # APELFieldError if any of the parameter is None.
-                        # It shouldn't happen if the DB does its job, hence
-                        # the exception.
-                        val = c.fn(*(row[i] for i in c.colidxs))
-
-                    # At this stage, val could be None in the c.fn is None
-                    # case above. That's why we need to check next.
-
-                    if val != None:
-                        msg += '%s: %s\n' % (c, val)
-                    elif val is None and c.mty != None:
-                        # If val is None and it's a compulsory APEL field,
-                        # give it the default value planned for compulsory
-                        # fields for which we have no data.
-                        msg += '%s: %s\n' % (c, c.mty)
-                    else:
-                        # Value may be None, so we shave it off the message
-                        # entirely.
-                        pass
-
-                    # This bit of code didn't really bother whether or not
-                    # the left join yielded None values on the right hand,
-                    # since all we really care about at the end of the day is
-                    # not have None values (or missing values, in fact, since
-                    # I shave None values off) where you don't want them.
-
-                elif c.val != None:
-                    # Constant, default value if we don't mean to look at the 
-                    # DB for this field.
-                    msg += '%s: %s\n' % (c, c.val)
-                else:
-                    # We're not looking at the DB and we didn't plan any 
-                    # constant, default value: we have a problem.
-                    raise APELFieldError(c)
-
-                # Record first and last eventTime
-                end = row[eventTimeIdx]
-                if start == 0:
-                    start = end
-
-            # Add jobId to temporary array for later flagging
-            pubs.append(row[jobIdIdx])
-            if (j + 1) % options.bunch == 0:
-                msg += '%%\n'
-                send(logger, msg, j, mq=mq, ssm=options.ssm)
-                msg = HEADER
-
-                # Mark this bunch as published
-                mark(updatecursor, pubs, t)
-            else:
-                msg += '%%\n'
-
-        # Send last bit if any
-        if msg != HEADER:
-            send(logger, msg, j, mq=mq, ssm=options.ssm)
-            mark(updatecursor, pubs, t)
+        publisher = Publisher(logger, connection, cursor, formatter(fields),
+                              options.bunch, eventTimeIdx, pkIdx, mq,
+                              ssm, lstnr, options.formatters)
+        n = publisher.run(t)
+        start, end = publisher.start, publisher.end
+
+        # Move watermark on, along with the published flags
+        if options.incremental and publisher.last != 0:
+            record(connection.cursor(), t, publisher.last, n, since)
     except cx_Oracle.DatabaseError, e:
         logger.error("Couldn't mark some records as published: %s" % e)
         return 1
     except stomp.exception.NotConnectedException:
         logger.error("Lost connection to message broker")
         return 1
-    except APELFieldError, e:
+    except (APELFieldError, AckError, IOError, OSError), e:
         logger.error(e)
         return 1
 
@@ -458,7 +738,7 @@ def main():
         logger.info("Didn't send any APEL message")
     else:
         log = "Sent APEL messages for %d events between %s and %s to %s"
-        logger.info(log % (j + 1, start, end, QUEUE))
+        logger.info(log % (n, start, end, QUEUE))
 
     # Disconnect from message broker
     if mq != None:
@@ -472,6 +752,202 @@ def main():
         return 1
 
     logger.info("Done")
+    return 0
+
+def ranges(cursor, tab):
+    '''
+    Work out which eventTime ranges unpublished events are to be joined by
+    in backlog mode: one range per monthly partition of the local table
+    overlapping unpublished events, or one range per month if the table
+    isn't partitioned.
+
+    Expects a DB cursor and the local table name. Returns a list of
+    (low, high) datetime pairs.
+    '''
+    stmt = "SELECT MIN(eventTime), MAX(eventTime) FROM %s WHERE published = :e"
+    cursor.execute(stmt % tab, [EPOCH])
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+
+    bounds = common.partbounds(cursor, tab)
+    if not bounds:
+        # Not partitioned: go by month
+        m = first.year * 12 + first.month - 1
+        while True:
+            b = datetime.datetime(m / 12, m % 12 + 1, 1)
+            bounds.append(b)
+            if b > last:
+                break
+            m += 1
+    else:
+        bounds.insert(0, EPOCH)
+
+    return [(l, h) for l, h in zip(bounds[:-1], bounds[1:])
+            if h > first and l <= last]
+
+def loadranges(path):
+    '''
+    Return the set of (low, high) UNIX timestamp pairs of the ranges
+    recorded in the backlog checkpoint file as already published.
+    '''
+    done = set()
+    try:
+        f = open(path)
+        for l in f:
+            low, high = l.split()
+            done.add((int(low), int(high)))
+        f.close()
+    except IOError:
+        pass
+    return done
+
+def saverange(path, rge):
+    '''
+    Record (low, high) datetime range in backlog checkpoint file as
+    published.
+    '''
+    f = open(path, 'a')
+    f.write('%d %d\n' % tuple([ts(t) for t in rge]))
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+def backlog(args):
+    '''
+    Publish one eventTime range of a backlog in a worker process, with its
+    own DB connection and broker connection or SSM writer.
+
+    Expects an (options, configuration, VO-group mapping, range) tuple and
+    returns a (range, exit code) tuple.
+    '''
+    options, conf, vogroups, rge = args
+    logger = logging.getLogger(common.LOGGER)
+    logger.info("Publishing backlog from %s to %s" % rge)
+    try:
+        code = publish(logger, options, conf, vogroups, rge)
+    except common.AcctDBError, e:
+        logger.error(e)
+        code = 1
+    return rge, code
+
+def backlogmain(logger, options, conf, vogroups):
+    '''
+    Publish the unpublished events by eventTime range (typically by
+    partition) with several worker processes, skipping the ranges the
+    backlog checkpoint file records as already published.
+    '''
+    import multiprocessing
+
+    try:
+        connection = common.connect(logger, options.acctdbfile)
+        todo = ranges(connection.cursor(), str(common.LOCALTAB))
+        connection.close()
+    except (common.AcctDBError, cx_Oracle.DatabaseError), e:
+        logger.error("Couldn't work out backlog ranges: %s" % e)
+        return 1
+
+    done = loadranges(options.checkpoint)
+    todo = [r for r in todo if (ts(r[0]), ts(r[1])) not in done]
+    logger.info("%d backlog ranges to publish" % len(todo))
+
+    # Workers don't move the watermark on
+    options.incremental = False
+
+    code = 0
+    pool = multiprocessing.Pool(options.workers)
+    for rge, c in pool.imap_unordered(backlog, [(options, conf, vogroups, r)
+                                                for r in todo]):
+        if c:
+            logger.error("Couldn't publish backlog from %s to %s" % rge)
+            code = 1
+        else:
+            saverange(options.checkpoint, rge)
+    pool.close()
+    pool.join()
+    return code
+
+def main():
+    # Read arguments
+    p = optparse.OptionParser()
+    help = "user/passwd@dsn-formatted accounting DB connection file path"
+    p.add_option("-a", "--acctdbfile", help=help)
+    help = "number of events per APEL message (default is %d)" % BUNCH
+    p.add_option("-b", "--bunch", default=BUNCH, type='int', help=help)
+    p.add_option("-c", "--conf", help="configuration file")
+    help="VO file (containing VO-group mappings)"
+    p.add_option("-v", "--vofile", help=help)
+    p.add_option("-s", "--ssm", help="SSM home directory")
+    help = "group messages into SSM files of up to SSMBUDGET bytes "
+    help += "(defaults to 0, i.e. one file per message)"
+    p.add_option("--ssmbudget", type='int', default=0, help=help)
+    help = "log file absolute path (defaults to %s)" % LOGFILE
+    p.add_option("-l", "--logfile", help=help, default=LOGFILE)
+    p.add_option("-m", "--msgbroker", help="message broker host")
+    help = "only join the events from the last eventTime published on, as "
+    help += "recorded in the %s table" % common.PUBTAB
+    p.add_option("-i", "--incremental", action='store_true', help=help)
+    help = "how many hours before the last eventTime published to join "
+    help += "again in incremental mode, for late CE records "
+    help += "(defaults to %d)" % LOOKBACK
+    p.add_option("--lookback", type='int', default=LOOKBACK, help=help)
+    help = "number of rows fetched at a time (defaults to %d)" % ARRAYSIZE
+    p.add_option("--arraysize", type='int', default=ARRAYSIZE, help=help)
+    help = "number of threads formatting messages (defaults to %d)" % \
+           FORMATTERS
+    p.add_option("--formatters", type='int', default=FORMATTERS, help=help)
+    help = "publish unpublished events by partition (or month) with several "
+    help += "worker processes, e.g. after a long outage"
+    p.add_option("--backlog", action='store_true', help=help)
+    help = "number of backlog worker processes (defaults to %d)" % WORKERS
+    p.add_option("--workers", type='int', default=WORKERS, help=help)
+    help = "backlog checkpoint file absolute path, recording which ranges "
+    help += "have been published (defaults to %s)" % CKPTFILE
+    p.add_option("-k", "--checkpoint", default=CKPTFILE, help=help)
+    options, args = p.parse_args()
+
+    # Set up logging
+    #logging.basicConfig(level=logging.INFO, format=fmt)
+    #h = logging.StreamHandler()
+    h = logging.FileHandler(options.logfile)
+    fmt = '%(asctime)s %(levelname)s %(message)s'
+    h.setFormatter(logging.Formatter(fmt, common.LOGDATEFMT))
+    logger = logging.getLogger(common.LOGGER)
+    logger.addHandler(h)
+    logger.setLevel(logging.INFO)
+
+    if options.acctdbfile is None or options.vofile is None:
+        p.print_help()
+        return 1
+
+    try:
+        # Set configuration
+        conf = {}
+        if options.conf:
+            f = open(options.conf, 'r')
+            for l in f:
+                key, val = l.split(None, 1)
+                # Try to force it an integer
+                try:
+                    conf[key] = int(val[:-1]) # Remove trailing newline
+                except ValueError:
+                    conf[key] = val[:-1] # Remove trailing newline
+            f.close()
+
+        # Load VO-group mapping from file
+        f = open(options.vofile, 'r')
+        vogroups = {}
+        for l in f:
+            key, val = l.split()
+            vogroups[key] = val
+        f.close()
+    except IOError, e:
+        logger.error(e)
+        return 1
+
+    if options.backlog:
+        return backlogmain(logger, options, conf, vogroups)
+    return publish(logger, options, conf, vogroups)
 
 if __name__ == '__main__':
     sys.exit(main())